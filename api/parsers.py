@@ -0,0 +1,24 @@
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+import codecs
+import csv
+
+# Разбор тела запроса в дополнительных форматах:
+
+class CSVParser(BaseParser):
+    """
+    Таблица csv с заголовком в первой строке.
+    Результат - список словарей строк таблицы, пустые ячейки в словари не попадают
+    """
+    media_type = 'text/csv'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        try:
+            reader = csv.DictReader(codecs.getreader(encoding)(stream))
+            return [{key.strip(): value.strip() for key, value in row.items() if key and value and value.strip()}
+                    for row in reader]
+        except (csv.Error, UnicodeDecodeError, AttributeError) as exc:
+            raise ParseError('CSV parse error - %s' % str(exc))
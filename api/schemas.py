@@ -10,6 +10,7 @@ class PartnerUpdateSchema(ResponsesSchema):
     """
     status_descriptions = {
         '201': t('Created'),
+        '202': t('Загрузка поставлена в очередь'),
         '404': t('URL не найден'),
     }
 
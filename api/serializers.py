@@ -1,4 +1,5 @@
 from collections import OrderedDict
+from django.conf import settings
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError, ObjectDoesNotExist, PermissionDenied, FieldError
 from django.db.utils import Error as DBError, ConnectionDoesNotExist
@@ -6,8 +7,13 @@ from django.utils.translation import gettext_lazy as t
 from recaptcha.fields import ReCaptchaField
 from rest_framework import serializers
 
-from core.models import Category, Shop, ProductInfo, Product, ProductParameter, OrderItem, Order
+from core.models import Category, Shop, ProductInfo, Product, ProductParameter, OrderItem, Order, ImportJob, ImportRun, ImportRunPhase, \
+    ImportReport, UploadSession, IMPORT_MODE_CHOICES
+from core.feed_compression import split_extension
+from core.partner_info_loader import get_feed_format
 from core.serializers import DefaultSerializer, DefaultModelSerializer, ModelPresenter
+from core.tasks import run_import_job
+from core.upload_sessions import missing_chunks
 from core.utils import is_dict
 from core.validators import NotBlankTogetherValidator, EqualTogetherValidator
 from rest_auth.models import User, Contact, ADDRESS_ITEMS_LIMIT
@@ -16,9 +22,13 @@ from rest_auth.models import User, Contact, ADDRESS_ITEMS_LIMIT
 class PartnerUpdateSerializer(DefaultSerializer):
     url = serializers.URLField(required=False, help_text=t('Путь к загружаемому файлу'), label=t('URL path'))
     file = serializers.FileField(required=False, help_text=t('Файл, передаваемый через http'), label=t('File field'))
+    mode = serializers.ChoiceField(choices=IMPORT_MODE_CHOICES, required=False,
+                                   help_text=t('Режим загрузки: полная замена прайса или только изменения'), label=t('Import mode'))
+    background = serializers.BooleanField(required=False, default=False,
+                                          help_text=t('Загрузить в фоне: сразу возвращается ИД задания импорта'), label=t('Background import'))
 
     class Meta:
-        write_only_fields = ('url', 'file', )
+        write_only_fields = ('url', 'file', 'mode', 'background', )
         validators = (
             NotBlankTogetherValidator(fields=('url', 'file', )),
         )
@@ -211,10 +221,138 @@ class CategoryDetailSerializer(DefaultModelSerializer):
         read_only_fields = ('url', 'id', )
 
 
+class ImportJobSerializer(DefaultModelSerializer):
+    result = serializers.SerializerMethodField(label=t('Результат загрузки'), help_text=t('Ответ загрузки прайса или сводка общего импорта'))
+
+    class Meta:
+        model = ImportJob
+        fields = ('id', 'kind', 'state', 'processed', 'total', 'result', 'created_at', 'finished_at', 'Errors', 'Status', )
+        read_only_fields = fields
+
+    def get_result(self, obj):
+        return obj.get_result()
+
+    def to_representation(self, instance):
+        data = super(ImportJobSerializer, self).to_representation(instance)
+        # Ход выполняющейся загрузки хранится в состоянии задачи celery:
+        if instance.kind == 'partner' and instance.state == 'running' and instance.task_id:
+            task = run_import_job.AsyncResult(instance.task_id)
+            if task.state == 'PROGRESS' and is_dict(task.info):
+                data['processed'] = task.info.get('processed', data['processed'])
+                data['total'] = task.info.get('total', data['total'])
+        return data
+
+
+class ImportRunPhaseSerializer(DefaultModelSerializer):
+    rows_per_second = serializers.FloatField(read_only=True, label=t('Товаров в секунду'), help_text=t('Скорость обработки товаров на этапе'))
+
+    class Meta:
+        model = ImportRunPhase
+        fields = ('name', 'duration', 'rows', 'rows_per_second', 'queries', 'memory_peak', )
+        read_only_fields = fields
+
+
+class ImportRunSerializer(DefaultModelSerializer):
+    shop = serializers.StringRelatedField(label=t('Магазин'), help_text=t('Магазин, прайс которого загружался'))
+    phases = ImportRunPhaseSerializer(many=True, read_only=True, label=t('Этапы'), help_text=t('Показатели загрузки по этапам'))
+
+    class Meta:
+        model = ImportRun
+        fields = ('id', 'shop', 'job', 'source', 'status_code', 'rows', 'duration', 'queries', 'started_at', 'phases',
+                  'Errors', 'Status', )
+        read_only_fields = fields
+        extra_kwargs = {
+            'job': {'view_name': 'api:partner-job', 'lookup_url_kwarg': 'job_id'},
+        }
+
+
+class PartnerPatchItemSerializer(serializers.Serializer):
+    external_id = serializers.IntegerField(min_value=0, help_text=t('Внешний ИД товара в прайсе'), label=t('External id'))
+    quantity = serializers.IntegerField(required=False, min_value=0, help_text=t('Количество'), label=t('Quantity'))
+    price = serializers.DecimalField(required=False, max_digits=20, decimal_places=2, min_value=0,
+                                     help_text=t('Цена'), label=t('Price'))
+    price_rrc = serializers.DecimalField(required=False, max_digits=20, decimal_places=2, min_value=0,
+                                         help_text=t('Рекомендуемая розничная цена'), label=t('RRC price'))
+
+    def validate(self, attrs):
+        if len(attrs) < 2:
+            raise serializers.ValidationError(t('Не задано ни одно изменяемое поле (quantity, price, price_rrc)'))
+        return attrs
+
+
+class PartnerPatchSerializer(DefaultSerializer):
+    shop = serializers.IntegerField(required=False, help_text=t('ИД магазина (если у поставщика несколько магазинов)'), label=t('Shop'))
+    goods = PartnerPatchItemSerializer(many=True, allow_empty=False, help_text=t('Изменения остатков и цен'), label=t('Goods'))
+
+    class Meta:
+        write_only_fields = ('shop', 'goods', )
+
+    def validate_goods(self, value):
+        if len(value) > settings.PRICE_IMPORT['PATCH_MAX_ITEMS']:
+            raise serializers.ValidationError(t('Слишком много изменений в одном запросе'))
+        return value
+
+
+class ImportReportSerializer(DefaultModelSerializer):
+    shop = serializers.StringRelatedField(label=t('Магазин'), help_text=t('Магазин, прайс которого загружен частично'))
+    download = serializers.HyperlinkedIdentityField(view_name='api:partner-report', lookup_url_kwarg='report_id',
+                                                    label=t('Скачать'), help_text=t('Ссылка на отчет (csv)'))
+
+    class Meta:
+        model = ImportReport
+        fields = ('id', 'shop', 'skipped', 'created_at', 'download', 'Errors', 'Status', )
+        read_only_fields = fields
+
+
+class UploadSessionCreateSerializer(DefaultSerializer):
+    name = serializers.CharField(max_length=255, help_text=t('Имя файла прайса (по расширению определяется формат)'), label=t('File name'))
+    size = serializers.IntegerField(min_value=1, help_text=t('Размер файла, байт'), label=t('File size'))
+    chunk_size = serializers.IntegerField(required=False, min_value=1, help_text=t('Размер части, байт'), label=t('Chunk size'))
+    checksum = serializers.RegexField(r'^[0-9a-fA-F]{64}$', required=False, allow_blank=True,
+                                      help_text=t('sha256 всего файла (hex), проверяется при завершении загрузки'), label=t('Checksum'))
+    mode = serializers.ChoiceField(choices=IMPORT_MODE_CHOICES, required=False,
+                                   help_text=t('Режим загрузки: полная замена прайса или только изменения'), label=t('Import mode'))
+
+    class Meta:
+        write_only_fields = ('name', 'size', 'chunk_size', 'checksum', 'mode', )
+
+    def validate_name(self, value):
+        extension, _ = split_extension(value)
+        if not get_feed_format('', extension):
+            raise serializers.ValidationError(t('Не опознан формат файла'))
+        return value
+
+    def validate_size(self, value):
+        if value > settings.PRICE_IMPORT['UPLOAD_MAX_SIZE']:
+            raise serializers.ValidationError(t('Слишком большой файл'))
+        return value
+
+    def validate_chunk_size(self, value):
+        if value > settings.PRICE_IMPORT['UPLOAD_MAX_CHUNK_SIZE']:
+            raise serializers.ValidationError(t('Слишком большой размер части'))
+        return value
+
+
+class UploadSessionSerializer(DefaultModelSerializer):
+    missing = serializers.SerializerMethodField(label=t('Недостающие части'), help_text=t('Номера еще не принятых частей файла'))
+
+    class Meta:
+        model = UploadSession
+        fields = ('id', 'name', 'size', 'chunk_size', 'chunks', 'missing', 'state', 'job', 'created_at', 'updated_at',
+                  'Errors', 'Status', )
+        read_only_fields = fields
+        extra_kwargs = {
+            'job': {'view_name': 'api:partner-job', 'lookup_url_kwarg': 'job_id'},
+        }
+
+    def get_missing(self, obj):
+        return missing_chunks(obj) if obj.state == 'open' else []
+
+
 class ShopSerializer(DefaultModelSerializer):
     class Meta:
         model = Shop
-        fields = ('url', 'id', 'name', 'state', 'Errors', 'Status', )
+        fields = ('url', 'id', 'name', 'state', 'error_policy', 'Errors', 'Status', )
         read_only_fields = ('url', 'id', 'name', )
 
 
@@ -243,10 +381,58 @@ class ProductInfoSerializer(DefaultModelSerializer):
         read_only_fields = ('url', 'id', )
 
 
+# Части позиции каталога (CatalogItem): поля берутся из строки каталога,
+# ссылки строятся по id без запросов к базе
+
+class CatalogShopSerializer(serializers.Serializer):
+    url = serializers.HyperlinkedRelatedField(source='shop', view_name='shop-detail', read_only=True)
+    name = serializers.CharField(source='shop_name', read_only=True)
+
+
+class CatalogCategorySerializer(serializers.Serializer):
+    url = serializers.HyperlinkedRelatedField(source='category', view_name='category-detail', read_only=True)
+    id = serializers.IntegerField(source='category_id', read_only=True)
+    name = serializers.CharField(source='category_name', read_only=True)
+
+
+class CatalogProductSerializer(serializers.Serializer):
+    name = serializers.CharField(source='product_name', read_only=True)
+    category = CatalogCategorySerializer(source='*', read_only=True)
+
+
+class CatalogItemSerializer(DefaultSerializer):
+    """
+    Позиция каталога в представлении позиции прайса (как ProductInfoSerializer)
+    """
+
+    url = serializers.HyperlinkedIdentityField(view_name='productinfo-detail')
+    id = serializers.IntegerField(source='product_info_id', read_only=True)
+    product = CatalogProductSerializer(source='*', read_only=True, label=t('Товар'), help_text=t('ДАнные по товару'))
+    shop = CatalogShopSerializer(source='*', read_only=True, label=t('Магазин'), help_text=t('Данные по магазину'))
+    quantity = serializers.IntegerField(read_only=True, label=t('Количество'))
+    price = serializers.DecimalField(max_digits=20, decimal_places=2, read_only=True, label=t('Цена'))
+    price_rrc = serializers.DecimalField(max_digits=20, decimal_places=2, read_only=True,
+                                         label=t('Рекомендуемая розничная цена'))
+    product_parameters = serializers.SerializerMethodField(label=t('Параметры'), help_text=t('Параметры товара'))
+
+    def get_product_parameters(self, obj):
+        return [dict(parameter=name, value=value) for name, value in obj.get_parameters().items()]
+
+
+class SuggestionSerializer(DefaultSerializer):
+    """
+    Подсказка поиска: продукт или категория (см. core.suggest)
+    """
+
+    type = serializers.CharField(read_only=True, label=t('Вид'), help_text=t('product или category'))
+    id = serializers.IntegerField(read_only=True)
+    name = serializers.CharField(read_only=True, label=t('Название'))
+
+
 class AddOrderItemSerializer(DefaultModelSerializer):
     items = serializers.JSONField(required=False)
     product_info = serializers.PrimaryKeyRelatedField(
-        queryset=ProductInfo.objects.select_related('shop', 'product').prefetch_related('shop__user').all())
+        queryset=ProductInfo.objects.active().select_related('shop', 'product').prefetch_related('shop__user'))
     class Meta:
         model = OrderItem
         fields = ('product_info', 'quantity', 'items', 'Errors', 'Status', )
@@ -3,15 +3,18 @@ from django.conf import settings
 from django.core.exceptions import ValidationError, ObjectDoesNotExist, PermissionDenied, FieldError
 from django.db.utils import Error as DBError, ConnectionDoesNotExist
 from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+from django.test.utils import override_settings
 from django.urls import reverse
+import hashlib
 import os
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase, APIRequestFactory, APILiveServerTestCase
 
 from rest_auth.models import User
-from core.models import Category, ProductInfo, Parameter, ProductParameter
+from core.models import Category, Shop, ProductInfo, Parameter, ProductParameter, ImportJob, ImportRun, ImportReport, UploadSession
 from core.partner_info_loader import load_partner_info
+from core.tasks import import_shop, import_summary, run_import_job
 
 class PartnerUpdateTests(APILiveServerTestCase):
     """
@@ -457,3 +460,343 @@ class PartnerUpdateTests(APILiveServerTestCase):
         """
 
         self.try_partner_update_file('noparams.json', check_parameters=False)
+
+    def test_partner_update_url_not_modified_direct(self):
+        """
+        Прайс магазина, не изменившийся с последней загрузки, запрашивается условно и не записывается
+        """
+        self.create_user()
+        user = User.objects.get(email=self.data['email'])
+        url = self.live_server_url + reverse('api:test_url', kwargs={'ext': 'json'})
+
+        response = load_partner_info(url=url, user_id=user.id)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        shop = Shop.objects.get(user=user)
+        self.assertTrue(shop.feed_etag)
+        self.assertEqual(len(shop.feed_digest), 64)
+        info_ids = set(ProductInfo.objects.values_list('id', flat=True))
+
+        shop.load_url = url
+        shop.save()
+        response = load_partner_info(url=url, user_id=user.id, shop=shop)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['NotModified'], True)
+        self.assertEqual(set(ProductInfo.objects.values_list('id', flat=True)), info_ids)
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=0)
+    def test_partner_update_temporary_file_json(self):
+        """
+        Загрузить информацию поставщика из файла json, сохраненного Django во временный файл на диске
+        """
+        self.try_partner_update_file('json')
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=0)
+    def test_partner_update_temporary_file_yaml(self):
+        """
+        Загрузить информацию поставщика из файла yaml, сохраненного во временный файл
+        """
+        self.try_partner_update_file('yaml')
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=0)
+    def test_partner_update_temporary_file_xml(self):
+        """
+        Загрузить информацию поставщика из файла xml, сохраненного во временный файл
+        """
+        self.try_partner_update_file('xml')
+
+    def test_partner_update_file_same_digest(self):
+        """
+        Повторная загрузка того же файла не записывается в базу
+        """
+        self.try_partner_update_file('json')
+        info_ids = set(ProductInfo.objects.values_list('id', flat=True))
+
+        with open(os.path.join(settings.MEDIA_ROOT, 'tests/shop1.json'), 'rb') as fp:
+            response = self.client.post(reverse('api:partner-update'),
+                                        data=encode_multipart(BOUNDARY, {'file': fp}),
+                                        content_type=MULTIPART_CONTENT)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['NotModified'], True)
+        self.assertEqual(set(ProductInfo.objects.values_list('id', flat=True)), info_ids)
+
+    def test_partner_update_import_profile(self):
+        """
+        Показатели загрузки по этапам сохраняются и доступны поставщику
+        """
+        with self.settings(PRICE_IMPORT=dict(settings.PRICE_IMPORT, PROFILE_MEMORY=True)):
+            self.try_partner_update_file('json')
+
+        run = ImportRun.objects.get()
+        self.assertEqual(run.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(run.source, 'shop1.json')
+        self.assertEqual(run.rows, ProductInfo.objects.count())
+        self.assertTrue(run.queries)
+
+        response = self.client.get(reverse('api:partner-imports'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.data['data']
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['shop'], str(run.shop))
+        phases = {phase['name']: phase for phase in data[0]['phases']}
+        self.assertEqual(set(phases), {'fetch', 'decode', 'validate', 'resolve', 'write'})
+        for name in ('decode', 'validate', 'resolve', 'write'):
+            self.assertEqual(phases[name]['rows'], run.rows)
+            self.assertTrue(phases[name]['rows_per_second'])
+        self.assertTrue(phases['write']['queries'])
+        self.assertTrue(phases['decode']['memory_peak'])
+
+    def test_import_shop_tasks(self):
+        """
+        Импорт прайсов по магазинам: ошибка одного магазина не прерывает общий импорт
+        """
+        self.create_user()
+        user = User.objects.get(email=self.data['email'])
+        good = Shop.objects.create(name='Связной', user=user,
+                                   load_url=self.live_server_url + reverse('api:test_url', kwargs={'ext': 'json'}))
+        bad = Shop.objects.create(name='Недоступный', user=user,
+                                  load_url=self.live_server_url + reverse('api:test_url', kwargs={'ext': 'nonreal.json'}))
+
+        results = [import_shop(good.id), import_shop(bad.id)]
+
+        self.assertEqual(results[0]['success'], True)
+        self.assertEqual(results[1]['success'], False)
+        self.assertEqual(results[1]['status'], status.HTTP_404_NOT_FOUND)
+        self.assertTrue(results[1]['errors'])
+        self.assertTrue(ProductInfo.objects.filter(shop=good).count())
+        self.assertEqual(import_summary(results), dict(total=2, succeeded=1, failed=[bad.id], partial=[]))
+
+    def test_partner_update_background(self):
+        """
+        Фоновая загрузка прайса: задание ставится в очередь, его состояние доступно по ссылке
+        """
+        self.create_user()
+        user = User.objects.get(email=self.data['email'])
+        token = Token.objects.get_or_create(user_id=user.id)[0].key
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+
+        with open(os.path.join(settings.MEDIA_ROOT, 'tests/shop1.yaml'), 'rb') as fp:
+            response = self.client.post(reverse('api:partner-update'),
+                                        data=encode_multipart(BOUNDARY, {'file': fp, 'background': 'true'}),
+                                        content_type=MULTIPART_CONTENT)
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job = ImportJob.objects.get(id=response.data['Job'])
+        self.assertEqual(job.state, 'queued')
+        self.assertEqual(job.user, user)
+        self.assertFalse(ProductInfo.objects.count())
+
+        run_import_job.apply(args=(job.id, ))
+
+        response = self.client.get(response.data['Url'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.data['data']
+        self.assertEqual(data['state'], 'done')
+        self.assertEqual(data['processed'], ProductInfo.objects.count())
+        self.assertEqual(data['total'], data['processed'])
+        self.assertEqual(data['result']['Created'], 4)
+        self.assertFalse(ImportJob.objects.get(id=job.id).file)
+        self.assertEqual(job.runs.get().rows, data['processed'])
+
+    def test_partner_patch(self):
+        """
+        Обновление остатков и цен по внешнему ИД в json и csv без загрузки прайса
+        """
+        self.try_partner_update_file('json')
+        first, second = ProductInfo.objects.order_by('external_id')[:2]
+
+        response = self.client.post(reverse('api:partner-patch'), format='json', data=[
+            {'external_id': first.external_id, 'quantity': 0},
+            {'external_id': second.external_id, 'price': '99.50', 'price_rrc': 120},
+            {'external_id': 1, 'quantity': 5},
+        ])
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertEqual(response.data['Updated'], 2)
+        self.assertEqual(response.data['NotFound'], [1])
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.quantity, 0)
+        self.assertEqual((str(second.price), str(second.price_rrc)), ('99.50', '120.00'))
+        self.assertFalse(Shop.objects.get().feed_digest)
+
+        quantity = second.quantity
+        content = f'external_id,quantity,price\n{first.external_id},7,\n{second.external_id},,10\n'
+        response = self.client.patch(reverse('api:partner-patch'), data=content, content_type='text/csv')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.data)
+        self.assertEqual(response.data['Updated'], 2)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.quantity, second.quantity, second.price), (7, quantity, 10))
+
+        response = self.client.post(reverse('api:partner-patch'), format='json',
+                                    data=[{'external_id': first.external_id}])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Тот же прайс после обновления загружается заново:
+        with open(os.path.join(settings.MEDIA_ROOT, 'tests/shop1.json'), 'rb') as fp:
+            response = self.client.post(reverse('api:partner-update'),
+                                        data=encode_multipart(BOUNDARY, {'file': fp}),
+                                        content_type=MULTIPART_CONTENT)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertNotEqual(ProductInfo.objects.active().get(external_id=first.external_id).quantity, 7)
+
+    def test_partner_patch_shops(self):
+        """
+        Поставщику с несколькими магазинами нужно указать магазин
+        """
+        user = self.login()
+        shops = [Shop.objects.create(name=name, user=user) for name in ('Первый', 'Второй')]
+        data = {'goods': [{'external_id': 1, 'quantity': 1}]}
+
+        response = self.client.post(reverse('api:partner-patch'), format='json', data=data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(reverse('api:partner-patch'), format='json', data=dict(data, shop=shops[1].id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['NotFound'], [1])
+
+        response = self.client.post(reverse('api:partner-patch') + '?shop=0', format='json', data=data)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_partner_update_partial(self):
+        """
+        Частичная загрузка прайса с пропуском товаров с ошибками и отчетом о них
+        """
+        user = self.login()
+        Shop.objects.create(name='Связной', user=user)
+        response = self.client.put(reverse('api:partner-state'), data={'error_policy': 'skip'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Shop.objects.get(name='Связной').error_policy, 'skip')
+        self.assertTrue(Shop.objects.get(name='Связной').state)
+
+        with open(os.path.join(settings.MEDIA_ROOT, 'tests/shop1.wrong10.json'), 'rb') as fp:
+            response = self.client.post(reverse('api:partner-update'),
+                                        data=encode_multipart(BOUNDARY, {'file': fp}),
+                                        content_type=MULTIPART_CONTENT)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(response.data['Partial'])
+        self.assertEqual(response.data['Skipped'], 1)
+        self.assertEqual(ProductInfo.objects.count(), 3)
+
+        response = self.client.get(reverse('api:partner-reports'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['data']), 1)
+        report = response.data['data'][0]
+        self.assertEqual(report['skipped'], 1)
+
+        response = self.client.get(report['download'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        content = b''.join(response.streaming_content).decode('utf-8-sig')
+        self.assertEqual(content.splitlines()[1].split(',')[0], '0')
+        ImportReport.objects.get().file.delete()
+
+    def login(self, email=None):
+        self.create_user(email)
+        user = User.objects.get(email=email or self.data['email'])
+        token = Token.objects.get_or_create(user_id=user.id)[0].key
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+        return user
+
+    def put_chunk(self, upload_id, number, content, checksum=None):
+        return self.client.put(reverse('api:partner-upload-chunk', kwargs={'upload_id': upload_id, 'number': number}),
+                               data=content, content_type='application/octet-stream',
+                               HTTP_X_CHECKSUM_SHA256=checksum or hashlib.sha256(content).hexdigest())
+
+    def test_partner_update_chunked(self):
+        """
+        Загрузка прайса по частям с докачкой недостающих частей
+        """
+        self.login()
+        with open(os.path.join(settings.MEDIA_ROOT, 'tests/shop1.yaml'), 'rb') as fp:
+            content = fp.read()
+        chunk_size = len(content) // 3 + 1
+        chunks = [content[start:start + chunk_size] for start in range(0, len(content), chunk_size)]
+
+        response = self.client.post(reverse('api:partner-uploads'),
+                                    data={'name': 'shop1.yaml', 'size': len(content), 'chunk_size': chunk_size,
+                                          'checksum': hashlib.sha256(content).hexdigest()}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['Chunks'], 3)
+        upload_id, url = response.data['Upload'], response.data['Url']
+
+        # Части передаются в любом порядке, часть с неверной контрольной суммой не принимается:
+        self.assertEqual(self.put_chunk(upload_id, 2, chunks[2]).status_code, status.HTTP_200_OK)
+        response = self.put_chunk(upload_id, 0, chunks[0], checksum='0' * 64)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.put_chunk(upload_id, 1, chunks[1][:-1]).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(url).data['data']['missing'], [0, 1])
+
+        response = self.client.post(reverse('api:partner-upload-finalize', kwargs={'upload_id': upload_id}))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['Missing'], [0, 1])
+
+        self.assertEqual(self.put_chunk(upload_id, 1, chunks[1]).status_code, status.HTTP_200_OK)
+        response = self.put_chunk(upload_id, 0, chunks[0])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['Missing'], 0)
+
+        response = self.client.post(reverse('api:partner-upload-finalize', kwargs={'upload_id': upload_id}))
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job = ImportJob.objects.get(id=response.data['Job'])
+        self.assertEqual(UploadSession.objects.get(id=upload_id).job, job)
+        self.assertEqual(self.put_chunk(upload_id, 0, chunks[0]).status_code, status.HTTP_409_CONFLICT)
+
+        run_import_job.apply(args=(job.id, ))
+
+        job = ImportJob.objects.get(id=job.id)
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.get_result()['Created'], 4)
+        self.assertFalse(job.file)
+
+    def test_partner_update_chunked_wrong(self):
+        """
+        Ошибки загрузки по частям: неизвестный формат, неверная контрольная сумма файла, чужая загрузка
+        """
+        user = self.login()
+        response = self.client.post(reverse('api:partner-uploads'), data={'name': 'shop1.txt', 'size': 10}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        content = b'{"version": "v1.0"}'
+        response = self.client.post(reverse('api:partner-uploads'),
+                                    data={'name': 'shop1.json', 'size': len(content), 'checksum': 'f' * 64}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        upload_id = response.data['Upload']
+        self.assertEqual(self.put_chunk(upload_id, 1, content).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.put_chunk(upload_id, 0, content).status_code, status.HTTP_200_OK)
+        response = self.client.post(reverse('api:partner-upload-finalize', kwargs={'upload_id': upload_id}))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(ImportJob.objects.count())
+
+        self.login('sample2@mail.com')
+        self.assertEqual(self.client.get(reverse('api:partner-upload', kwargs={'upload_id': upload_id})).status_code,
+                         status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.put_chunk(upload_id, 0, content).status_code, status.HTTP_404_NOT_FOUND)
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {user.auth_token.key}')
+        response = self.client.delete(reverse('api:partner-upload', kwargs={'upload_id': upload_id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(UploadSession.objects.count())
+
+    def test_partner_update_background_wrong(self):
+        """
+        Ошибка фоновой загрузки сохраняется в задании, чужие задания недоступны
+        """
+        self.create_user()
+        user = User.objects.get(email=self.data['email'])
+        job = ImportJob.objects.create(user=user, url=self.live_server_url + reverse('api:test_url', kwargs={'ext': 'wrong3.json'}))
+
+        run_import_job.apply(args=(job.id, ))
+
+        job = ImportJob.objects.get(id=job.id)
+        self.assertEqual(job.state, 'failed')
+        self.assertIn('Errors', job.get_result())
+        self.assertFalse(ProductInfo.objects.count())
+
+        self.create_user('sample2@mail.com')
+        other = User.objects.get(email='sample2@mail.com')
+        token = Token.objects.get_or_create(user_id=other.id)[0].key
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+        response = self.client.get(reverse('api:partner-job', kwargs={'job_id': job.id}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
@@ -2,15 +2,19 @@ from copy import deepcopy
 from django.conf import settings
 from django.contrib.auth import authenticate
 from django.core.exceptions import ValidationError, ObjectDoesNotExist, PermissionDenied, FieldError
+from django.db import connection
 from django.db.utils import Error as DBError, ConnectionDoesNotExist
 from django.test.client import BOUNDARY, MULTIPART_CONTENT, encode_multipart
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 import os
+from unittest import mock
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase
 
 from core.models import ProductInfo, Shop, Category, Order
+from core.pagination import ListingPagination
 from core.utils import is_dict, is_list
 from rest_auth.models import User, Contact
 
@@ -832,6 +836,144 @@ class APITests(APITestCase):
             self.assertIn('parameter', entry)
             self.assertIn('value', entry)
         
+    def test_get_product_info_queries(self):
+        """
+        Страница каталога читается одним запросом (и одним запросом считается число позиций)
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('api:productinfo-list'), format='json')
+
+        # Кроме запросов к кэшу каталога (CACHES['catalog']):
+        self.assertEqual(len([query for query in queries if 'core_' in query['sql']]), 2)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['results'])
+
+    def product_ids(self, url):
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item['id'] for item in response.data['results']], response.data
+
+    def test_get_product_info_cursor(self):
+        """
+        Тест постраничного вывода продуктов курсором: те же позиции, что и по номерам страниц,
+        в порядке сортировки, переход назад возвращает те же страницы
+        """
+        for ordering in ('', '&ordering=price', '&ordering=-price,quantity'):
+            with mock.patch.object(ListingPagination, 'page_size', 1):
+                expected = []
+                url = reverse('api:productinfo-list') + '?page=1' + ordering
+                while url:
+                    ids, data = self.product_ids(url)
+                    expected += ids
+                    url = data['next']
+
+                pages = []
+                url = reverse('api:productinfo-list') + '?paginate=cursor' + ordering
+                while url:
+                    ids, data = self.product_ids(url)
+                    self.assertNotIn('count', data)
+                    pages.append(ids)
+                    url = data['next']
+
+                backward = []
+                url = data['previous']
+                while url:
+                    ids, data = self.product_ids(url)
+                    backward.insert(0, ids)
+                    url = data['previous']
+
+            cursor_ids = sum(pages, [])
+            self.assertGreater(len(pages), 2)
+            self.assertEqual(sorted(cursor_ids), sorted(expected))
+            self.assertEqual(len(set(cursor_ids)), len(cursor_ids))
+            self.assertEqual(backward, pages[:-1])
+            if ordering:
+                prices = list(ProductInfo.objects.filter(id__in=cursor_ids).values_list('id', 'price'))
+                prices = dict(prices)
+                self.assertEqual([prices[id] for id in cursor_ids],
+                                 sorted(prices.values(), reverse=ordering.startswith('&ordering=-')))
+
+    def test_get_product_parameters_cursor(self):
+        with mock.patch.object(ListingPagination, 'page_size', 5):
+            ids, data = self.product_ids(reverse('api:productparameter-list') + '?paginate=cursor')
+            url, names = data['next'], [item['parameter'] for item in data['results']]
+            while url:
+                page, data = self.product_ids(url)
+                ids += page
+                names += [item['parameter'] for item in data['results']]
+                url = data['next']
+        count = self.client.get(reverse('api:productparameter-list'), format='json').data['count']
+
+        self.assertEqual(len(set(ids)), count)
+        self.assertEqual(names, sorted(names))
+
+    def test_get_product_info_wrong_cursor(self):
+        response = self.client.get(reverse('api:productinfo-list') + '?cursor=abc', format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_product_info_cached_count(self):
+        """
+        Тест кэширования числа продуктов до изменения каталога
+        """
+        url = reverse('api:productinfo-list')
+        # Кэш каталога - из настроек проекта (общий для процессов), без подмены в тесте:
+        count = self.client.get(url, format='json').data['count']
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url + '?page=1', format='json').data['count'], count)
+        self.assertFalse([query for query in queries if 'COUNT(' in query['sql']])
+
+        self.login_user(self.shop_owner1_data)
+        response = self.client.put(reverse('api:partner-state'), data={'state': 'false'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.clear_credentials()
+
+        self.assertEqual(self.client.get(url + '?search=', format='json').data['count'], 0)
+
+    def test_search_product_info(self):
+        """
+        Тест поиска продуктов: по названию, категории и параметрам, по началу слов
+        """
+        ids, _ = self.product_ids(reverse('api:productinfo-list') + '?search=iphone xr')
+        self.assertEqual(len(ids), 3)
+        ids, _ = self.product_ids(reverse('api:productinfo-list') + '?search=смартфоны,черн')
+        self.assertEqual(len(ids), 1)
+        # В том числе по значению параметра (встроенная память):
+        ids, _ = self.product_ids(reverse('api:productinfo-list') + '?search=256')
+        self.assertEqual(len(ids), 3)
+        ids, data = self.product_ids(reverse('api:productinfo-list') + '?search=xs&paginate=cursor')
+        self.assertEqual(len(ids), 1)
+        self.test_get_product_info('?search=apple&ordering=-price')
+
+    def test_fuzzy_search_product_info(self):
+        """
+        Тест поиска продуктов с опечатками, если полнотекстовый поиск ничего не нашел
+        """
+        with self.settings(CATALOG_SEARCH=dict(settings.CATALOG_SEARCH, FUZZY_SYNC_INTERVAL=0,
+                                               FUZZY_REBUILD_INTERVAL=0)):
+            ids, _ = self.product_ids(reverse('api:productinfo-list') + '?search=iphne xr')
+            self.assertEqual(len(ids), 3)
+            ids, _ = self.product_ids(reverse('api:productinfo-list') + '?search=iphne чрный')
+            self.assertEqual(len(ids), 1)
+            ids, _ = self.product_ids(reverse('api:productinfo-list') + '?search=qwerty')
+            self.assertEqual(ids, [])
+
+    def test_suggest_product_info(self):
+        """
+        Тест подсказок поиска
+        """
+        url = reverse('api:productinfo-suggest')
+        with self.settings(CATALOG_SEARCH=dict(settings.CATALOG_SEARCH, SUGGEST_SYNC_INTERVAL=0)):
+            response = self.client.get(url + '?q=iphone xr', format='json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([item['name'] for item in response.data], [
+                'Смартфон Apple iPhone XR 256GB (красный)',
+                'Смартфон Apple iPhone XR 128GB (синий)',
+                'Смартфон Apple iPhone XR 256GB (черный)',
+            ])
+            response = self.client.get(url + '?q=смартф', format='json')
+            self.assertEqual(response.data[-1], dict(type='category', id=response.data[-1]['id'], name='Смартфоны'))
+            self.assertEqual(self.client.get(url, format='json').data, [])
+
     def test_get_product_info_query_shop_id(self, query=''):
         """
         Тест получения списка продуктов с фильтрацией по магазину
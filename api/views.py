@@ -6,17 +6,23 @@ from django.core.exceptions import ValidationError, ObjectDoesNotExist, Permissi
 from django.db import transaction, IntegrityError
 from django.db.models import Q, Sum, F, DecimalField
 from django.db.utils import Error as DBError, ConnectionDoesNotExist
-from django.http import HttpResponse, HttpResponseNotFound
+from django.http import HttpResponse, HttpResponseNotFound, FileResponse
 from django.urls import resolve
+from django.utils.cache import get_conditional_response
 from django.utils.decorators import method_decorator
+from django.utils.http import quote_etag
 from django.utils.translation import gettext_lazy as t
 from django.views.decorators.cache import cache_page, never_cache
 from django.views.decorators.vary import vary_on_headers
+from django_filters.rest_framework import DjangoFilterBackend
+import hashlib
+import io
 import os
 from rest_framework import viewsets, mixins
 from rest_framework.authtoken.models import Token
 from rest_framework.decorators import api_view, action
 from rest_framework.generics import ListAPIView
+from rest_framework.parsers import JSONParser
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
@@ -25,24 +31,38 @@ from ujson import loads as load_json
 
 
 from core.mixins import SuperSelectableMixin, ViewSetViewSerializersMixin, ViewSetViewDescriptionsMixin
-from core.models import Category, Shop, ProductInfo, Product, ProductParameter, Order, OrderItem
+from core.catalog import refresh_shops
+from core.filters import AliasOrderingFilter, CatalogSearchFilter
+from core.models import Category, Shop, ProductInfo, Product, ProductParameter, Order, OrderItem, ImportJob, ImportRun, \
+    ImportReport, UploadSession, CatalogItem, VISIBLE_CATALOG
 from core.partner_info_loader import load_partner_info
+from core.price_patch import apply_patch
+from core.suggest import suggest_index
 from core.permissions import IsShop, IsBuyer
-from core.response import ResponseOK, ResponseCreated, ResponseBadRequest, ResponseForbidden, ResponseConflict
-from core.utils import to_positive_int, is_dict
+from core.response import ResponseOK, ResponseCreated, ResponseAccepted, ResponseBadRequest, ResponseForbidden, \
+    ResponseConflict, ResponseNotFound
+from core.tasks import run_import_job
+from core.upload_sessions import create_session, write_chunk, finalize_session, delete_session
+from core.utils import to_positive_int, is_dict, is_list
 from rest_auth.models import User, ConfirmEmailToken, Contact, ADDRESS_ITEMS_LIMIT
 
 from .serializers import RegisterUserSerializer, CategorySerializer, CategoryDetailSerializer, \
     ContactSerializer, PartnerUpdateSerializer, ContactBulkDeleteSerializer, \
-    ShopSerializer, ProductInfoSerializer, UserLoginSerializer, ListUserSerializer, \
+    ShopSerializer, CatalogItemSerializer, UserLoginSerializer, ListUserSerializer, \
     CaptchaInfoSerializer, ConfirmUserSerializer, UpdateUserDetailsSerializer, \
-    ProductParameterSerializer, OrderSerializer, CreateOrderSerializer, \
+    ProductParameterSerializer, OrderSerializer, CreateOrderSerializer, SuggestionSerializer, \
     AddOrderItemSerializer, ShowBasketSerializer, OrderItemsStringSerializer, \
-    BasketSetQuantitySerializer, RetrieveUserDetailsSerializer   
+    BasketSetQuantitySerializer, RetrieveUserDetailsSerializer, ImportJobSerializer, \
+    ImportRunSerializer, ImportReportSerializer, UploadSessionCreateSerializer, UploadSessionSerializer, \
+    PartnerPatchSerializer
 
+from .parsers import CSVParser
 from .schemas import PartnerUpdateSchema, OrderCreateSchema, UserRegisterSchema
 from .signals import new_user_registered, new_order
 
+# Число последних загрузок прайсов, показываемых поставщику
+IMPORT_RUNS_LIMIT = 50
+
 shared_user_properties = {
 
     'serializer_class': ListUserSerializer,
@@ -62,6 +82,14 @@ shared_user_properties = {
         'confirm': ConfirmUserSerializer,
         'details':RetrieveUserDetailsSerializer,
         'update_info': PartnerUpdateSerializer,
+        'patch_info': PartnerPatchSerializer,
+        'job': ImportJobSerializer,
+        'imports': ImportRunSerializer,
+        'reports': ImportReportSerializer,
+        'uploads': UploadSessionCreateSerializer,
+        'upload': UploadSessionSerializer,
+        'upload_chunk': UploadSessionSerializer,
+        'upload_finalize': UploadSessionSerializer,
         'state': ShopSerializer,
         'orders': OrderSerializer,
     },
@@ -256,6 +284,15 @@ class PartnerViewSet(BaseUserViewSet):
         'retrieve': (IsAuthenticated, ),
         'details': (IsAuthenticated, IsShop, ),
         'update_info': (IsAuthenticated, IsShop, ),
+        'patch_info': (IsAuthenticated, IsShop, ),
+        'job': (IsAuthenticated, IsShop, ),
+        'imports': (IsAuthenticated, IsShop, ),
+        'reports': (IsAuthenticated, IsShop, ),
+        'report': (IsAuthenticated, IsShop, ),
+        'uploads': (IsAuthenticated, IsShop, ),
+        'upload': (IsAuthenticated, IsShop, ),
+        'upload_chunk': (IsAuthenticated, IsShop, ),
+        'upload_finalize': (IsAuthenticated, IsShop, ),
         'state': (IsAuthenticated, IsShop, ),
         'orders': (IsAuthenticated, IsShop, ),
     }
@@ -269,14 +306,176 @@ class PartnerViewSet(BaseUserViewSet):
     # @method_decorator(cache_page(60*60*2))
     def update_info(self, request, *args, **kwargs):
         """
-        Обновление прайса от поставщика из указанного url или загруженного файла
+        Обновление прайса от поставщика из указанного url или загруженного файла.
+        При background=true прайс загружается в фоне: возвращается ИД задания импорта
         """
 
         serializer = self.get_serializer_class()(data=request.data)
         serializer.is_valid(raise_exception=True)
         data = serializer.validated_data
 
-        return load_partner_info(data.get('url'), data.get('file'), request.user.id)
+        if data.get('background'):
+            job = ImportJob.objects.create(user=request.user, mode=data.get('mode') or '',
+                                           file=data.get('file'), url=None if data.get('file') else data.get('url'))
+            job.task_id = run_import_job.delay(job.id).id
+            job.save(update_fields=('task_id', ))
+            return ResponseAccepted(Job=job.id, Url=reverse('api:partner-job', kwargs={'job_id': job.id}, request=request))
+
+        return load_partner_info(data.get('url'), data.get('file'), request.user.id, data.get('mode'))
+
+    @action(detail=False, methods=('post', 'patch', ), name='Patch stock and prices',
+            url_name='patch', url_path='patch', parser_classes=(JSONParser, CSVParser, ),
+            )
+    @method_decorator(never_cache)
+    def patch_info(self, request, *args, **kwargs):
+        """
+        Обновление остатков и цен без загрузки всего прайса: список изменений
+        {external_id, quantity?, price?, price_rrc?} в json (список или {shop, goods})
+        или в csv с заголовком external_id,quantity,price,price_rrc (пустая ячейка - без изменений).
+        Магазин задается параметром shop, если у поставщика их несколько
+        """
+        data = {'goods': request.data} if is_list(request.data) and not is_dict(request.data) else request.data
+        if 'shop' in request.query_params:
+            data = dict(data, shop=request.query_params['shop'])
+        serializer = self.get_serializer_class()(data=data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        shops = Shop.objects.filter(user_id=request.user.id)
+        if 'shop' in data:
+            shops = shops.filter(id=data['shop'])
+        shops = list(shops[:2])
+        if not shops:
+            return ResponseNotFound('Магазин не найден')
+        if len(shops) > 1:
+            return ResponseBadRequest('У поставщика несколько магазинов: укажите магазин в параметре shop')
+
+        updated, missing = apply_patch(shops[0], data['goods'])
+        return ResponseOK(Updated=updated, NotFound=missing)
+
+    @action(detail=False, methods=('get',), name='Import job status',
+            url_name='job', url_path=r'jobs/(?P<job_id>[0-9]+)',
+            )
+    @method_decorator(never_cache)
+    def job(self, request, job_id=None, *args, **kwargs):
+        """
+        Состояние задания фоновой загрузки прайса
+        """
+        job = ImportJob.objects.filter(id=job_id, user_id=request.user.id).first()
+        if job is None:
+            return ResponseNotFound('Задание импорта не найдено')
+        serializer = self.get_serializer_class()(job, context={'request': request})
+        return ResponseOK(data=serializer.data)
+
+    @action(detail=False, methods=('get',), name='Price import profiles',
+            url_name='imports', url_path='imports',
+            )
+    @method_decorator(never_cache)
+    def imports(self, request, *args, **kwargs):
+        """
+        Показатели последних загрузок прайсов поставщика по этапам
+        (время, скорость, число запросов к базе, пик памяти)
+        """
+        runs = ImportRun.objects.filter(
+            Q(user_id=request.user.id) | Q(shop__user_id=request.user.id)).select_related(
+            'shop').prefetch_related('phases')[:IMPORT_RUNS_LIMIT]
+        serializer = self.get_serializer_class()(runs, many=True, context={'request': request})
+        return ResponseOK(data=serializer.data)
+
+    @action(detail=False, methods=('get',), name='Partial import reports',
+            url_name='reports', url_path='reports',
+            )
+    @method_decorator(never_cache)
+    def reports(self, request, *args, **kwargs):
+        """
+        Отчеты о товарах, пропущенных при частичной загрузке прайсов магазинов поставщика
+        """
+        reports = ImportReport.objects.filter(shop__user_id=request.user.id).select_related('shop')
+        serializer = self.get_serializer_class()(reports, many=True, context={'request': request})
+        return ResponseOK(data=serializer.data)
+
+    @action(detail=False, methods=('get',), name='Download partial import report',
+            url_name='report', url_path=r'reports/(?P<report_id>[0-9]+)',
+            )
+    @method_decorator(never_cache)
+    def report(self, request, report_id=None, *args, **kwargs):
+        """
+        Скачивание отчета о пропущенных товарах (csv: строка, название, ошибка)
+        """
+        report = ImportReport.objects.filter(id=report_id, shop__user_id=request.user.id).first()
+        if report is None:
+            return ResponseNotFound('Отчет не найден')
+        return FileResponse(report.file.open('rb'), as_attachment=True, content_type='text/csv',
+                            filename=os.path.basename(report.file.name))
+
+    @action(detail=False, methods=('get', 'post', ), name='Chunked price uploads',
+            url_name='uploads', url_path='uploads',
+            )
+    @method_decorator(never_cache)
+    def uploads(self, request, *args, **kwargs):
+        """
+        Загрузка большого прайса по частям: создание загрузки (POST) и список незавершенных загрузок (GET).
+        Части передаются запросами PUT uploads/<ИД>/chunks/<номер> с заголовком X-Checksum-Sha256,
+        загрузка завершается запросом POST uploads/<ИД>/finalize
+        """
+        if request.method == 'GET':
+            sessions = UploadSession.objects.filter(user_id=request.user.id, state='open')
+            serializer = UploadSessionSerializer(sessions, many=True, context={'request': request})
+            return ResponseOK(data=serializer.data)
+
+        serializer = self.get_serializer_class()(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        session = create_session(request.user, **serializer.validated_data)
+        return ResponseCreated(Upload=session.id, ChunkSize=session.chunk_size, Chunks=session.chunks,
+                               Url=reverse('api:partner-upload', kwargs={'upload_id': session.id}, request=request))
+
+    @action(detail=False, methods=('get', 'delete', ), name='Chunked price upload',
+            url_name='upload', url_path=r'uploads/(?P<upload_id>[0-9]+)',
+            )
+    @method_decorator(never_cache)
+    def upload(self, request, upload_id=None, *args, **kwargs):
+        """
+        Состояние загрузки по частям (номера недостающих частей) или ее отмена (DELETE)
+        """
+        session = UploadSession.objects.filter(id=upload_id, user_id=request.user.id).first()
+        if session is None:
+            return ResponseNotFound('Загрузка не найдена')
+        if request.method == 'DELETE':
+            delete_session(session)
+            return ResponseOK()
+        serializer = self.get_serializer_class()(session, context={'request': request})
+        return ResponseOK(data=serializer.data)
+
+    @action(detail=False, methods=('put', ), name='Upload price chunk',
+            url_name='upload-chunk', url_path=r'uploads/(?P<upload_id>[0-9]+)/chunks/(?P<number>[0-9]+)',
+            )
+    def upload_chunk(self, request, upload_id=None, number=None, *args, **kwargs):
+        """
+        Передача части файла: тело запроса - содержимое части,
+        заголовок X-Checksum-Sha256 - ее sha256 (hex). Часть можно передавать повторно
+        """
+        session = UploadSession.objects.filter(id=upload_id, user_id=request.user.id).first()
+        if session is None:
+            return ResponseNotFound('Загрузка не найдена')
+        return write_chunk(session, int(number), request.stream or io.BytesIO(),
+                           request.META.get('HTTP_X_CHECKSUM_SHA256'))
+
+    @action(detail=False, methods=('post', ), name='Finalize chunked price upload',
+            url_name='upload-finalize', url_path=r'uploads/(?P<upload_id>[0-9]+)/finalize',
+            )
+    def upload_finalize(self, request, upload_id=None, *args, **kwargs):
+        """
+        Завершение загрузки по частям: собранный файл загружается в фоне,
+        возвращается ИД задания импорта
+        """
+        session = UploadSession.objects.filter(id=upload_id, user_id=request.user.id).first()
+        if session is None:
+            return ResponseNotFound('Загрузка не найдена')
+        error = finalize_session(session)
+        if error is not None:
+            return error
+        return ResponseAccepted(Job=session.job_id,
+                                Url=reverse('api:partner-job', kwargs={'job_id': session.job_id}, request=request))
 
 
     @action(detail=False, methods=('get', 'put'), name='Shop status control',
@@ -285,7 +484,8 @@ class PartnerViewSet(BaseUserViewSet):
     @method_decorator(never_cache)
     def state(self, request, *args, **kwargs):
         """
-        Активация / деактивация магазина
+        Активация / деактивация магазина и политика загрузки товаров с ошибками
+        (error_policy: reject - отклонять прайс, skip - пропускать такие товары)
         """
 
         if request.method == 'GET':
@@ -296,12 +496,16 @@ class PartnerViewSet(BaseUserViewSet):
 
         else:
 
-            serializer = self.get_serializer_class()(data=request.data)
+            serializer = self.get_serializer_class()(data=request.data, partial=True)
             serializer.is_valid(raise_exception=True)
-            state = serializer.validated_data['state']
+            fields = serializer.validated_data
+            if not fields:
+                return ResponseBadRequest('Не указаны все необходимые аргументы')
 
-            Shop.objects.filter(user_id=request.user.id).update(state=state)
-            return ResponseOK(state=state)
+            with transaction.atomic():
+                Shop.objects.filter(user_id=request.user.id).update(**fields)
+                refresh_shops(Shop.objects.filter(user_id=request.user.id).values_list('id', flat=True))
+            return ResponseOK(**fields)
 
     @action(detail=False, methods=('get', ), name='View orders',
             url_name='orders', url_path='orders',
@@ -435,8 +639,11 @@ class ProductParametersViewSet(viewsets.ReadOnlyModelViewSet):
     Параметры товаров
     """
 
-    queryset = ProductParameter.objects.select_related('parameter').all()
+    queryset = ProductParameter.objects.select_related('parameter').filter(
+        product_info__generation=F('product_info__shop__active_generation'))
     serializer_class = ProductParameterSerializer
+    # Число записей меняется только загрузками прайсов:
+    cache_counts = True
 
     filterset_fields = ('parameter__name', 'value' )
     ordering_fields = ('parameter__name', 'id', 'value', )
@@ -449,17 +656,29 @@ class ProductInfoViewSet(viewsets.ReadOnlyModelViewSet):
     Поиск товаров
     """
 
-    serializer_class = ProductInfoSerializer
+    serializer_class = CatalogItemSerializer
+    # Число записей меняется только вместе с каталогом:
+    cache_counts = True
 
+    # Поиск - по полнотекстовому индексу каталога (search_fields - без индекса):
+    filter_backends = (DjangoFilterBackend, CatalogSearchFilter, AliasOrderingFilter, )
     filterset_fields = ('shop', )
     ordering_fields = ('product', 'shop', 'quantity', 'price', 'price_rrc', 'id', )
-    search_fields = ('product__name', 'shop__name', )
+    search_fields = ('product_name', 'shop_name', )
     ordering = ('product', )
-    
+    # Найденные позиции по умолчанию - от более подходящих:
+    search_ordering = ('search_rank', 'id', )
+    # Сортировка по продукту и магазину - по их названиям (как Meta.ordering моделей),
+    # но без соединения таблиц:
+    ordering_aliases = {
+        'product': '-product_name',
+        'shop': '-shop_name',
+        'id': 'product_info',
+    }
 
     def get_queryset(self):
 
-        query = Q(shop__state=True)
+        query = VISIBLE_CATALOG
         shop_id = self.request.query_params.get('shop_id')
         category_id = self.request.query_params.get('category_id')
 
@@ -467,13 +686,27 @@ class ProductInfoViewSet(viewsets.ReadOnlyModelViewSet):
             query = query & Q(shop_id=shop_id)
 
         if category_id:
-            query = query & Q(product__category_id=category_id)
+            query = query & Q(category_id=category_id)
+
+        # Каталог (core.catalog) содержит позиции с магазином, продуктом и параметрами
+        # в одной строке: страница читается одним запросом
+        return CatalogItem.objects.filter(query)
 
-        # фильтруем и отбрасываем дубликаты
-        return ProductInfo.objects.filter(
-            query).select_related(
-            'shop', 'product__category').prefetch_related(
-            'product_parameters__parameter').distinct()
+    @action(detail=False, methods=('get',), name='Search suggestions',
+            url_name='suggest', url_path='suggest', serializer_class=SuggestionSerializer,
+            filter_backends=(), pagination_class=None,
+            )
+    @method_decorator(never_cache)
+    def suggest(self, request, *args, **kwargs):
+        """
+        Подсказки при вводе запроса поиска ?q=: продукты и категории, слово названия
+        которых начинается с q, - от больших остатков к меньшим. Индекс подсказок
+        хранится в памяти (core.suggest) и обновляется после изменения каталога
+        """
+        found = suggest_index.suggest(request.query_params.get('q', ''))
+        serializer = self.get_serializer([dict(type=kind, id=record_id, name=name)
+                                          for kind, record_id, name in found], many=True)
+        return Response(serializer.data)
 
 
 class OrderViewSet(ViewSetViewSerializersMixin, ViewSetViewDescriptionsMixin, viewsets.ReadOnlyModelViewSet):
@@ -701,4 +934,9 @@ def test_url(request, ext):
         return HttpResponseNotFound('Not found')
     with open(os.path.join(settings.MEDIA_ROOT, f'tests/shop1.{ext}'), 'rb') as fp:
         content = fp.read()
-    return HttpResponse(content, content_type=f'application/{ext}')
+    etag = quote_etag(hashlib.md5(content).hexdigest())
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(content, content_type=f'application/{ext}')
+    response['ETag'] = etag
+    return response
@@ -5,7 +5,9 @@ from django.utils.translation import gettext_lazy as _
 
 from nested_inline.admin import NestedStackedInline, NestedTabularInline, NestedModelAdmin
  
-from .models import Shop, Category, Product, ProductInfo, Order, OrderItem, Parameter, ProductParameter
+from .catalog import refresh_categories, refresh_items, refresh_shops, touch_suggest
+from .models import Shop, Category, Product, ProductInfo, Order, OrderItem, Parameter, ProductParameter, ImportJob, \
+    ImportRun, ImportRunPhase, ImportReport, UploadSession, DropFile
 from .tasks import do_import
 
 
@@ -15,19 +17,77 @@ admin.site.site_header = 'Администрирование магазина'
 @admin.register(Shop)
 class ShopAdmin(admin.ModelAdmin):
     change_list_template = 'admin/do_import.html'
+    readonly_fields = ('feed_etag', 'feed_last_modified', 'feed_digest', 'feed_failures', 'feed_retry_after',
+                       'active_generation', 'last_generation', )
 
     def get_urls(self):
         return [ path('do_import/', self.do_import) ] + super().get_urls()
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        refresh_shops([obj.id])
+
     def do_import(self, request):
-        do_import.delay()
-        self.message_user(request, 'Обновление прайс листов началось')
+        job = ImportJob.objects.create(kind='shops', user=request.user)
+        job.task_id = do_import.delay(job.id).id
+        job.save(update_fields=('task_id', ))
+        self.message_user(request, f'Обновление прайс листов началось (задание {job.id})')
         return HttpResponseRedirect('../')
 
 
+@admin.register(ImportJob)
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'user', 'state', 'processed', 'total', 'created_at', 'finished_at', )
+    list_filter = ('kind', 'state', )
+    readonly_fields = ('task_id', 'processed', 'total', 'result', 'created_at', 'finished_at', )
+
+
+class ImportRunPhaseInline(admin.TabularInline):
+    model = ImportRunPhase
+    extra = 0
+    fields = ('name', 'duration', 'rows', 'rows_per_second', 'queries', 'memory_peak', )
+    readonly_fields = fields
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(ImportRun)
+class ImportRunAdmin(admin.ModelAdmin):
+    list_display = ('id', 'shop', 'source', 'status_code', 'rows', 'duration', 'queries', 'started_at', )
+    list_filter = ('shop', 'status_code', )
+    readonly_fields = ('shop', 'user', 'job', 'source', 'status_code', 'rows', 'duration', 'queries', 'started_at', )
+    inlines = (ImportRunPhaseInline, )
+
+
+@admin.register(ImportReport)
+class ImportReportAdmin(admin.ModelAdmin):
+    list_display = ('id', 'shop', 'skipped', 'created_at', )
+    list_filter = ('shop', )
+    readonly_fields = ('shop', 'skipped', 'file', 'created_at', )
+
+
+@admin.register(UploadSession)
+class UploadSessionAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'name', 'size', 'chunk_size', 'state', 'job', 'created_at', 'updated_at', )
+    list_filter = ('state', )
+    readonly_fields = ('name', 'size', 'chunk_size', 'checksum', 'job', 'created_at', 'updated_at', )
+
+
+@admin.register(DropFile)
+class DropFileAdmin(admin.ModelAdmin):
+    list_display = ('id', 'shop', 'name', 'size', 'status_code', 'imported_at', )
+    list_filter = ('shop', )
+    readonly_fields = ('shop', 'name', 'size', 'mtime_ns', 'digest', 'status_code', 'result', 'imported_at', )
+
+
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
-    pass
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        refresh_categories([obj.id])
 
 
 @admin.register(Parameter)
@@ -53,6 +113,12 @@ class ProductInfoInline(NestedStackedInline):
 class ProductAdmin(NestedModelAdmin):
     inlines = (ProductInfoInline, )
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # Позиции прайса и их параметры правятся во вложенных формах:
+        refresh_items(form.instance.product_infos.values_list('id', flat=True))
+        touch_suggest()
+
 
 class OrderItemInline(admin.TabularInline):
     model = OrderItem
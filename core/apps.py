@@ -1,5 +1,16 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def create_search_index(sender, using='default', **kwargs):
+    from .catalog_search import install_search_index
+    install_search_index(using)
 
 
 class CoreConfig(AppConfig):
     name = 'core'
+
+    def ready(self):
+        # Индекс полнотекстового поиска по каталогу не описывается моделями,
+        # он создается после применения миграций:
+        post_migrate.connect(create_search_index, sender=self)
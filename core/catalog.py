@@ -0,0 +1,151 @@
+from django.core.cache import caches
+from django.db import transaction
+import json
+from uuid import uuid4
+
+from .models import CatalogItem, ProductInfo, ProductParameter, Shop, Category
+from .utils import chunked
+
+
+# Каталог для покупателей (CatalogItem) - денормализованная копия позиций прайсов:
+# магазин, продукт, категория, цены, количество и параметры в одной строке,
+# /products читает его одним запросом без соединений и DISTINCT.
+# Каталог обновляется вместе с источниками:
+#  - загрузка прайса пересобирает записанные позиции (refresh_items) и при
+#    переключении поколения показывает новое поколение (activate_generation);
+#  - быстрое обновление остатков и цен пересобирает измененные позиции;
+#  - смена названия или состояния магазина и названия категории копируются
+#    в позиции (refresh_shops, refresh_categories);
+#  - удаленные позиции прайса удаляются из каталога каскадно.
+# Для уже загруженных данных каталог собирается командой rebuild_catalog.
+# Каждое изменение каталога меняет его версию (catalog_version, см. touch_catalog):
+# по версии сбрасываются закэшированные счетчики страниц (core.pagination).
+# Версия хранится в кэше CATALOG_CACHE, общем для процессов web и celery: изменение
+# каталога при загрузке прайса в задаче видно всем процессам сайта.
+# Подсказки поиска (core.suggest) пересобираются по отдельной версии, которая меняется
+# реже - один раз на загрузку прайса или другую правку каталога (см. touch_suggest).
+
+# Число позиций прайса в одном запросе (у sqlite есть лимит на число параметров в запросе)
+CATALOG_CHUNK_SIZE = 500
+
+CATALOG_CACHE = 'catalog'
+CATALOG_VERSION_KEY = 'catalog:version'
+SUGGEST_VERSION_KEY = 'catalog:suggest_version'
+
+INFO_FIELDS = ('id', 'shop_id', 'shop__name', 'shop__state', 'shop__active_generation', 'generation',
+               'product_id', 'product__name', 'product__category_id', 'product__category__name',
+               'quantity', 'price', 'price_rrc', )
+
+
+def catalog_version(key=CATALOG_VERSION_KEY):
+    """
+    Текущая версия каталога (строка, меняется при каждом изменении каталога).
+    key=SUGGEST_VERSION_KEY - версия каталога для подсказок поиска
+    """
+    cache = caches[CATALOG_CACHE]
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid4().hex, None)
+        version = cache.get(key, '')
+    return version
+
+
+def touch_catalog(key=CATALOG_VERSION_KEY):
+    """
+    Смена версии каталога - сразу и еще раз после фиксации текущей транзакции
+    (счетчики, посчитанные до фиксации по старым данным, сбрасываются)
+    """
+    caches[CATALOG_CACHE].set(key, uuid4().hex, None)
+    transaction.on_commit(lambda: caches[CATALOG_CACHE].set(key, uuid4().hex, None))
+
+
+def touch_suggest():
+    """
+    Смена версии каталога для подсказок поиска. Вызывается один раз в конце загрузки
+    прайса или другой правки каталога, а не на каждую пачку позиций: каждая смена
+    версии - пересборка индекса подсказок во всех процессах
+    """
+    touch_catalog(SUGGEST_VERSION_KEY)
+
+
+def build_items(info_ids):
+    """
+    Позиции каталога для позиций прайса info_ids (тремя запросами без учета лимита)
+    """
+    parameters = {}
+    for info_id, name, value in ProductParameter.objects.filter(product_info_id__in=info_ids).order_by(
+            'id').values_list('product_info_id', 'parameter__name', 'value'):
+        parameters.setdefault(info_id, {})[name] = value
+    return [
+        CatalogItem(product_info_id=info_id, shop_id=shop_id, shop_name=shop_name, shop_state=shop_state,
+                    product_id=product_id, product_name=product_name,
+                    category_id=category_id, category_name=category_name,
+                    quantity=quantity, price=price, price_rrc=price_rrc,
+                    parameters=json.dumps(parameters.get(info_id, {}), ensure_ascii=False),
+                    generation=generation, visible=generation == active_generation)
+        for (info_id, shop_id, shop_name, shop_state, active_generation, generation, product_id, product_name,
+             category_id, category_name, quantity, price, price_rrc)
+        in ProductInfo.objects.filter(id__in=info_ids).values_list(*INFO_FIELDS)
+    ]
+
+
+def refresh_items(info_ids, chunk_size=CATALOG_CHUNK_SIZE):
+    """
+    Пересборка позиций каталога для позиций прайса info_ids
+    (версия каталога меняется, только если позиции есть)
+    """
+    info_ids = list(info_ids)
+    if not info_ids:
+        return
+    for chunk in chunked(info_ids, chunk_size):
+        with transaction.atomic():
+            CatalogItem.objects.filter(product_info_id__in=chunk).delete()
+            CatalogItem.objects.bulk_create(build_items(chunk))
+    touch_catalog()
+
+
+def activate_generation(shop_id, generation):
+    """
+    Показ покупателям позиций поколения generation прайса магазина вместо остальных
+    (вызывается в транзакции переключения поколения магазина)
+    """
+    CatalogItem.objects.filter(shop_id=shop_id, visible=True).exclude(generation=generation).update(visible=False)
+    CatalogItem.objects.filter(shop_id=shop_id, generation=generation).update(visible=True)
+    touch_catalog()
+
+
+def refresh_shops(shop_ids):
+    """
+    Копирование названия и состояния магазинов shop_ids в их позиции каталога
+    """
+    for shop_id, name, state in Shop.objects.filter(id__in=list(shop_ids)).values_list('id', 'name', 'state'):
+        CatalogItem.objects.filter(shop_id=shop_id).update(shop_name=name, shop_state=state)
+    touch_catalog()
+    touch_suggest()
+
+
+def refresh_categories(category_ids):
+    """
+    Копирование названий категорий category_ids в позиции каталога
+    """
+    for category_id, name in Category.objects.filter(id__in=list(category_ids)).values_list('id', 'name'):
+        CatalogItem.objects.filter(category_id=category_id).update(category_name=name)
+    touch_catalog()
+    touch_suggest()
+
+
+def rebuild_catalog(chunk_size=CATALOG_CHUNK_SIZE):
+    """
+    Сборка каталога заново по всем позициям прайсов. Возвращает число позиций каталога
+    """
+    CatalogItem.objects.all().delete()
+    touch_catalog()
+    infos = ProductInfo.objects.order_by('id')
+    last_id = 0
+    while True:
+        info_ids = list(infos.filter(id__gt=last_id).values_list('id', flat=True)[:chunk_size])
+        if not info_ids:
+            touch_suggest()
+            return CatalogItem.objects.count()
+        last_id = info_ids[-1]
+        refresh_items(info_ids, chunk_size)
@@ -0,0 +1,105 @@
+from django.db import connections, transaction, OperationalError
+from django.db.models import FloatField
+from django.db.models.expressions import RawSQL
+
+from .models import CatalogItem
+
+
+# Полнотекстовый поиск по каталогу (sqlite FTS5).
+# Таблица SEARCH_TABLE индексирует название продукта, категорию, магазин и значения
+# параметров позиций каталога (rowid - первичный ключ CatalogItem). Индекс обновляется
+# триггерами на таблице каталога, поэтому любое изменение каталога (загрузки прайсов,
+# смена названий, каскадные удаления) сразу попадает в поиск.
+# Запрос поиска соединяет каталог с результатом MATCH по rowid: время поиска зависит
+# от числа найденных позиций, а не от размера каталога. Позиции ранжируются bm25
+# с весами столбцов SEARCH_WEIGHTS.
+# Таблица и триггеры создаются после migrate (см. CoreConfig.ready); если база не sqlite
+# или sqlite собран без FTS5, поиск выполняется через SearchFilter (icontains).
+
+SEARCH_TABLE = 'core_catalog_search'
+
+# Веса столбцов: название продукта, категория, магазин, значения параметров
+SEARCH_WEIGHTS = (10.0, 2.0, 3.0, 1.0)
+
+PARAMETER_VALUES = "(SELECT group_concat(value, ' ') FROM json_each(NULLIF({row}.parameters, '')))"
+
+# Токенизатор unicode61 не отождествляет ё и е, поэтому ё заменяется в индексе и в запросе:
+YO = "replace(replace({}, 'ё', 'е'), 'Ё', 'Е')"
+
+SEARCH_COLUMNS = ', '.join(YO.format(column) for column in (
+    '{row}.product_name', '{row}.category_name', '{row}.shop_name', PARAMETER_VALUES))
+
+
+def search_ddl(catalog_table, pk):
+    insert = f'INSERT INTO {SEARCH_TABLE}(rowid, product_name, category_name, shop_name, parameters) ' \
+             f'VALUES (new.{pk}, {SEARCH_COLUMNS.format(row="new")});'
+    delete = f'DELETE FROM {SEARCH_TABLE} WHERE rowid = old.{pk};'
+    return [
+        f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5("
+        f"product_name, category_name, shop_name, parameters, tokenize='unicode61 remove_diacritics 2')",
+        f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rank) VALUES "
+        f"('rank', 'bm25({', '.join(str(weight) for weight in SEARCH_WEIGHTS)})')",
+        f'CREATE TRIGGER {SEARCH_TABLE}_insert AFTER INSERT ON {catalog_table} BEGIN {insert} END',
+        f'CREATE TRIGGER {SEARCH_TABLE}_delete AFTER DELETE ON {catalog_table} BEGIN {delete} END',
+        f'CREATE TRIGGER {SEARCH_TABLE}_update AFTER UPDATE OF product_name, category_name, shop_name, parameters '
+        f'ON {catalog_table} BEGIN {delete} {insert} END',
+        f'INSERT INTO {SEARCH_TABLE}(rowid, product_name, category_name, shop_name, parameters) '
+        f'SELECT {pk}, {SEARCH_COLUMNS.format(row=catalog_table)} FROM {catalog_table}',
+    ]
+
+
+# Наличие индекса в базах (по псевдониму базы)
+available = {}
+
+
+def search_available(using='default'):
+    """
+    Есть ли в базе using индекс полнотекстового поиска
+    """
+    if using not in available:
+        connection = connections[using]
+        available[using] = connection.vendor == 'sqlite' and \
+            SEARCH_TABLE in connection.introspection.table_names(include_views=True)
+    return available[using]
+
+
+def install_search_index(using='default'):
+    """
+    Создание индекса поиска с триггерами и заполнение его по каталогу
+    (если индекса еще нет). Возвращает True, если индекс есть
+    """
+    connection = connections[using]
+    available.pop(using, None)
+    if connection.vendor != 'sqlite' or search_available(using):
+        return search_available(using)
+    if CatalogItem._meta.db_table not in connection.introspection.table_names():
+        return False
+    try:
+        with transaction.atomic(using), connection.cursor() as cursor:
+            for statement in search_ddl(CatalogItem._meta.db_table, CatalogItem._meta.pk.column):
+                cursor.execute(statement)
+    except OperationalError:
+        # sqlite собран без FTS5 или JSON1
+        return False
+    available.pop(using, None)
+    return search_available(using)
+
+
+def match_query(terms):
+    """
+    Запрос FTS5 по словам поиска: все слова, каждое - как начало слова
+    """
+    return ' '.join('"{}"*'.format(term.replace('"', '""').replace('ё', 'е').replace('Ё', 'Е')) for term in terms)
+
+
+def search_catalog(queryset, terms):
+    """
+    Позиции каталога queryset, найденные по словам terms, с рангом search_rank
+    (меньше - лучше)
+    """
+    catalog_table = queryset.model._meta.db_table
+    return queryset.extra(
+        tables=[SEARCH_TABLE],
+        where=[f'{SEARCH_TABLE} MATCH %s', f'{SEARCH_TABLE}.rowid = {catalog_table}.{queryset.model._meta.pk.column}'],
+        params=[match_query(terms)],
+    ).annotate(search_rank=RawSQL(f'{SEARCH_TABLE}.rank', (), output_field=FloatField()))
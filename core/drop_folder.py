@@ -0,0 +1,106 @@
+from django.conf import settings
+from django.utils import timezone
+import json
+import logging
+import os
+import time
+
+from .models import DropFile, Shop
+from .partner_info_loader import file_digest, load_local_file
+
+
+# Загрузка прайсов из каталога на диске (например, общего тома, куда поставщики
+# выкладывают файлы). Каталог PRICE_IMPORT['DROP_DIR'] (относительно PRIVATE_ROOT)
+# содержит подкаталоги магазинов с именами по ИД магазина:
+#   drop/<ИД магазина>/<файл прайса>
+# Прайс загружается от имени владельца магазина. Файл загружается, если с прошлого
+# обхода изменились его размер или время изменения и хэш содержимого, и не изменялся
+# последние PRICE_IMPORT['DROP_SETTLE_TIME'] секунд (файл может еще дописываться).
+# Скрытые файлы (.имя) пропускаются: в них удобно дописывать файл перед переименованием.
+# Файлы читаются и хэшируются через mmap (см. partner_info_loader.mapped_stream).
+
+logger = logging.getLogger(__name__)
+
+
+def drop_root():
+    return os.path.join(settings.PRIVATE_ROOT, settings.PRICE_IMPORT['DROP_DIR'])
+
+
+def iter_dropped_files(root):
+    """
+    Файлы в подкаталогах магазинов: (ИД магазина, имя файла, путь, os.stat_result)
+    """
+    if not os.path.isdir(root):
+        return
+    with os.scandir(root) as shop_dirs:
+        for shop_dir in sorted(shop_dirs, key=lambda entry: entry.name):
+            if not shop_dir.is_dir() or not shop_dir.name.isdigit():
+                continue
+            with os.scandir(shop_dir.path) as files:
+                for entry in sorted(files, key=lambda entry: entry.name):
+                    if entry.is_file() and not entry.name.startswith('.'):
+                        yield int(shop_dir.name), entry.name, entry.path, entry.stat()
+
+
+def claim(dropped, stat):
+    """
+    Отметка файла как обрабатываемого: новые размер и время изменения записываются,
+    только если запись не изменена другим обходом каталога (иначе возвращается False)
+    """
+    return DropFile.objects.filter(id=dropped.id, size=dropped.size, mtime_ns=dropped.mtime_ns) \
+        .update(size=stat.st_size, mtime_ns=stat.st_mtime_ns) == 1
+
+
+def import_dropped_file(dropped, path, stat, mode=None):
+    """
+    Загрузка изменившегося файла каталога. Возвращает сводку загрузки
+    или None, если содержимое файла не изменилось или файл обрабатывается другим обходом
+    """
+    if not claim(dropped, stat):
+        return None
+    try:
+        with open(path, 'rb') as stream:
+            digest = file_digest(stream)
+        if digest == dropped.digest:
+            return None
+        response = load_local_file(path, dropped.shop.user_id, mode, digest)
+    except Exception as e:
+        # Файл будет обработан повторно при следующем обходе:
+        DropFile.objects.filter(id=dropped.id).update(size=None, mtime_ns=None)
+        logger.exception(f'Error importing dropped price list: shop_id={dropped.shop_id}, name={dropped.name}')
+        return dict(shop_id=dropped.shop_id, name=dropped.name, status=None, errors=str(e))
+
+    dropped.size, dropped.mtime_ns, dropped.digest = stat.st_size, stat.st_mtime_ns, digest
+    dropped.status_code = response.status_code
+    dropped.result = json.dumps(response.data, ensure_ascii=False, default=str)
+    dropped.imported_at = timezone.now()
+    dropped.save(update_fields=('digest', 'status_code', 'result', 'imported_at', ))
+    errors = response.data.get('Errors')
+    return dict(shop_id=dropped.shop_id, name=dropped.name, status=response.status_code,
+                errors=str(errors) if errors else None)
+
+
+def scan_drop_folder(mode=None, root=None):
+    """
+    Обход каталога прайсов и загрузка новых и изменившихся файлов.
+    Возвращает список сводок загрузок
+    """
+    now = time.time()
+    settle_time = settings.PRICE_IMPORT['DROP_SETTLE_TIME']
+    shops = {}
+    results = []
+    for shop_id, name, path, stat in iter_dropped_files(root or drop_root()):
+        if now - stat.st_mtime < settle_time:
+            continue
+        if shop_id not in shops:
+            shops[shop_id] = Shop.objects.filter(id=shop_id, user__isnull=False).first()
+        if shops[shop_id] is None:
+            logger.warning(f'Dropped price list of unknown shop: shop_id={shop_id}, name={name}')
+            continue
+        dropped, _ = DropFile.objects.get_or_create(shop=shops[shop_id], name=name)
+        if dropped.size == stat.st_size and dropped.mtime_ns == stat.st_mtime_ns:
+            continue
+        result = import_dropped_file(dropped, path, stat, mode)
+        if result:
+            results.append(result)
+    return results
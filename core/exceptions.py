@@ -28,3 +28,16 @@ def custom_exception_handler(exc, context):
 
     return response
 
+
+class FeedError(Exception):
+    """
+    Ошибка в прайсе поставщика.
+    error и format передаются в ResponseBadRequest при формировании ответа,
+    rows - список ошибок в товарах с номерами строк
+    """
+
+    def __init__(self, error, format=None, rows=None):
+        super(FeedError, self).__init__(error, format)
+        self.error = error
+        self.format = format
+        self.rows = rows
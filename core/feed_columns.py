@@ -0,0 +1,177 @@
+import numpy as np
+
+from .exceptions import FeedError
+from .feed_validator import PARAMETERS_ERROR, DUPLICATE_PARAMETER_ERROR
+from .utils import is_dict
+
+
+# Столбцовый формат прайса v2.0.
+# Товары задаются словарем столбцов одинаковой длины: id (необязательный),
+# category (номер категории в списке categories заголовка), name, price,
+# price_rrc, quantity. Параметры товаров - таблица со словарями названий
+# и значений параметров:
+#   parameters:
+#     names: [название, ...]       # словарь названий параметров
+#     values: [значение, ...]      # словарь значений параметров
+#     good: [номер товара, ...]    # строки таблицы: номер товара в столбцах,
+#     name: [номер названия, ...]  # номер названия в names
+#     value: [номер значения, ...] # и номер значения в values
+# Имена ключей в прайсе не повторяются для каждого товара, поэтому такой
+# прайс разбирается в несколько раз быстрее прайса v1.0.
+
+COLUMNS = ('id', 'category', 'name', 'price', 'price_rrc', 'quantity', )
+
+OPTIONAL_COLUMNS = ('id', )
+
+PARAMETER_COLUMNS = ('good', 'name', 'value', )
+
+
+def is_column(value):
+    return isinstance(value, (list, tuple))
+
+
+def to_index_array(values, title):
+    """
+    Перевод столбца номеров в массив int64
+    """
+    array = np.array(values)
+    if array.ndim != 1 or (len(array) and array.dtype.kind not in 'iu'):
+        raise FeedError('Некорректный формат файла: столбец {} таблицы параметров должен содержать целые числа', title)
+    return array.astype(np.int64)
+
+
+class GoodsColumns(object):
+    """
+    Товары прайса v2.0, заданные по столбцам.
+    Ошибки структуры (не заданы столбцы, столбцы разной длины) вызывают FeedError,
+    ошибки в значениях отдельных товаров проверяются пачками (GoodsValidator.column_batches)
+    """
+
+    def __init__(self, goods, categories=None):
+        if not is_dict(goods):
+            raise FeedError('Некорректный формат файла: товары прайса v2.0 должны быть заданы словарем столбцов')
+        self.columns = {}
+        self.size = None
+        for name in COLUMNS:
+            values = goods.get(name)
+            if values is None and name in OPTIONAL_COLUMNS:
+                continue
+            if not is_column(values):
+                raise FeedError('Некорректный формат файла: столбец товаров {} должен быть задан списком', name)
+            if self.size is None:
+                self.size = len(values)
+            elif len(values) != self.size:
+                raise FeedError('Некорректный формат файла: столбцы товаров разной длины')
+            self.columns[name] = values
+
+        # Номера категорий заменяются на их названия:
+        category_names = [category.get('name') if is_dict(category) else None
+                          for category in (categories if is_column(categories) else [])]
+        self.columns['category'] = [
+            category_names[index] if type(index) is int and 0 <= index < len(category_names) else None
+            for index in self.columns['category']
+        ]
+        self.read_parameters(goods.get('parameters'))
+
+    def __len__(self):
+        return self.size
+
+    def read_parameters(self, table):
+        """
+        Чтение таблицы параметров. Строки таблицы упорядочиваются по номеру товара
+        """
+        table = {} if table is None else table
+        if not is_dict(table):
+            raise FeedError('Некорректный формат файла: параметры прайса v2.0 должны быть заданы таблицей')
+        names = table.get('names') or []
+        values = table.get('values') or []
+        if not is_column(names) or not is_column(values):
+            raise FeedError('Некорректный формат файла: словари названий и значений параметров должны быть заданы списками')
+        columns = []
+        for title in PARAMETER_COLUMNS:
+            column = table.get(title) or []
+            if not is_column(column):
+                raise FeedError('Некорректный формат файла: столбец {} таблицы параметров должен быть задан списком', title)
+            columns.append(to_index_array(column, title))
+        good, name, value = columns
+        if not len(good) == len(name) == len(value):
+            raise FeedError('Некорректный формат файла: столбцы таблицы параметров разной длины')
+        if len(good) and (good.min() < 0 or good.max() >= self.size):
+            raise FeedError('Некорректный формат файла: номер товара в таблице параметров вне списка товаров')
+
+        # Названия-числа (например, из xml) приводятся к строкам, как при записи в базу:
+        self.parameter_names = [str(entry) if isinstance(entry, (int, float)) else entry for entry in names]
+        self.parameter_values = values
+        self.valid_names = np.array([isinstance(entry, str) and bool(entry) for entry in self.parameter_names],
+                                    dtype=bool)
+        self.valid_values = np.array([entry is not None for entry in values], dtype=bool)
+
+        order = np.argsort(good, kind='stable')
+        self.parameter_good = good[order]
+        self.parameter_name = name[order]
+        self.parameter_value = value[order]
+
+    def column(self, name, start, end):
+        """
+        Значения столбца для товаров с номерами от start до end
+        """
+        values = self.columns.get(name)
+        return values[start:end] if values is not None else [None] * (end - start)
+
+    def parameter_rows(self, start, end):
+        """
+        Строки таблицы параметров для товаров с номерами от start до end:
+        номера товаров относительно start, номера названий и значений
+        """
+        low, high = np.searchsorted(self.parameter_good, [start, end])
+        return (self.parameter_good[low:high] - start,
+                self.parameter_name[low:high],
+                self.parameter_value[low:high])
+
+    def check_parameters(self, messages, start, end):
+        """
+        Проверка параметров товаров пачки. Сообщения об ошибках записываются в messages
+        """
+        good, name, value = self.parameter_rows(start, end)
+        if not len(good):
+            return
+        invalid = (name < 0) | (name >= len(self.parameter_names)) | \
+                  (value < 0) | (value >= len(self.parameter_values))
+        valid = ~invalid
+        invalid[valid] = ~self.valid_names[name[valid]] | ~self.valid_values[value[valid]]
+
+        # Повторы названия параметра у одного товара:
+        keys = good * max(len(self.parameter_names), 1) + name
+        order = np.argsort(keys, kind='stable')
+        repeated = np.zeros(len(keys), dtype=bool)
+        repeated[order[1:]] = keys[order[1:]] == keys[order[:-1]]
+
+        for index in np.flatnonzero(invalid | repeated):
+            if messages[good[index]] is None:
+                messages[good[index]] = PARAMETERS_ERROR if invalid[index] else DUPLICATE_PARAMETER_ERROR
+
+    def items(self, start, end, quantity=None):
+        """
+        Словари товаров с номерами от start до end в виде прайса v1.0 (для записи в базу).
+        quantity - проверенные количества товаров
+        """
+        parameters = [[] for _ in range(end - start)]
+        names, values = self.parameter_names, self.parameter_values
+        # Одинаковые пары название-значение у разных товаров - общий (неизменяемый писателем) словарь:
+        entries = {}
+        good, name, value = self.parameter_rows(start, end)
+        for good, key in zip(good.tolist(), (name * len(values) + value).tolist()):
+            entry = entries.get(key)
+            if entry is None:
+                entry = entries[key] = {'name': names[key // len(values)], 'value': values[key % len(values)]}
+            parameters[good].append(entry)
+        return [dict(id=external_id, category=category, name=name, price=price, price_rrc=price_rrc,
+                     quantity=count, parameters=item_parameters)
+                for external_id, category, name, price, price_rrc, count, item_parameters in zip(
+                    self.column('id', start, end),
+                    self.column('category', start, end),
+                    self.column('name', start, end),
+                    self.column('price', start, end),
+                    self.column('price_rrc', start, end),
+                    quantity if quantity is not None else self.column('quantity', start, end),
+                    parameters)]
@@ -0,0 +1,77 @@
+import bz2
+import gzip
+import lzma
+import os
+import zstandard
+
+
+# Сжатые прайсы (gzip, bzip2, xz, zstd).
+# Сжатие определяется по сигнатуре в начале файла: заявленное сжатие
+# (Content-Encoding, расширение .gz/.bz2/.xz/.zst) может не совпадать с
+# содержимым - например, http клиент уже распаковал ответ с Content-Encoding: gzip,
+# а ответы с Content-Encoding: zstd, xz, bzip2 клиенты не распаковывают.
+# Расширение сжатия учитывается при определении формата прайса по имени файла.
+# Распаковка выполняется потоково, по мере чтения прайса парсером.
+
+COMPRESSION_MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bzip2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+)
+
+MAGIC_LENGTH = max(len(magic) for magic, _ in COMPRESSION_MAGIC)
+
+# Заголовок Accept-Encoding запросов прайса:
+ACCEPT_ENCODING = 'gzip, deflate, zstd, xz, bzip2'
+
+COMPRESSION_EXTENSIONS = {
+    '.gz': 'gzip',
+    '.gzip': 'gzip',
+    '.bz2': 'bzip2',
+    '.xz': 'xz',
+    '.zst': 'zstd',
+}
+
+DECOMPRESSORS = {
+    'gzip': lambda stream: gzip.GzipFile(fileobj=stream, mode='rb'),
+    'bzip2': lambda stream: bz2.BZ2File(stream, mode='rb'),
+    'xz': lambda stream: lzma.LZMAFile(stream, mode='rb'),
+    'zstd': lambda stream: zstandard.ZstdDecompressor().stream_reader(stream),
+}
+
+# Ошибки распаковки поврежденного файла:
+DECOMPRESSION_ERRORS = (OSError, EOFError, lzma.LZMAError, zstandard.ZstdError)
+
+
+def split_extension(name):
+    """
+    Расширение формата прайса и сжатие, заданное расширением файла:
+    'shop.json.gz' -> ('.json', 'gzip')
+    """
+    base, extension = os.path.splitext(name or '')
+    compression = COMPRESSION_EXTENSIONS.get(extension.lower())
+    if compression:
+        _, extension = os.path.splitext(base)
+    return extension, compression
+
+
+def sniff_compression(stream):
+    """
+    Сжатие по сигнатуре в начале потока (позиция в потоке не меняется)
+    """
+    position = stream.tell()
+    head = stream.read(MAGIC_LENGTH)
+    stream.seek(position)
+    for magic, compression in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def decompressed(stream):
+    """
+    Поток распакованного содержимого сжатого прайса или сам stream для несжатого
+    """
+    compression = sniff_compression(stream)
+    return DECOMPRESSORS[compression](stream) if compression else stream
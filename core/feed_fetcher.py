@@ -0,0 +1,131 @@
+import aiohttp
+import asyncio
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+import hashlib
+import os
+import tempfile
+from time import perf_counter
+
+from .feed_readers import READ_CHUNK_SIZE
+
+
+# Параллельное скачивание прайсов магазинов (этап fetch общего импорта).
+# Прайсы скачиваются асинхронно через общий пул keep-alive соединений
+# с ограничением числа соединений на сервер и таймаутами, содержимое
+# пишется во временные файлы с подсчетом sha256.
+
+
+def fetch_result(url, status=None, path=None, digest=None, headers=None, error=None, elapsed=None):
+    """
+    Результат скачивания прайса (словарь, пригодный для передачи в задачу celery).
+    elapsed - время скачивания, с
+    """
+    headers = headers or {}
+    return dict(url=url, status=status, path=path, digest=digest,
+                etag=headers.get('ETag', ''),
+                last_modified=headers.get('Last-Modified', ''),
+                content_type=headers.get('Content-Type', ''),
+                error=error, elapsed=elapsed)
+
+
+async def fetch_feed(session, url, headers=None, directory=None):
+    """
+    Скачивание одного прайса во временный файл.
+    Ошибки соединения, таймауты и ответы с ошибкой возвращаются в поле error
+    """
+    started = perf_counter()
+    try:
+        async with session.get(url, headers=headers or {}) as response:
+            if response.status == 304:
+                return fetch_result(url, response.status, headers=response.headers,
+                                    elapsed=perf_counter() - started)
+            if response.status >= 400:
+                return fetch_result(url, response.status, error=f'{response.status} {response.reason}',
+                                    elapsed=perf_counter() - started)
+            digest = hashlib.sha256()
+            fd, path = tempfile.mkstemp(prefix='feed-', dir=directory)
+            try:
+                with os.fdopen(fd, 'wb') as target:
+                    async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+                        digest.update(chunk)
+                        target.write(chunk)
+            except BaseException:
+                os.remove(path)
+                raise
+            return fetch_result(url, response.status, path, digest.hexdigest(), response.headers,
+                                elapsed=perf_counter() - started)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return fetch_result(url, error=str(e) or e.__class__.__name__, elapsed=perf_counter() - started)
+
+
+async def fetch_all(sources, directory=None):
+    options = settings.PRICE_IMPORT
+    timeout = aiohttp.ClientTimeout(total=options['FETCH_TIMEOUT'],
+                                    sock_connect=options['FETCH_CONNECT_TIMEOUT'],
+                                    sock_read=options['FETCH_READ_TIMEOUT'])
+    connector = aiohttp.TCPConnector(limit=options['FETCH_CONNECTIONS'],
+                                     limit_per_host=options['FETCH_CONNECTIONS_PER_HOST'])
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        return await asyncio.gather(*(fetch_feed(session, url, headers, directory) for url, headers in sources))
+
+
+def fetch_feeds(sources, directory=None):
+    """
+    Параллельное скачивание прайсов.
+    sources - список пар (ссылка, заголовки запроса).
+    Возвращает список результатов fetch_result в том же порядке.
+    Временные файлы удаляются тем, кто загружает прайс (см. remove_fetched)
+    """
+    if not sources:
+        return []
+    directory = directory or settings.PRICE_IMPORT['FETCH_DIR']
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(fetch_all(sources, directory))
+    finally:
+        loop.close()
+
+
+def remove_fetched(fetched):
+    """
+    Удаление временного файла скачанного прайса (если он есть)
+    """
+    path = fetched and fetched.get('path')
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+class CircuitBreaker(object):
+    """
+    Размыкатель для ссылок на прайс магазина.
+    После threshold неудачных запросов подряд ссылка не запрашивается
+    reset_timeout секунд, затем делается пробный запрос: при успехе счетчик
+    неудач сбрасывается, при неудаче ссылка снова исключается.
+    Состояние хранится в полях магазина feed_failures и feed_retry_after
+    """
+
+    def __init__(self, threshold=None, reset_timeout=None):
+        self.threshold = threshold or settings.PRICE_IMPORT['BREAKER_THRESHOLD']
+        self.reset_timeout = reset_timeout or settings.PRICE_IMPORT['BREAKER_RESET_TIMEOUT']
+
+    def allows(self, shop, now=None):
+        now = now or timezone.now()
+        return shop.feed_retry_after is None or shop.feed_retry_after <= now
+
+    def record(self, shop, success, now=None):
+        """
+        Учет результата запроса прайса магазина
+        """
+        now = now or timezone.now()
+        if success:
+            shop.feed_failures = 0
+            shop.feed_retry_after = None
+        else:
+            shop.feed_failures += 1
+            if shop.feed_failures >= self.threshold:
+                shop.feed_retry_after = now + timedelta(seconds=self.reset_timeout)
+        shop.save(update_fields=('feed_failures', 'feed_retry_after', ))
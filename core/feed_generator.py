@@ -0,0 +1,129 @@
+import json
+import random
+from xml.sax.saxutils import escape
+import yaml
+
+from .feed_columns import COLUMNS
+
+
+# Генерация синтетических прайсов в форматах v1.0 и v2.0 (для замеров скорости загрузки).
+# Прайс v1.0 пишется в файл потоково, товар за товаром: размер прайса
+# не ограничен памятью. Прайс v2.0 (по столбцам, см. feed_columns) строится
+# в памяти целиком. Содержимое воспроизводимо при одинаковом seed.
+
+SHOP_NAME = 'Тестовый магазин'
+
+YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+class FeedGenerator(object):
+    """
+    Генератор прайса из goods товаров с parameters параметрами у каждого,
+    разнесенных по categories категориям
+    """
+
+    def __init__(self, goods, parameters=5, categories=10, shop=SHOP_NAME, seed=0, version='v1.0'):
+        self.goods_count = goods
+        self.parameters = parameters
+        self.categories = [f'Категория {index}' for index in range(max(categories, 1))]
+        self.shop = shop
+        self.seed = seed
+        self.version = version
+
+    def header(self):
+        return dict(version=self.version, shop=self.shop, categories=[dict(name=name) for name in self.categories])
+
+    def goods(self):
+        """
+        Итератор по товарам прайса
+        """
+        rnd = random.Random(self.seed)
+        for index in range(self.goods_count):
+            price = rnd.randint(100, 200000)
+            yield dict(id=index + 1,
+                       category=self.categories[index % len(self.categories)],
+                       name=f'Товар {index + 1}',
+                       price=price,
+                       price_rrc=price + rnd.randint(0, price // 10),
+                       quantity=rnd.randint(0, 100),
+                       parameters=[dict(name=f'Параметр {number}', value=str(rnd.randint(1, 1000)))
+                                   for number in range(self.parameters)])
+
+    def columns(self):
+        """
+        Товары в формате v2.0: словарь столбцов и таблица параметров
+        """
+        columns = {name: [] for name in COLUMNS}
+        category_index = {name: index for index, name in enumerate(self.categories)}
+        names, values = {}, {}
+        table = dict(good=[], name=[], value=[])
+        for index, item in enumerate(self.goods()):
+            item['category'] = category_index[item['category']]
+            for name in COLUMNS:
+                columns[name].append(item[name])
+            for entry in item['parameters']:
+                table['good'].append(index)
+                table['name'].append(names.setdefault(entry['name'], len(names)))
+                table['value'].append(values.setdefault(entry['value'], len(values)))
+        columns['parameters'] = dict(names=list(names), values=list(values), **table)
+        return columns
+
+    def write_json(self, target):
+        if self.version == 'v2.0':
+            json.dump(dict(self.header(), goods=self.columns()), target, ensure_ascii=False)
+            return
+        header = json.dumps(self.header(), ensure_ascii=False)
+        target.write(header[:-1] + ', "goods": [\n')
+        for index, item in enumerate(self.goods()):
+            target.write((',\n' if index else '') + json.dumps(item, ensure_ascii=False))
+        target.write('\n]}\n')
+
+    def write_yaml(self, target):
+        if self.version == 'v2.0':
+            yaml.dump(dict(self.header(), goods=self.columns()), target, Dumper=YAML_DUMPER,
+                      allow_unicode=True, sort_keys=False, default_flow_style=None, width=2 ** 16)
+            return
+        yaml.dump(self.header(), target, Dumper=YAML_DUMPER, allow_unicode=True, sort_keys=False)
+        target.write('goods:\n')
+        for item in self.goods():
+            yaml.dump([item], target, Dumper=YAML_DUMPER, allow_unicode=True, sort_keys=False)
+
+    def write_xml(self, target):
+        def element(tag, value):
+            return f'<{tag}>{escape(str(value))}</{tag}>'
+
+        def value_xml(value):
+            if isinstance(value, dict):
+                return ''.join(f'<{key}>{value_xml(entry)}</{key}>' for key, entry in value.items())
+            if isinstance(value, list):
+                return ''.join(f'<list-item>{value_xml(entry)}</list-item>' for entry in value)
+            return escape(str(value))
+
+        target.write('<?xml version="1.0" encoding="utf-8"?>\n<root>\n')
+        if self.version == 'v2.0':
+            target.write(value_xml(dict(self.header(), goods=self.columns())) + '\n</root>\n')
+            return
+        target.write(element('version', self.version) + element('shop', self.shop) + '\n<categories>\n')
+        for name in self.categories:
+            target.write('<list-item>' + element('name', name) + '</list-item>\n')
+        target.write('</categories>\n<goods>\n')
+        for item in self.goods():
+            parameters = item.pop('parameters')
+            target.write('<list-item>' + ''.join(element(key, value) for key, value in item.items()))
+            if parameters:
+                target.write('<parameters>' + ''.join(
+                    '<list-item>' + element('name', entry['name']) + element('value', entry['value']) + '</list-item>'
+                    for entry in parameters) + '</parameters>')
+            target.write('</list-item>\n')
+        target.write('</goods>\n</root>\n')
+
+    def write(self, feed_format, target):
+        """
+        Запись прайса в формате feed_format (json, yaml, xml) в текстовый поток target
+        """
+        getattr(self, f'write_{feed_format}')(target)
+
+    def save(self, feed_format, path):
+        with open(path, 'w', encoding='utf-8') as target:
+            self.write(feed_format, target)
+        return path
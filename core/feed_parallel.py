@@ -0,0 +1,118 @@
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from django.conf import settings
+import json
+import multiprocessing
+import os
+from time import perf_counter
+
+from .exceptions import FeedError
+from .feed_readers import iter_json_feed
+from .feed_validator import check_rows
+from .import_profiler import add_phase, phase
+
+
+# Параллельный разбор больших прайсов.
+# json читатель нарезает список товаров на сегменты текста по границам товаров
+# (см. feed_readers.JSONStreamReader.segment), сегменты разбираются и проверяются
+# (check_rows) в процессах ProcessPoolExecutor. Результаты собираются в порядке
+# прайса: повторы названий, учет ошибок и запись в базу остаются в основном процессе.
+# В работе одновременно не более двух сегментов на процесс, поэтому память
+# не растет с размером прайса.
+# Граница сегмента, принятая внутри вложенного словаря, всегда приводит к ошибке
+# разбора (скобки сегмента не сбалансированы), но не к неверным товарам: при ошибке
+# разбора прайс разбирается заново последовательно (см. partner_info_loader.import_stream).
+# Демонические процессы (например, процессы-исполнители celery prefork) не могут
+# запускать дочерние процессы, поэтому в них прайсы разбираются последовательно.
+
+PARALLEL_READERS = {
+    'json': lambda stream: iter_json_feed(stream, settings.PRICE_IMPORT['PARALLEL_SEGMENT_SIZE']),
+}
+
+
+def parallel_workers(feed_format, size):
+    """
+    Число процессов для разбора прайса формата feed_format размером size байт
+    (0 - прайс разбирается последовательно)
+    """
+    if feed_format not in PARALLEL_READERS or size is None or size < settings.PRICE_IMPORT['PARALLEL_MIN_SIZE']:
+        return 0
+    if multiprocessing.current_process().daemon:
+        return 0
+    workers = settings.PRICE_IMPORT['PARALLEL_WORKERS']
+    workers = os.cpu_count() if workers is None else workers
+    return workers if workers > 1 else 0
+
+
+def check_segment(items):
+    return items, check_rows(items)
+
+
+def parse_segment(text):
+    """
+    Разбор и проверка сегмента списка товаров (выполняется в процессе пула)
+    """
+    try:
+        items = json.loads('[' + text + ']')
+    except ValueError as e:
+        # Исключения json передаются из процесса пула без своих аргументов:
+        raise ValueError(str(e))
+    return check_segment(items)
+
+
+def parallel_goods(parts, executor, window):
+    """
+    Итератор по разобранным и проверенным частям списка товаров (товары, результат check_rows)
+    в порядке прайса. parts - части списка товаров (Feed.parts), window - наибольшее
+    число частей в работе
+    """
+    parts = iter(parts)
+    pending = deque()
+
+    def submit():
+        with phase('decode'):
+            part = next(parts, None)
+        if part is None:
+            return False
+        kind, value = part
+        if kind == 'segment':
+            pending.append(executor.submit(parse_segment, value))
+        else:
+            future = Future()
+            future.set_result(check_segment([value]))
+            pending.append(future)
+        return True
+
+    while len(pending) < window and submit():
+        pass
+    while pending:
+        started = perf_counter()
+        try:
+            result = pending.popleft().result()
+        except ValueError as e:
+            raise FeedError('Некорректный формат файла: {}', e)
+        add_phase('decode', perf_counter() - started, len(result[0]))
+        submit()
+        yield result
+
+
+class SegmentPool(object):
+    """
+    Пул процессов для разбора сегментов прайса
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.executor.shutdown()
+
+    def goods(self, feed):
+        """
+        Разобранные и проверенные части списка товаров прайса (см. parallel_goods)
+        """
+        return parallel_goods(feed.parts(), self.executor, 2 * self.workers)
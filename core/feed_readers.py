@@ -0,0 +1,454 @@
+import codecs
+from django.conf import settings
+from defusedxml.ElementTree import iterparse, ParseError as XMLParseError
+import json
+import re
+from rest_framework_xml.parsers import XMLParser
+from yaml import SafeLoader, YAMLError
+from yaml.composer import Composer
+from yaml.constructor import SafeConstructor
+from yaml.resolver import Resolver
+from yaml.events import StreamEndEvent, MappingStartEvent, MappingEndEvent, SequenceStartEvent, SequenceEndEvent
+
+from .exceptions import FeedError
+from .feed_compression import DECOMPRESSION_ERRORS
+from .utils import is_list
+
+
+# Потоковое чтение прайсов поставщиков.
+# Читатели не строят в памяти весь документ: они возвращают события
+# ('key', <ключ>, <значение>) для ключей верхнего уровня и
+# ('item', 'goods', <товар>) для каждого товара из списка goods.
+# Прайс Яндекс.Маркета (YML) читается xml читателем и переводится
+# в те же события прайса v1.0 (см. iter_yml_feed).
+# Для параллельного разбора (см. feed_parallel) json читатель вместо товаров
+# возвращает события ('segment', 'goods', <текст товаров через запятую>).
+
+READ_CHUNK_SIZE = 64 * 1024
+
+STREAMED_KEY = 'goods'
+
+NOT_A_DICT_ERROR = 'Некорректный формат файла: исходные данные должны представлять собой словарь'
+
+# Самый длинный токен json, который может оборваться на конце буфера ('-Infinity'):
+# ошибка разбора ближе к концу буфера может быть вызвана обрывом значения
+MAX_TOKEN_LENGTH = 9
+
+try:
+    from yaml.cyaml import CParser
+
+    class StreamSafeLoader(CParser, Composer, SafeConstructor, Resolver):
+        """
+        Безопасный загрузчик yaml (как CSafeLoader: события разбирает libyaml,
+        объекты python строятся только стандартных типов), строящий узлы
+        по одному (у CSafeLoader нет compose_node)
+        """
+
+        def __init__(self, stream):
+            CParser.__init__(self, stream)
+            Composer.__init__(self)
+            SafeConstructor.__init__(self)
+            Resolver.__init__(self)
+
+except ImportError:
+    # PyYAML без libyaml
+    StreamSafeLoader = SafeLoader
+
+
+class JSONStreamReader(object):
+    """
+    Инкрементальный разбор json из байтового потока.
+    Значения разбираются стандартным json.JSONDecoder по мере чтения потока,
+    в памяти хранится только непрочитанный остаток буфера
+    """
+
+    whitespace = re.compile(r'[ \t\n\r]*')
+
+    # Возможная граница между словарями - элементами списка:
+    item_boundary = re.compile(r'\}[ \t\n\r]*,[ \t\n\r]*\{')
+
+    def __init__(self, stream, chunk_size=READ_CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self.buffer = ''
+        self.pos = 0
+        # Число символов документа до начала буфера (для позиций в сообщениях об ошибках):
+        self.offset = 0
+        self.eof = False
+
+    def fill(self, size=None):
+        """
+        Чтение очередной порции потока в буфер
+        """
+        chunk = self.stream.read(size or self.chunk_size)
+        self.eof = not chunk
+        self.offset += self.pos
+        self.buffer = self.buffer[self.pos:] + self.text_decoder.decode(chunk or b'', final=self.eof)
+        self.pos = 0
+
+    def peek(self):
+        """
+        Следующий значимый символ (без его извлечения) или '' в конце потока
+        """
+        while True:
+            self.pos = self.whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return ''
+            self.fill()
+
+    def next(self):
+        """
+        Извлечение следующего значимого символа
+        """
+        char = self.peek()
+        self.pos += len(char)
+        return char
+
+    def expect(self, *chars):
+        char = self.next()
+        if char not in chars:
+            raise ValueError(f'Expecting one of {chars} at position {self.offset + self.pos - len(char)}, got {char!r}')
+        return char
+
+    def value(self):
+        """
+        Разбор очередного значения json целиком.
+        Если значение не помещается в буфер, порции чтения удваиваются:
+        большое значение (например, столбец прайса v2.0) разбирается заново
+        лишь логарифмическое число раз. Буфер дочитывается, только если разбор
+        дошел до его конца: ошибка внутри буфера - ошибка документа
+        """
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as e:
+                if self.eof or not self.truncated(e):
+                    raise ValueError(f'{e.msg} at position {self.offset + e.pos}')
+            else:
+                # Число в конце буфера может продолжаться в следующей порции:
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            self.fill(size)
+            size *= 2
+
+    def truncated(self, error):
+        """
+        Вызвана ли ошибка разбора концом буфера (значение продолжается в следующей порции)
+        """
+        return error.pos >= len(self.buffer) - MAX_TOKEN_LENGTH or error.msg.startswith('Unterminated string')
+
+    def segment(self, size):
+        """
+        Извлечение текста нескольких следующих элементов списка товаров
+        (не короче size символов, без завершающей запятой) без их разбора.
+        Текст обрезается на границе товаров: после первого вхождения '}, {'
+        за size символами, за которым следует словарь с ключом price (у словарей
+        параметров его нет). Граница внутри вложенного словаря с ключом price
+        ложная: текст такого сегмента не разбирается как список (см. feed_parallel).
+        Возвращает None, если граница не найдена (например, у конца списка)
+        """
+        self.peek()
+        while len(self.buffer) - self.pos < 2 * size and not self.eof:
+            self.fill(size)
+        for match in self.item_boundary.finditer(self.buffer, self.pos + size):
+            start = match.end() - 1
+            try:
+                item, _ = self.decoder.raw_decode(self.buffer, start)
+            except ValueError:
+                continue
+            if isinstance(item, dict) and 'price' in item:
+                text = self.buffer[self.pos:match.start() + 1]
+                self.pos = start
+                return text
+        return None
+
+
+def iter_json_feed(stream, segment_size=None):
+    """
+    Потоковый разбор прайса в формате json.
+    segment_size - размер сегментов списка товаров, возвращаемых
+    без разбора для параллельной обработки (см. JSONStreamReader.segment)
+    """
+    reader = JSONStreamReader(stream)
+    if reader.peek() != '{':
+        # Пустой документ - ошибка разбора, иначе - не словарь:
+        reader.value()
+        raise FeedError(NOT_A_DICT_ERROR)
+    reader.next()
+    if reader.peek() == '}':
+        reader.next()
+    else:
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            if key == STREAMED_KEY and reader.peek() == '[':
+                reader.next()
+                if reader.peek() == ']':
+                    reader.next()
+                else:
+                    segments = bool(segment_size)
+                    while True:
+                        segment = reader.segment(segment_size) if segments else None
+                        if segment is not None:
+                            yield 'segment', key, segment
+                            continue
+                        # Остаток списка без границ сегментов разбирается по товарам:
+                        segments = False
+                        yield 'item', key, reader.value()
+                        if reader.expect(',', ']') == ']':
+                            break
+            else:
+                yield 'key', key, reader.value()
+            if reader.expect(',', '}') == '}':
+                break
+    if reader.peek():
+        raise ValueError(f'Extra data at position {reader.offset + reader.pos}')
+
+
+def iter_yaml_feed(stream):
+    """
+    Потоковый разбор прайса в формате yaml по событиям парсера.
+    Из узлов собирается только очередной товар, а не весь документ
+    """
+    loader = StreamSafeLoader(stream)
+    try:
+        loader.get_event()
+        if loader.check_event(StreamEndEvent):
+            raise FeedError(NOT_A_DICT_ERROR)
+        loader.get_event()
+        if not loader.check_event(MappingStartEvent):
+            raise FeedError(NOT_A_DICT_ERROR)
+        loader.get_event()
+        while not loader.check_event(MappingEndEvent):
+            key = loader.construct_document(loader.compose_node(None, None))
+            if key == STREAMED_KEY and loader.check_event(SequenceStartEvent):
+                loader.get_event()
+                while not loader.check_event(SequenceEndEvent):
+                    yield 'item', key, loader.construct_document(loader.compose_node(None, None))
+                loader.get_event()
+            else:
+                yield 'key', key, loader.construct_document(loader.compose_node(None, None))
+    finally:
+        loader.dispose()
+
+
+def iter_xml_feed(stream):
+    """
+    Потоковый разбор прайса в формате xml (iterparse).
+    Структура документа такая же, как у rest_framework_xml:
+    списки задаются элементами list-item.
+    Разобранные элементы удаляются из дерева
+    """
+    converter = XMLParser()
+    root = section = None
+    sections = children = 0
+    streamed = False
+    depth = 0
+    events = iterparse(stream, events=('start', 'end'), forbid_dtd=True)
+    for event, element in events:
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                root = element
+                if root.tag == YML_ROOT:
+                    yield from iter_yml_feed(events, root)
+                    return
+            elif depth == 2:
+                sections += 1
+                if sections == 1 and element.tag == 'list-item':
+                    raise FeedError(NOT_A_DICT_ERROR)
+                section = element
+                children = 0
+                streamed = False
+            elif depth == 3:
+                children += 1
+                if children == 1:
+                    # Как и в XMLParser, тип узла определяется по первому потомку:
+                    streamed = section.tag == STREAMED_KEY and element.tag == 'list-item'
+            continue
+
+        depth -= 1
+        if depth == 2 and streamed:
+            yield 'item', section.tag, converter._xml_convert(element)
+            section.remove(element)
+        elif depth == 1:
+            if not streamed:
+                yield 'key', section.tag, converter._xml_convert(section)
+            root.remove(section)
+        elif depth == 0 and not sections:
+            raise FeedError(NOT_A_DICT_ERROR)
+
+
+# Прайс Яндекс.Маркета (YML):
+#   <yml_catalog><shop>
+#     <name>Магазин</name>
+#     <categories><category id="1">Смартфоны</category>...</categories>
+#     <offers>
+#       <offer id="12" available="true">
+#         <name>...</name> (или typePrefix, vendor и model), <categoryId>1</categoryId>,
+#         <price>, <oldprice>, <count>, <param name="Цвет" unit="...">черный</param>...
+#       </offer>...
+#     </offers>
+#   </shop></yml_catalog>
+# Валюта цен не учитывается (цены считаются указанными в рублях).
+
+YML_ROOT = 'yml_catalog'
+
+
+def yml_offer(offer, categories):
+    """
+    Товар прайса v1.0 из элемента offer. Цена без скидки (oldprice) считается
+    рекомендуемой розничной, количество без count задается наличием (available).
+    Повторяющиеся параметры объединяются в один со списком значений через запятую
+    """
+    fields = {child.tag: (child.text or '').strip() for child in offer if child.tag != 'param'}
+    name = fields.get('name') or ' '.join(
+        fields[key] for key in ('typePrefix', 'vendor', 'model') if fields.get(key))
+    if fields.get('count'):
+        quantity = fields['count']
+    elif offer.get('available', 'true').lower() == 'false':
+        quantity = 0
+    else:
+        quantity = settings.PRICE_IMPORT['YML_AVAILABLE_QUANTITY']
+
+    parameters = {}
+    for param in offer.iterfind('param'):
+        key = param.get('name')
+        if key and param.get('unit'):
+            key = f'{key}, {param.get("unit")}'
+        value = (param.text or '').strip()
+        parameters[key] = f'{parameters[key]}, {value}' if key in parameters else value
+    return dict(id=offer.get('id'),
+                category=categories.get(fields.get('categoryId')),
+                name=name,
+                price=fields.get('price'),
+                price_rrc=fields.get('oldprice') or fields.get('price'),
+                quantity=quantity,
+                parameters=[dict(name=key, value=value) for key, value in parameters.items()])
+
+
+def iter_yml_feed(events, root):
+    """
+    Потоковый разбор прайса YML по событиям iterparse после открытия корневого элемента root.
+    Предложения (offer) переводятся в товары по мере разбора и удаляются из дерева,
+    категории должны идти в документе до предложений
+    """
+    yield 'key', 'version', 'v1.0'
+    categories = {}
+    path = [root]
+    for event, element in events:
+        if event == 'start':
+            path.append(element)
+            continue
+        path.pop()
+        parent = path[-1].tag if path else None
+        if element.tag == 'offer' and parent == 'offers':
+            yield 'item', STREAMED_KEY, yml_offer(element, categories)
+        elif element.tag == 'category' and parent == 'categories':
+            categories[element.get('id')] = (element.text or '').strip()
+            continue
+        elif element.tag == 'categories' and parent == 'shop':
+            names = dict.fromkeys(name for name in categories.values() if name)
+            yield 'key', 'categories', [dict(name=name) for name in names]
+        elif element.tag == 'name' and parent == 'shop':
+            yield 'key', 'shop', (element.text or '').strip()
+        else:
+            continue
+        path[-1].remove(element)
+
+
+FEED_READERS = {
+    'json': iter_json_feed,
+    'yaml': iter_yaml_feed,
+    'xml': iter_xml_feed,
+}
+
+GOODS_EVENTS = ('item', 'segment', )
+
+PARSE_ERRORS = (ValueError, TypeError, YAMLError, XMLParseError) + DECOMPRESSION_ERRORS
+
+
+class Feed(object):
+    """
+    Прайс, читаемый из потока.
+    При создании читаются ключи верхнего уровня до первого товара
+    (заголовок: version, shop, categories). Товары затем отдаются
+    по одному через goods() (или частями через parts()). Если товары
+    в документе идут раньше заголовка, они буферизуются до его появления.
+    Ключи, идущие после товаров, попадают в header по мере чтения
+    """
+
+    required_keys = ('version', 'shop', )
+
+    def __init__(self, events):
+        self.events = self.translate_errors(events)
+        self.header = {}
+        self.buffer = []
+        self.read_header()
+
+    @staticmethod
+    def translate_errors(events):
+        try:
+            yield from events
+        except PARSE_ERRORS as e:
+            raise FeedError('Некорректный формат файла: {}', e)
+
+    def has_header(self):
+        return all(key in self.header for key in self.required_keys)
+
+    def read_header(self):
+        for kind, key, value in self.events:
+            if kind in GOODS_EVENTS:
+                self.buffer.append((kind, value))
+            else:
+                self.header[key] = value
+            if self.buffer and self.has_header():
+                break
+
+    def columns(self):
+        """
+        Товары прайса v2.0 - словарь столбцов (см. feed_columns).
+        Документ дочитывается до конца
+        """
+        for kind, key, value in self.events:
+            if kind in GOODS_EVENTS:
+                self.buffer.append((kind, value))
+            else:
+                self.header[key] = value
+        if self.buffer:
+            raise FeedError('Некорректный формат файла: товары прайса v2.0 должны быть заданы словарем столбцов')
+        return self.header.pop(STREAMED_KEY, {})
+
+    def goods(self):
+        """
+        Итератор по товарам прайса (читатель без сегментов)
+        """
+        for kind, value in self.parts():
+            yield value
+
+    def parts(self):
+        """
+        Итератор по частям списка товаров: ('item', товар)
+        или ('segment', текст товаров), см. iter_json_feed
+        """
+        buffer, self.buffer = self.buffer, []
+        yield from buffer
+        for kind, key, value in self.events:
+            if kind in GOODS_EVENTS:
+                yield kind, value
+            else:
+                self.header[key] = value
+        # Список товаров, не разобранный потоково (например, пустой элемент xml):
+        if STREAMED_KEY in self.header:
+            goods = self.header.pop(STREAMED_KEY)
+            if not is_list(goods):
+                raise FeedError('Некорректный формат файла: товары должны быть заданы в списке')
+            for item in goods:
+                yield 'item', item
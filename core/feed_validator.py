@@ -0,0 +1,280 @@
+from django.conf import settings
+import numpy as np
+
+from .exceptions import FeedError
+from .import_profiler import phase
+from .utils import is_dict, is_list, to_float
+
+
+# Проверка товаров прайса по столбцам.
+# Товары проверяются пачками: цены и количества пачки переводятся в массивы
+# numpy и проверяются векторно, названия - по массиву хэшей. Проверка не
+# останавливается на первой ошибке: собираются ошибки всех товаров прайса
+# с номерами строк (номер товара в списке goods, начиная с 0).
+# При частичной загрузке (skip_invalid) товары с ошибками пропускаются,
+# а в пачках для записи остаются только корректные товары.
+# Проверки, не зависящие от других товаров (check_rows), могут выполняться
+# в параллельных процессах разбора (см. feed_parallel), повторы названий
+# и учет ошибок - в GoodsValidator.
+
+INFO_ERROR = 'некорректно указана информация по продукту'
+DUPLICATE_ERROR = 'продукты с одинаковым именем'
+NOT_A_DICT_ERROR = 'товары должны быть описаны как словарь'
+PARAMETERS_ERROR = 'параметры должны иметь не пустые значения name и value'
+DUPLICATE_PARAMETER_ERROR = 'параметры с одинаковым именем'
+
+
+def to_float_array(values):
+    """
+    Перевод столбца значений в массив float64 (некорректные значения - nan)
+    """
+    try:
+        array = np.array(values, dtype=np.float64)
+        if array.shape == (len(values), ):
+            return array
+    except (ValueError, TypeError):
+        pass
+    return np.array([to_float(value) if not is_list(value) or isinstance(value, str) else None
+                     for value in values], dtype=np.float64)
+
+
+def check_parameters(parameters):
+    """
+    Проверка списка параметров товара. Возвращает текст ошибки или None
+    """
+    if parameters is None:
+        return None
+    if not is_list(parameters) or isinstance(parameters, str) or is_dict(parameters):
+        return 'параметры должны быть заданы как массив полей name и value'
+    names = set()
+    for entry in parameters:
+        if not is_dict(entry):
+            return 'параметр для продукта должен быть описан как словарь'
+        name = entry.get('name')
+        if not name or entry.get('value') is None:
+            return PARAMETERS_ERROR
+        if name in names:
+            return DUPLICATE_PARAMETER_ERROR
+        names.add(name)
+    return None
+
+
+def check_values(names, categories, price, price_rrc, quantity):
+    """
+    Векторная проверка значений столбцов пачки товаров (без повторов названий).
+    Возвращает маску товаров с ошибками и количества в виде массива float64
+    """
+    price = to_float_array(price)
+    price_rrc = to_float_array(price_rrc)
+    quantity = to_float_array(quantity)
+    has_name = np.array([bool(name) for name in names], dtype=bool)
+    has_category = np.array([bool(category) for category in categories], dtype=bool)
+
+    with np.errstate(invalid='ignore'):
+        valid_quantity = np.isfinite(quantity) & (quantity >= 0) & (quantity == np.floor(quantity))
+    invalid = ~(has_name & has_category & np.isfinite(price) & np.isfinite(price_rrc) & valid_quantity)
+    return invalid, quantity
+
+
+def check_rows(items):
+    """
+    Проверка товаров пачки, не зависящая от других пачек.
+    Корректные количества приводятся к int.
+    Возвращает сообщения об ошибках значений товаров и об ошибках их параметров
+    """
+    messages = [None] * len(items)
+    rows = []
+    for index, item in enumerate(items):
+        if is_dict(item):
+            rows.append(item)
+        else:
+            rows.append({})
+            messages[index] = NOT_A_DICT_ERROR
+
+    invalid, quantity = check_values([row.get('name') for row in rows],
+                                     [row.get('category') for row in rows],
+                                     [row.get('price') for row in rows],
+                                     [row.get('price_rrc') for row in rows],
+                                     [row.get('quantity') for row in rows])
+    for index in np.flatnonzero(invalid):
+        if messages[index] is None:
+            messages[index] = INFO_ERROR
+    parameter_messages = [check_parameters(row.get('parameters')) for row in rows]
+
+    for row, value, message, parameter_message in zip(rows, quantity.tolist(), messages, parameter_messages):
+        if message is None and parameter_message is None:
+            row['quantity'] = int(value)
+    return messages, parameter_messages
+
+
+class GoodsValidator(object):
+    """
+    Проверка товаров прайса пачками с накоплением ошибок.
+    Хэши названий проверенных товаров хранятся в отсортированном массиве
+    (для поиска повторов между пачками без хранения самих названий).
+    В ответ попадает не более max_errors ошибок, число ошибок считается полностью.
+    skip_invalid - пропускать товары с ошибками, report - отчет, в который
+    записываются все ошибки (см. import_report.ErrorReport)
+    """
+
+    def __init__(self, batch_size=None, max_errors=None, skip_invalid=False, report=None):
+        self.batch_size = batch_size or settings.PRICE_IMPORT['BATCH_SIZE']
+        self.max_errors = max_errors or settings.PRICE_IMPORT['MAX_ERRORS']
+        self.skip_invalid = skip_invalid
+        self.report = report
+        self.rows = 0
+        self.errors = []
+        self.error_count = 0
+        self.name_hashes = np.empty(0, dtype=np.int64)
+
+    @property
+    def writable(self):
+        """
+        Проверенные товары можно записывать: ошибок нет или они пропускаются
+        """
+        return self.skip_invalid or not self.error_count
+
+    def batches(self, goods):
+        """
+        Итератор по проверенным пачкам товаров
+        """
+        batch = []
+        for item in goods:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                yield self.check(batch)
+                batch = []
+        if batch:
+            yield self.check(batch)
+
+    def checked_batches(self, parts):
+        """
+        Итератор по проверенным пачкам из частей прайса, уже проверенных
+        check_rows: (товары, результат check_rows), см. feed_parallel
+        """
+        for items, checked in parts:
+            yield self.check(items, checked)
+
+    def check(self, items, checked=None):
+        """
+        Проверка пачки товаров. Корректные количества приводятся к int.
+        checked - результат check_rows для пачки, если он уже получен.
+        Возвращает пачку (без товаров с ошибками, если они пропускаются)
+        """
+        with phase('validate', len(items)):
+            messages = self.check_batch(items, checked)
+        if not self.skip_invalid:
+            return items
+        return [item for item, message in zip(items, messages) if message is None]
+
+    def check_batch(self, items, checked=None):
+        messages, parameter_messages = checked or check_rows(items)
+        names = [item.get('name') if is_dict(item) else None for item in items]
+        messages = [message or parameter_message for message, parameter_message in zip(messages, parameter_messages)]
+        self.check_duplicates(messages, names)
+        self.add_errors(messages, names)
+        return messages
+
+    def column_batches(self, columns):
+        """
+        Итератор по проверенным пачкам товаров прайса v2.0, заданного по столбцам
+        (см. feed_columns.GoodsColumns). Столбцы проверяются без построения
+        словарей товаров, словари строятся только для записи (writable)
+        """
+        for start in range(0, len(columns), self.batch_size):
+            end = min(start + self.batch_size, len(columns))
+            with phase('validate', end - start):
+                messages = [None] * (end - start)
+                names = columns.column('name', start, end)
+                quantity = self.check_columns(messages, names,
+                                              columns.column('category', start, end),
+                                              columns.column('price', start, end),
+                                              columns.column('price_rrc', start, end),
+                                              columns.column('quantity', start, end))
+                columns.check_parameters(messages, start, end)
+                self.check_duplicates(messages, names)
+                self.add_errors(messages, names)
+            if not self.writable:
+                continue
+            with phase('decode'):
+                items = columns.items(start, end, [int(value) if message is None else 0
+                                                   for value, message in zip(quantity.tolist(), messages)])
+            if self.skip_invalid:
+                items = [item for item, message in zip(items, messages) if message is None]
+            yield items
+
+    def check_columns(self, messages, names, categories, price, price_rrc, quantity):
+        """
+        Векторная проверка значений столбцов пачки товаров (без повторов названий).
+        Сообщения об ошибках записываются в messages (если для товара еще нет сообщения).
+        Возвращает количества в виде массива float64
+        """
+        invalid, quantity = check_values(names, categories, price, price_rrc, quantity)
+
+        for index in np.flatnonzero(invalid):
+            if messages[index] is None:
+                messages[index] = INFO_ERROR
+        return quantity
+
+    def check_duplicates(self, messages, names):
+        """
+        Проверка повторов названий у товаров пачки без других ошибок.
+        Сообщения о повторах записываются в messages
+        """
+        valid = np.array([message is None and bool(name) for message, name in zip(messages, names)], dtype=bool)
+        for index in np.flatnonzero(self.check_names(names, valid)):
+            messages[index] = DUPLICATE_ERROR
+
+    def check_names(self, names, valid):
+        """
+        Поиск повторяющихся названий корректных товаров (маска valid) в пачке и среди
+        ранее проверенных товаров. Запоминаются только названия корректных товаров,
+        поэтому товар с ошибкой не делает повтором следующий товар с тем же названием.
+        Возвращает маску повторов (первое вхождение названия повтором не считается)
+        """
+        hashes = np.array([hash(str(name)) for name in names], dtype=np.int64)
+        duplicates = np.zeros(len(names), dtype=bool)
+
+        # Повторы внутри пачки:
+        checked = np.flatnonzero(valid)
+        order = np.argsort(hashes[checked], kind='stable')
+        ordered = hashes[checked][order]
+        repeated = np.zeros(len(checked), dtype=bool)
+        repeated[1:] = ordered[1:] == ordered[:-1]
+        duplicates[checked[order[repeated]]] = True
+
+        # Повторы среди предыдущих пачек:
+        if len(self.name_hashes):
+            positions = np.searchsorted(self.name_hashes, hashes)
+            found = self.name_hashes[np.minimum(positions, len(self.name_hashes) - 1)] == hashes
+            duplicates |= found
+        duplicates &= valid
+
+        new_hashes = np.unique(hashes[valid])
+        self.name_hashes = np.insert(self.name_hashes, np.searchsorted(self.name_hashes, new_hashes), new_hashes)
+        return duplicates
+
+    def add_errors(self, messages, names):
+        """
+        Учет ошибок очередной пачки (номера строк отсчитываются от начала прайса)
+        """
+        offset = self.rows
+        self.rows += len(messages)
+        for index, message in enumerate(messages):
+            if message is not None:
+                self.add_error(offset + index, names[index], message)
+
+    def add_error(self, row, name, message):
+        self.error_count += 1
+        if self.report is not None:
+            self.report.add(row, name, message)
+        if len(self.errors) < self.max_errors:
+            self.errors.append(dict(row=row, name=str(name) if name is not None else None, error=message))
+
+    def raise_errors(self):
+        """
+        Исключение FeedError со списком ошибок, если они были найдены
+        """
+        if self.error_count:
+            raise FeedError('Некорректный формат файла: ошибок в описании товаров - {}', self.error_count,
+                            rows=self.errors)
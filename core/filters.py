@@ -0,0 +1,59 @@
+from django.db.models import FloatField, Value
+from rest_framework.filters import OrderingFilter, SearchFilter
+
+from .catalog_search import search_available, search_catalog
+from .fuzzy_search import fuzzy_catalog
+
+
+class AliasOrderingFilter(OrderingFilter):
+    """
+    Сортировка с псевдонимами полей: view.ordering_aliases - словарь
+    <поле сортировки в запросе> - <поле (выражение сортировки) в queryset>.
+    Позволяет сохранить параметры сортировки API, когда queryset строится
+    по другой модели (например, ?ordering=product по каталогу CatalogItem)
+    """
+
+    def get_default_ordering(self, view):
+        # При поиске по умолчанию сортировка задается view.search_ordering (например, по рангу):
+        search_ordering = getattr(view, 'search_ordering', None)
+        if search_ordering and SearchFilter().get_search_terms(view.request):
+            return search_ordering
+        return super(AliasOrderingFilter, self).get_default_ordering(view)
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super(AliasOrderingFilter, self).get_ordering(request, queryset, view)
+        aliases = getattr(view, 'ordering_aliases', None)
+        if not ordering or not aliases:
+            return ordering
+        return [self.resolve_alias(term, aliases) for term in ordering]
+
+    @staticmethod
+    def resolve_alias(term, aliases):
+        descending = term.startswith('-')
+        alias = aliases.get(term.lstrip('-'))
+        if alias is None:
+            return term
+        if descending:
+            return alias[1:] if alias.startswith('-') else '-' + alias
+        return alias
+
+
+class CatalogSearchFilter(SearchFilter):
+    """
+    Полнотекстовый поиск по каталогу (см. core.catalog_search): найденные позиции
+    получают ранг search_rank. Без индекса поиска (база не sqlite) - поиск
+    SearchFilter по view.search_fields с одинаковым рангом.
+    Если ничего не найдено, продукты ищутся по названию с учетом опечаток
+    (см. core.fuzzy_search)
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        if not terms:
+            return queryset
+        if search_available(queryset.db):
+            found = search_catalog(queryset, terms)
+        else:
+            found = super(CatalogSearchFilter, self).filter_queryset(request, queryset, view).annotate(
+                search_rank=Value(0.0, output_field=FloatField()))
+        return found if found.exists() else fuzzy_catalog(queryset, terms)
@@ -0,0 +1,202 @@
+from array import array
+from django.conf import settings
+from django.db.models import Case, FloatField, Value, When
+import numpy as np
+import re
+import threading
+import time
+
+from .models import Product
+
+
+# Нечеткий поиск по названиям продуктов (опечатки: "iphne", "смартфн").
+# Индекс хранится в памяти процесса: для каждой триграммы названий - массив
+# номеров продуктов (array('I'), без объектов python на вхождение), для каждого
+# продукта - id, нормализованное название и число триграмм.
+# Поиск: счетчики общих триграмм запроса и названий считаются numpy.bincount
+# по спискам вхождений триграмм запроса, лучшие CATALOG_SEARCH['FUZZY_CANDIDATES']
+# кандидатов по сходству триграмм (коэффициент Жаккара) проверяются расстоянием
+# редактирования каждого слова запроса до ближайшего слова названия
+# (допустимое число опечаток зависит от длины слова, см. allowed_typos).
+# Проверка кандидатов ограничена по времени (FUZZY_BUDGET): по его исчерпании
+# возвращаются лучшие из проверенных.
+# Индекс дополняется продуктами, созданными загрузками прайсов (по возрастанию id,
+# одним запросом не чаще FUZZY_SYNC_INTERVAL секунд), и перестраивается целиком
+# раз в FUZZY_REBUILD_INTERVAL секунд (переименованные и удаленные продукты).
+
+WORD_SEPARATOR = re.compile(r'[\W_]+')
+
+
+def normalize(text):
+    """
+    Название в нижнем регистре, ё - как е, без знаков препинания
+    """
+    return WORD_SEPARATOR.sub(' ', text.lower().replace('ё', 'е')).strip()
+
+
+def trigrams(text):
+    """
+    Коды триграмм нормализованного текста (слова дополняются пробелами по краям)
+    """
+    codes = set()
+    for word in text.split():
+        word = f' {word} '
+        for start in range(len(word) - 2):
+            codes.add(ord(word[start]) << 42 | ord(word[start + 1]) << 21 | ord(word[start + 2]))
+    return codes
+
+
+def allowed_typos(word):
+    """
+    Допустимое число опечаток в слове запроса
+    """
+    return 0 if len(word) < 3 else 1 if len(word) < 6 else 2
+
+
+def edit_distance(first, second, limit):
+    """
+    Расстояние Левенштейна между словами, не больше limit + 1
+    (расчет прекращается, как только расстояние заведомо больше limit)
+    """
+    if abs(len(first) - len(second)) > limit:
+        return limit + 1
+    previous = list(range(len(second) + 1))
+    for row, first_char in enumerate(first, 1):
+        current = [row]
+        for column, second_char in enumerate(second, 1):
+            current.append(min(previous[column] + 1, current[column - 1] + 1,
+                               previous[column - 1] + (first_char != second_char)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return min(previous[-1], limit + 1)
+
+
+def word_distance(word, name):
+    """
+    Расстояние от слова запроса до ближайшего слова названия
+    (0, если слово запроса входит в название)
+    """
+    if word in name:
+        return 0
+    limit = allowed_typos(word)
+    return min((edit_distance(word, name_word, limit) for name_word in name.split()), default=limit + 1)
+
+
+class TrigramIndex(object):
+    """
+    Триграммный индекс названий продуктов (см. описание модуля)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.product_ids = array('I')
+        self.names = []
+        self.sizes = array('H')
+        self.postings = {}
+        self.last_id = 0
+        self.synced_at = None
+        self.built_at = time.monotonic()
+
+    def add(self, product_id, name):
+        """
+        Добавление продукта в индекс
+        """
+        position = len(self.product_ids)
+        name = normalize(name)
+        codes = trigrams(name)
+        self.product_ids.append(product_id)
+        self.names.append(name)
+        self.sizes.append(min(len(codes), 0xffff))
+        for code in codes:
+            posting = self.postings.get(code)
+            if posting is None:
+                posting = self.postings[code] = array('I')
+            posting.append(position)
+        self.last_id = max(self.last_id, product_id)
+
+    def sync(self):
+        """
+        Дополнение индекса новыми продуктами (и полная перестройка по истечении срока)
+        """
+        options = settings.CATALOG_SEARCH
+        now = time.monotonic()
+        if self.synced_at is not None and now - self.synced_at < options['FUZZY_SYNC_INTERVAL']:
+            return
+        with self.lock:
+            if now - self.built_at >= options['FUZZY_REBUILD_INTERVAL']:
+                self.reset()
+            for product_id, name in Product.objects.filter(id__gt=self.last_id).order_by('id').values_list(
+                    'id', 'name').iterator():
+                self.add(product_id, name)
+            self.synced_at = now
+
+    def candidates(self, codes, count, min_common=1):
+        """
+        Номера count продуктов с наибольшим сходством триграмм с запросом
+        среди продуктов, у которых с запросом не меньше min_common общих триграмм
+        """
+        postings = [np.frombuffer(self.postings[code], dtype=np.uint32) for code in codes if code in self.postings]
+        if not postings:
+            return np.empty(0, dtype=np.intp)
+        overlap = np.bincount(np.concatenate(postings), minlength=len(self.product_ids))
+        positions = np.flatnonzero(overlap >= max(min_common, 1))
+        common = overlap[positions]
+        sizes = np.frombuffer(self.sizes, dtype=np.uint16)[positions].astype(np.int64)
+        similarity = common / (len(codes) + sizes - common)
+        if len(positions) > count:
+            best = np.argpartition(-similarity, count - 1)[:count]
+            positions, similarity = positions[best], similarity[best]
+        return positions[np.argsort(-similarity, kind='stable')]
+
+    def search(self, query, limit=None):
+        """
+        id продуктов, похожих на запрос, от лучших к худшим
+        """
+        options = settings.CATALOG_SEARCH
+        self.sync()
+        words = normalize(query).split()
+        if not words:
+            return []
+        deadline = time.perf_counter() + options['FUZZY_BUDGET']
+        found = []
+        # Массивы индекса не должны меняться, пока на них есть представления numpy
+        # и номера продуктов:
+        with self.lock:
+            # Каждая опечатка в слове меняет не больше трех его триграмм:
+            codes = trigrams(' '.join(words))
+            min_common = len(codes) - 3 * sum(allowed_typos(word) for word in words)
+            for rank, position in enumerate(self.candidates(codes, options['FUZZY_CANDIDATES'], min_common)):
+                name = self.names[position]
+                total = 0
+                for word in words:
+                    distance = word_distance(word, name)
+                    if distance > allowed_typos(word):
+                        break
+                    total += distance
+                else:
+                    found.append((total, rank, self.product_ids[position]))
+                if time.perf_counter() > deadline:
+                    break
+        found.sort()
+        return [product_id for _, _, product_id in found[:limit or options['FUZZY_LIMIT']]]
+
+
+# Индекс процесса
+product_index = TrigramIndex()
+
+
+def fuzzy_catalog(queryset, terms):
+    """
+    Позиции каталога queryset с продуктами, похожими на слова terms,
+    с рангом search_rank (номер продукта в результатах нечеткого поиска)
+    """
+    product_ids = product_index.search(' '.join(terms))
+    if not product_ids:
+        return queryset.none().annotate(search_rank=Value(0.0, output_field=FloatField()))
+    return queryset.filter(product_id__in=product_ids).annotate(search_rank=Case(
+        *(When(product_id=product_id, then=Value(float(rank))) for rank, product_id in enumerate(product_ids)),
+        output_field=FloatField()))
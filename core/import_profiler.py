@@ -0,0 +1,195 @@
+from contextlib import contextmanager, nullcontext
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from functools import wraps
+import threading
+from time import perf_counter
+import tracemalloc
+
+from .models import Shop, ImportRun, ImportRunPhase, IMPORT_PHASE_CHOICES
+
+
+# Профилирование загрузки прайсов по этапам: скачивание (fetch), разбор (decode),
+# проверка (validate), поиск в справочниках (resolve) и запись (write).
+# При потоковой загрузке этапы чередуются, их показатели суммируются.
+# Профиль текущей загрузки хранится в потоке: модули загрузки отмечают этапы
+# функциями phase/iterate, которые ничего не делают вне профилируемой загрузки.
+
+_local = threading.local()
+
+
+class PhaseStats(object):
+    """
+    Накопленные показатели этапа загрузки
+    """
+
+    def __init__(self):
+        self.duration = 0.0
+        self.rows = 0
+        self.queries = 0
+        self.memory_peak = None
+
+
+class ImportProfiler(object):
+    """
+    Профиль загрузки прайса.
+    Время этапов считается по perf_counter, запросы - через execute_wrapper
+    соединения с базой, пик памяти - через tracemalloc (память, выделенная
+    за время этапа; трассировка сбрасывается при переходе от другого этапа,
+    а не при каждом входе: пик этапа iterate - пик всего цикла, а не одного элемента)
+    """
+
+    def __init__(self, memory=None, **run_fields):
+        self.memory = settings.PRICE_IMPORT['PROFILE_MEMORY'] if memory is None else memory
+        self.run_fields = run_fields
+        self.phases = {name: PhaseStats() for name, _ in IMPORT_PHASE_CHOICES}
+        self.current = None
+        self.last = None
+        self.queries = 0
+        self.response = None
+
+    def start(self):
+        self.started_at = timezone.now()
+        self.started = perf_counter()
+        # Чужую трассировку памяти не сбрасываем:
+        self.memory = self.memory and not tracemalloc.is_tracing()
+        if self.memory:
+            tracemalloc.start()
+        self.query_wrapper = connection.execute_wrapper(self.count_query)
+        self.query_wrapper.__enter__()
+
+    def stop(self):
+        self.query_wrapper.__exit__(None, None, None)
+        if self.memory:
+            tracemalloc.stop()
+        self.duration = perf_counter() - self.started
+
+    def count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        if self.current is not None:
+            self.current.queries += 1
+        return execute(sql, params, many, context)
+
+    @contextmanager
+    def phase(self, name, rows=0):
+        """
+        Учет выполнения этапа name, обработано rows товаров.
+        Вложенный этап учитывается во внешнем
+        """
+        if self.current is not None:
+            yield
+            return
+        stats = self.current = self.phases[name]
+        if self.memory and self.last is not stats:
+            tracemalloc.clear_traces()
+        self.last = stats
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            stats.duration += perf_counter() - started
+            stats.rows += rows
+            if self.memory:
+                stats.memory_peak = max(stats.memory_peak or 0, tracemalloc.get_traced_memory()[1])
+            self.current = None
+
+    def iterate(self, name, iterable):
+        """
+        Итератор, время получения каждого элемента которого учитывается в этапе name
+        """
+        iterator = iter(iterable)
+        stats = self.phases[name]
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            stats.rows += 1
+            yield item
+
+    def save(self):
+        status_code = getattr(self.response, 'status_code', None)
+        # Магазин, созданный откаченной загрузкой, в базе уже отсутствует:
+        shop = self.run_fields.get('shop')
+        if shop is not None and not Shop.objects.filter(id=shop.id).exists():
+            self.run_fields['shop'] = None
+        run = ImportRun.objects.create(status_code=status_code, rows=self.phases['decode'].rows,
+                                       duration=self.duration, queries=self.queries,
+                                       started_at=self.started_at, **self.run_fields)
+        ImportRunPhase.objects.bulk_create([
+            ImportRunPhase(run=run, name=name, duration=stats.duration, rows=stats.rows,
+                           queries=stats.queries, memory_peak=stats.memory_peak)
+            for name, stats in self.phases.items() if stats.duration or stats.rows
+        ])
+        return run
+
+
+def current_profiler():
+    return getattr(_local, 'profiler', None)
+
+
+@contextmanager
+def profile_import(**run_fields):
+    """
+    Профилирование загрузки прайса с сохранением ImportRun по окончании.
+    Вложенные вызовы используют внешний профиль (дополняя его поля run_fields)
+    """
+    profiler = current_profiler()
+    if profiler is not None or not settings.PRICE_IMPORT['PROFILE']:
+        if profiler is not None:
+            profiler.run_fields.update(run_fields)
+        yield profiler
+        return
+    profiler = _local.profiler = ImportProfiler(**run_fields)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        _local.profiler = None
+        profiler.save()
+
+
+def profiled(func):
+    """
+    Декоратор функции загрузки прайса, возвращающей http ответ
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with profile_import() as profiler:
+            response = func(*args, **kwargs)
+            if profiler is not None and profiler.response is None:
+                profiler.response = response
+            return response
+    return wrapper
+
+
+def phase(name, rows=0):
+    profiler = current_profiler()
+    return profiler.phase(name, rows) if profiler is not None else nullcontext()
+
+
+def iterate(name, iterable):
+    profiler = current_profiler()
+    return profiler.iterate(name, iterable) if profiler is not None else iterable
+
+
+def add_phase(name, duration, rows=0):
+    """
+    Учет этапа, выполненного вне профилируемой загрузки (например, скачивания прайса)
+    """
+    profiler = current_profiler()
+    if profiler is not None:
+        profiler.phases[name].duration += duration
+        profiler.phases[name].rows += rows
+
+
+def set_run_info(**run_fields):
+    """
+    Дополнение сведений о загрузке (магазин, пользователь, источник)
+    """
+    profiler = current_profiler()
+    if profiler is not None:
+        profiler.run_fields.update(run_fields)
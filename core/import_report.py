@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.files import File
+import csv
+import io
+from tempfile import TemporaryFile
+
+from .models import ImportReport
+
+
+# Отчет о товарах, пропущенных при частичной загрузке прайса
+# (политика магазина error_policy=skip). Строки отчета пишутся во временный
+# файл по мере проверки товаров, поэтому число ошибок в отчете не ограничено
+# (в ответ загрузки попадает не более PRICE_IMPORT['MAX_ERRORS']).
+
+REPORT_COLUMNS = ('row', 'name', 'error', )
+
+
+class ErrorReport(object):
+    """
+    Накопление строк отчета об ошибках в csv (utf-8 с BOM - для открытия в Excel)
+    """
+
+    def __init__(self):
+        self.file = TemporaryFile()
+        self.text = io.TextIOWrapper(self.file, encoding='utf-8-sig', newline='')
+        self.writer = csv.writer(self.text)
+        self.writer.writerow(REPORT_COLUMNS)
+        self.count = 0
+
+    def add(self, row, name, error):
+        self.writer.writerow((row, '' if name is None else name, error))
+        self.count += 1
+
+    def save(self, shop):
+        """
+        Сохранение отчета магазина. Хранится не более PRICE_IMPORT['ERROR_REPORTS']
+        последних отчетов магазина
+        """
+        self.text.flush()
+        self.file.seek(0)
+        report = ImportReport(shop=shop, skipped=self.count)
+        report.file.save(f'shop{shop.id}.csv', File(self.file), save=True)
+        for old in ImportReport.objects.filter(shop=shop)[settings.PRICE_IMPORT['ERROR_REPORTS']:]:
+            old.file.delete(save=False)
+            old.delete()
+        return report
+
+    def close(self):
+        self.text.close()
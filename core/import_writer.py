@@ -0,0 +1,490 @@
+from decimal import Decimal
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+
+from .catalog import activate_generation, refresh_items, touch_catalog, touch_suggest
+from .import_profiler import phase
+from .models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter, OrderItem
+from .utils import chunked, to_positive_int
+
+
+# Ограничение на число значений в одном запросе вида name__in=[...]
+# (у sqlite есть лимит на число параметров в запросе)
+LOOKUP_CHUNK_SIZE = 500
+
+MONEY_QUANTUM = Decimal('0.01')
+
+
+def to_money(value):
+    """
+    Приведение цены к виду, в котором она хранится в базе
+    (для сравнения цен из прайса с сохраненными)
+    """
+    return Decimal(str(value)).quantize(MONEY_QUANTUM)
+
+
+def delete_infos(queryset, chunk_size=LOOKUP_CHUNK_SIZE):
+    """
+    Удаление позиций прайса порциями, каждая порция - в своей транзакции.
+    Возвращает число удаленных позиций
+    """
+    deleted = 0
+    while True:
+        ids = list(queryset.values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return deleted
+        with transaction.atomic():
+            _, counts = ProductInfo.objects.filter(id__in=ids).delete()
+        deleted += counts.get(ProductInfo._meta.label, 0)
+
+
+def issue_generation(shop_id):
+    """
+    Выделение нового поколения прайса магазина (номер, под которым еще нет позиций)
+    """
+    with transaction.atomic():
+        Shop.objects.filter(id=shop_id).update(last_generation=F('last_generation') + 1)
+        return Shop.objects.values_list('last_generation', flat=True).get(id=shop_id)
+
+
+def move_basket_items(shop_id, generation, infos):
+    """
+    Перенос позиций корзин с позиций прайса infos (пары id, id продукта) на позиции
+    тех же продуктов поколения generation. Позиции, для которых в корзине уже есть
+    новая позиция, не переносятся (удаляются вместе со старой позицией прайса)
+    """
+    new_ids = dict(ProductInfo.objects.filter(
+        shop_id=shop_id, generation=generation,
+        product_id__in=[product_id for _, product_id in infos]).values_list('product_id', 'id'))
+    targets = {info_id: new_ids[product_id] for info_id, product_id in infos if product_id in new_ids}
+    if not targets:
+        return
+    items = list(OrderItem.objects.filter(
+        order__state='basket', product_info_id__in=list(targets)).values_list('id', 'order_id', 'product_info_id'))
+    if not items:
+        return
+    existing = set(OrderItem.objects.filter(
+        order_id__in={order_id for _, order_id, _ in items},
+        product_info_id__in={targets[info_id] for _, _, info_id in items}).values_list('order_id', 'product_info_id'))
+    moves = {item_id: targets[info_id] for item_id, order_id, info_id in items
+             if (order_id, targets[info_id]) not in existing}
+    if moves:
+        OrderItem.objects.filter(id__in=list(moves)).update(product_info_id=Case(
+            *(When(id=item_id, then=Value(info_id)) for item_id, info_id in moves.items()),
+            output_field=IntegerField()))
+
+
+def collect_generations(shop_id, chunk_size=LOOKUP_CHUNK_SIZE):
+    """
+    Удаление позиций старых (предшествующих активному) поколений прайса магазина
+    порциями, каждая порция - в своей транзакции. Покупатели старые поколения
+    уже не видят, поэтому удаление не мешает чтению каталога.
+    Позиции корзин переносятся на позиции тех же продуктов активного поколения,
+    позиции оформленных заказов сохраняются вместе с их позициями прайса
+    (цена на момент заказа). Возвращает число удаленных позиций
+    """
+    active = Shop.objects.values_list('active_generation', flat=True).get(id=shop_id)
+    ordered = OrderItem.objects.exclude(order__state='basket').values('product_info_id')
+    old = ProductInfo.objects.filter(shop_id=shop_id, generation__lt=active).order_by('id')
+    deleted = 0
+    last_id = 0
+    while True:
+        infos = list(old.filter(id__gt=last_id).values_list('id', 'product_id')[:chunk_size])
+        if not infos:
+            return deleted
+        last_id = infos[-1][0]
+        with transaction.atomic():
+            move_basket_items(shop_id, active, infos)
+            _, counts = ProductInfo.objects.filter(
+                id__in=[info_id for info_id, _ in infos]).exclude(id__in=ordered).delete()
+        deleted += counts.get(ProductInfo._meta.label, 0)
+
+
+class CatalogWriter(object):
+    """
+    Пакетная запись прайса поставщика в базу.
+    Товары накапливаются в буфере и записываются пачками по batch_size штук:
+    справочники категорий, продуктов и параметров разрешаются в id
+    несколькими запросами на пачку, недостающие записи создаются через
+    bulk_create, информация о продуктах и их параметры вставляются
+    также через bulk_create.
+    Число запросов к базе зависит от числа пачек, а не от числа товаров.
+    Прайс пишется новым поколением (см. Shop.active_generation): каждая пачка
+    записывается в своей транзакции, покупатели до конца загрузки видят старое
+    поколение. В close() магазин одним запросом переключается на новое
+    поколение, после чего старые поколения удаляются порциями.
+    При ошибке загрузки записанная часть нового поколения удаляется (discard).
+    progress - функция, вызываемая после записи каждой пачки
+    с общим числом записанных товаров
+    """
+
+    # Загрузка не оборачивается в общую транзакцию: пачки фиксируются по одной,
+    # а покупатели видят старое поколение до его переключения в activate():
+    atomic = False
+
+    def __init__(self, shop, batch_size=None, progress=None):
+        self.shop = shop
+        self.generation = None
+        self.batch_size = batch_size or settings.PRICE_IMPORT['BATCH_SIZE']
+        self.progress = progress
+        self.processed = 0
+        self.items = []
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.deleted = 0
+        self.category_ids = {}
+        self.parameter_ids = {}
+        self.shop_category_ids = set()
+
+        # Категорий и названий параметров немного, загружаем их сразу:
+        self.category_ids.update(Category.objects.values_list('name', 'id'))
+        self.parameter_ids.update(Parameter.objects.values_list('name', 'id'))
+
+    def clear(self):
+        """
+        Выделение нового поколения прайса магазина
+        """
+        with phase('write'):
+            self.generation = issue_generation(self.shop.id)
+
+    def add_categories(self, names):
+        """
+        Регистрация категорий магазина из заголовка прайса
+        """
+        names = list(names)
+        with phase('resolve'):
+            self.resolve_categories(names)
+        self.shop_category_ids.update(self.category_ids[name] for name in names)
+
+    def add(self, item):
+        """
+        Добавление товара в буфер записи
+        """
+        self.items.append(item)
+        if len(self.items) >= self.batch_size:
+            self.flush()
+
+    def extend(self, items):
+        """
+        Добавление нескольких товаров в буфер записи
+        """
+        for item in items:
+            self.add(item)
+
+    def close(self):
+        """
+        Запись остатка буфера, привязка категорий к магазину
+        и переключение магазина на новое поколение прайса
+        """
+        self.flush()
+        self.link_categories()
+        self.activate()
+        touch_suggest()
+        return self.result()
+
+    def link_categories(self):
+        through = Category.shops.through
+        with phase('write'):
+            through.objects.bulk_create(
+                [through(category_id=category_id, shop_id=self.shop.id) for category_id in self.shop_category_ids],
+                ignore_conflicts=True)
+
+    def activate(self):
+        """
+        Переключение магазина на записанное поколение и удаление старых поколений
+        """
+        with phase('write'):
+            with transaction.atomic():
+                activated = Shop.objects.filter(id=self.shop.id, active_generation__lt=self.generation).update(
+                    active_generation=self.generation)
+                if activated:
+                    activate_generation(self.shop.id, self.generation)
+            if not activated:
+                # Параллельная загрузка уже переключила магазин на более новое поколение:
+                self.discard()
+                return
+            self.shop.active_generation = self.generation
+            self.deleted = collect_generations(self.shop.id)
+
+    def discard(self):
+        """
+        Удаление позиций неактивированного поколения (при ошибке загрузки)
+        """
+        if self.generation is not None:
+            delete_infos(ProductInfo.objects.filter(shop_id=self.shop.id, generation=self.generation))
+
+    def result(self):
+        """
+        Число созданных, измененных, неизмененных и удаленных позиций прайса
+        """
+        return dict(created=self.created, updated=self.updated, unchanged=self.unchanged, deleted=self.deleted)
+
+    def resolve_names(self, model, cache, names, factory):
+        """
+        Получение id записей справочника model по названиям.
+        Найденные id сохраняются в словаре cache,
+        недостающие записи создаются с помощью factory(name)
+        """
+        missing = [name for name in set(names) if name not in cache]
+        for chunk in chunked(missing, LOOKUP_CHUNK_SIZE):
+            cache.update(model.objects.filter(name__in=chunk).values_list('name', 'id'))
+        missing = [name for name in missing if name not in cache]
+        if not missing:
+            return
+        model.objects.bulk_create([factory(name) for name in missing], ignore_conflicts=True)
+        for chunk in chunked(missing, LOOKUP_CHUNK_SIZE):
+            cache.update(model.objects.filter(name__in=chunk).values_list('name', 'id'))
+
+    def resolve_categories(self, names):
+        self.resolve_names(Category, self.category_ids, names, lambda name: Category(name=name))
+
+    def resolve_parameters(self, names):
+        self.resolve_names(Parameter, self.parameter_ids, names, lambda name: Parameter(name=name))
+
+    def resolve_products(self, items):
+        """
+        Получение id продуктов пачки. Словарь продуктов не хранится между
+        пачками, т.к. он растет вместе с размером прайса
+        """
+        categories = {item['name']: self.category_ids[item['category']] for item in items}
+        product_ids = {}
+        self.resolve_names(Product, product_ids, categories.keys(),
+                           lambda name: Product(name=name, category_id=categories[name]))
+        return product_ids
+
+    def flush(self):
+        """
+        Запись накопленной пачки товаров
+        """
+        items, self.items = self.items, []
+        if not items:
+            return
+        with phase('resolve', len(items)):
+            product_ids = self.resolve(items)
+        with phase('write', len(items)), transaction.atomic():
+            self.write(items, product_ids)
+        self.processed += len(items)
+        if self.progress:
+            self.progress(self.processed)
+
+    def resolve(self, items):
+        """
+        Разрешение справочников пачки в id. Возвращает словарь id продуктов
+        """
+        self.resolve_categories(item['category'] for item in items)
+        self.resolve_parameters(entry['name'] for item in items for entry in item.get('parameters') or [])
+        self.shop_category_ids.update(self.category_ids[item['category']] for item in items)
+        return self.resolve_products(items)
+
+    def write(self, items, product_ids):
+        """
+        Вставка пачки товаров (старый прайс удален в clear)
+        """
+        info_ids = self.create_infos(items, product_ids)
+        self.create_parameters(items, product_ids, info_ids)
+        refresh_items(info_ids.values())
+
+    def create_infos(self, items, product_ids):
+        """
+        Вставка информации о продуктах. Возвращает словарь id продукта -> id информации о продукте
+        """
+        ProductInfo.objects.bulk_create([
+            ProductInfo(product_id=product_ids[item['name']],
+                        external_id=to_positive_int(item.get('id')),
+                        price=item['price'],
+                        price_rrc=item['price_rrc'],
+                        quantity=item['quantity'],
+                        shop_id=self.shop.id,
+                        generation=self.generation)
+            for item in items
+        ])
+        self.created += len(items)
+
+        # bulk_create в sqlite не возвращает id, получаем их отдельным запросом:
+        info_ids = {}
+        for chunk in chunked([product_ids[item['name']] for item in items], LOOKUP_CHUNK_SIZE):
+            info_ids.update(ProductInfo.objects.filter(
+                shop_id=self.shop.id, generation=self.generation, product_id__in=chunk).values_list('product_id', 'id'))
+        return info_ids
+
+    def create_parameters(self, items, product_ids, info_ids):
+        """
+        Вставка параметров товаров
+        """
+        ProductParameter.objects.bulk_create([
+            ProductParameter(product_info_id=info_ids[product_ids[item['name']]],
+                             parameter_id=self.parameter_ids[entry['name']],
+                             value=entry['value'])
+            for item in items for entry in item.get('parameters') or []
+        ])
+
+
+class DiffCatalogWriter(CatalogWriter):
+    """
+    Инкрементальная запись прайса.
+    Товары сопоставляются с уже загруженными позициями магазина по
+    внешнему ИД (external_id), а при его отсутствии - по продукту.
+    Вставляются только новые позиции, обновляются только позиции с
+    изменившимися ценой, рекомендуемой ценой, количеством или параметрами,
+    удаляются только позиции, исчезнувшие из прайса (кроме позиций оформленных
+    заказов, см. drop_stale).
+    Связанные позиции заказов у неизменившихся товаров не затрагиваются.
+    Изменения вносятся в активное поколение прайса, поэтому загрузка
+    должна выполняться в одной транзакции
+    """
+
+    atomic = True
+
+    def clear(self):
+        """
+        Запоминание id текущих позиций магазина (удаляются те, что не встретятся в прайсе)
+        """
+        with phase('resolve'):
+            self.generation = Shop.objects.values_list('active_generation', flat=True).get(id=self.shop.id)
+            self.stale_ids = set(ProductInfo.objects.filter(
+                shop_id=self.shop.id, generation=self.generation).values_list('id', flat=True))
+
+    def close(self):
+        self.flush()
+        with phase('write'):
+            self.drop_stale(self.stale_ids)
+        self.link_categories()
+        # Неизменившийся прайс не сбрасывает подсказки во всех процессах:
+        if self.created or self.updated or self.deleted:
+            touch_suggest()
+        return self.result()
+
+    def drop_stale(self, info_ids):
+        """
+        Удаление исчезнувших из прайса позиций info_ids. Позиции оформленных заказов
+        сохраняются вместе с их позициями прайса (цена на момент заказа, как в
+        collect_generations): такие позиции переносятся в отдельное неактивное поколение
+        с нулевым количеством, позиции корзин с ними удаляются
+        """
+        info_ids = list(info_ids)
+        if not info_ids:
+            return
+        self.stale_ids.difference_update(info_ids)
+        ordered = OrderItem.objects.exclude(order__state='basket').values('product_info_id')
+        kept = []
+        for chunk in chunked(info_ids, LOOKUP_CHUNK_SIZE):
+            stale = ProductInfo.objects.filter(id__in=chunk)
+            kept += stale.filter(id__in=ordered).values_list('id', flat=True)
+            _, deleted = stale.exclude(id__in=ordered).delete()
+            self.deleted += deleted.get(ProductInfo._meta.label, 0)
+        if kept:
+            generation = issue_generation(self.shop.id)
+            for chunk in chunked(kept, LOOKUP_CHUNK_SIZE):
+                OrderItem.objects.filter(order__state='basket', product_info_id__in=chunk).delete()
+                ProductInfo.objects.filter(id__in=chunk).update(generation=generation, quantity=0)
+            refresh_items(kept)
+            self.deleted += len(kept)
+        touch_catalog()
+
+    def park_moved(self, infos):
+        """
+        Подготовка к смене продуктов позиций infos (внешний ИД товара перешел к другому
+        названию): новый продукт позиции может еще числиться за другой позицией поколения.
+        Исчезнувшие из прайса такие позиции удаляются (drop_stale), а сами позиции infos
+        до обновления переносятся во временное поколение (позиции могут обмениваться
+        продуктами) - иначе обновление нарушает уникальность продукта в поколении магазина
+        """
+        holders = set()
+        for chunk in chunked([info.product_id for info in infos], LOOKUP_CHUNK_SIZE):
+            holders.update(ProductInfo.objects.filter(
+                shop_id=self.shop.id, generation=self.generation, product_id__in=chunk).values_list('id', flat=True))
+        self.drop_stale(holders & self.stale_ids)
+        parking = issue_generation(self.shop.id)
+        for chunk in chunked([info.id for info in infos], LOOKUP_CHUNK_SIZE):
+            ProductInfo.objects.filter(id__in=chunk).update(generation=parking)
+
+    def discard(self):
+        # Изменения откатываются вместе с транзакцией загрузки
+        pass
+
+    def load_existing(self, items, product_ids):
+        """
+        Загрузка позиций магазина, соответствующих товарам пачки
+        """
+        fields = ('id', 'external_id', 'product_id', 'price', 'price_rrc', 'quantity')
+        by_external_id = {}
+        by_product_id = {}
+        queryset = ProductInfo.objects.filter(shop_id=self.shop.id, generation=self.generation)
+        external_ids = [to_positive_int(item.get('id')) for item in items if to_positive_int(item.get('id')) is not None]
+        for chunk in chunked(external_ids, LOOKUP_CHUNK_SIZE):
+            for row in queryset.filter(external_id__in=chunk).values(*fields):
+                by_external_id[row['external_id']] = row
+        for chunk in chunked(list(product_ids.values()), LOOKUP_CHUNK_SIZE):
+            for row in queryset.filter(product_id__in=chunk).values(*fields):
+                by_product_id[row['product_id']] = row
+
+        parameters = {}
+        info_ids = list({row['id'] for row in by_external_id.values()} | {row['id'] for row in by_product_id.values()})
+        for chunk in chunked(info_ids, LOOKUP_CHUNK_SIZE):
+            for info_id, parameter_id, value in ProductParameter.objects.filter(
+                    product_info_id__in=chunk).values_list('product_info_id', 'parameter_id', 'value'):
+                parameters.setdefault(info_id, {})[parameter_id] = value
+        return by_external_id, by_product_id, parameters
+
+    def write(self, items, product_ids):
+        by_external_id, by_product_id, parameters = self.load_existing(items, product_ids)
+
+        new_items = []
+        changed_infos = []
+        moved_infos = []
+        changed_parameters = {}
+        for item in items:
+            product_id = product_ids[item['name']]
+            external_id = to_positive_int(item.get('id'))
+            row = by_external_id.get(external_id) if external_id is not None else None
+            if row is None:
+                row = by_product_id.get(product_id)
+            if row is None or row['id'] not in self.stale_ids:
+                new_items.append(item)
+                continue
+            self.stale_ids.discard(row['id'])
+
+            values = dict(external_id=external_id,
+                          product_id=product_id,
+                          price=to_money(item['price']),
+                          price_rrc=to_money(item['price_rrc']),
+                          quantity=int(item['quantity']))
+            item_parameters = {self.parameter_ids[entry['name']]: str(entry['value'])
+                               for entry in item.get('parameters') or []}
+            info_changed = any(row[key] != value for key, value in values.items())
+            parameters_changed = parameters.get(row['id'], {}) != item_parameters
+            if info_changed:
+                changed_infos.append(ProductInfo(id=row['id'], shop_id=self.shop.id, generation=self.generation,
+                                                 **values))
+                if row['product_id'] != product_id:
+                    moved_infos.append(changed_infos[-1])
+            if parameters_changed:
+                changed_parameters[row['id']] = item_parameters
+            if info_changed or parameters_changed:
+                self.updated += 1
+            else:
+                self.unchanged += 1
+
+        if moved_infos:
+            self.park_moved(moved_infos)
+        if changed_infos:
+            ProductInfo.objects.bulk_update(changed_infos, ('external_id', 'product_id', 'price', 'price_rrc', 'quantity',
+                                                            'generation'))
+        for chunk in chunked(list(changed_parameters), LOOKUP_CHUNK_SIZE):
+            ProductParameter.objects.filter(product_info_id__in=chunk).delete()
+        ProductParameter.objects.bulk_create([
+            ProductParameter(product_info_id=info_id, parameter_id=parameter_id, value=value)
+            for info_id, values in changed_parameters.items() for parameter_id, value in values.items()
+        ])
+        refresh_items({info.id for info in changed_infos} | set(changed_parameters))
+
+        if new_items:
+            super(DiffCatalogWriter, self).write(new_items, product_ids)
+
+
+CATALOG_WRITERS = {
+    'replace': CatalogWriter,
+    'diff': DiffCatalogWriter,
+}
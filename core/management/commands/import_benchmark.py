@@ -0,0 +1,153 @@
+from datetime import datetime
+from django.conf import settings
+from django.core.files import File
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+import json
+import os
+import platform
+import resource
+import tempfile
+from time import perf_counter
+
+from core.feed_generator import FeedGenerator
+from core.models import ImportRun
+from core.partner_info_loader import load_partner_file
+from rest_auth.models import User
+
+
+FORMATS = ('json', 'yaml', 'xml', )
+
+VERSIONS = ('v1.0', 'v2.0', )
+
+
+def reset_peak_rss():
+    """
+    Сброс пикового RSS процесса (linux, /proc/self/clear_refs).
+    Возвращает False, если сброс не поддерживается
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    """
+    Пиковый RSS процесса, байт
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss в linux - в килобайтах, в macos - в байтах:
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if platform.system() == 'Darwin' else maxrss * 1024
+
+
+class Command(BaseCommand):
+    help = 'Замер скорости загрузки синтетических прайсов в чистую базу'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--goods', type=int, nargs='+', default=[1000, 10000],
+                            help='Число товаров в прайсе (можно указать несколько размеров)')
+        parser.add_argument('--parameters', type=int, default=5, help='Число параметров у товара')
+        parser.add_argument('--categories', type=int, default=10, help='Число категорий')
+        parser.add_argument('--formats', nargs='+', choices=FORMATS, default=list(FORMATS), help='Форматы прайса')
+        parser.add_argument('--versions', nargs='+', choices=VERSIONS, default=['v1.0'],
+                            help='Версии формата прайса (v2.0 - товары по столбцам)')
+        parser.add_argument('--mode', choices=('replace', 'diff'), default=None, help='Режим загрузки')
+        parser.add_argument('--profile-memory', action='store_true',
+                            help='Учитывать пик памяти этапов через tracemalloc (замедляет загрузку)')
+        parser.add_argument('--directory', default=None,
+                            help='Каталог для прайсов и базы (по умолчанию - временный, удаляется после замера)')
+        parser.add_argument('--output', default='import_benchmark.json', help='Файл результатов (json)')
+
+    def handle(self, *args, **options):
+        if options['directory']:
+            os.makedirs(options['directory'], exist_ok=True)
+            return self.benchmark(options['directory'], options)
+        with tempfile.TemporaryDirectory(prefix='import-benchmark-') as directory:
+            return self.benchmark(directory, options)
+
+    def benchmark(self, directory, options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('Замер выполняется только на sqlite')
+
+        # Замер выполняется в отдельной чистой базе, как тесты:
+        connection.settings_dict['TEST']['NAME'] = os.path.join(directory, 'benchmark.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        price_import = dict(settings.PRICE_IMPORT, PROFILE=True, PROFILE_MEMORY=options['profile_memory'])
+        results = []
+        try:
+            with override_settings(PRICE_IMPORT=price_import):
+                for goods in options['goods']:
+                    for version in options['versions']:
+                        for feed_format in options['formats']:
+                            result = self.run(directory, feed_format, version, goods, options)
+                            results.append(result)
+                            self.stdout.write(
+                                f'{version} {feed_format:>5} {goods:>8} товаров: {result["duration"]:8.2f} с, '
+                                f'{result["rows_per_second"]:10.0f} товаров/с, запросов - {result["queries"]}, '
+                                f'пик RSS - {result["peak_rss"] // 2 ** 20} МБ')
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = dict(created_at=datetime.now().isoformat(),
+                      python=platform.python_version(),
+                      platform=platform.platform(),
+                      database=connection.vendor,
+                      batch_size=settings.PRICE_IMPORT['BATCH_SIZE'],
+                      mode=options['mode'] or settings.PRICE_IMPORT['MODE'],
+                      parameters=options['parameters'],
+                      categories=options['categories'],
+                      results=results)
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2, ensure_ascii=False)
+        self.stdout.write(self.style.SUCCESS(f'Результаты записаны в {options["output"]}'))
+
+    def run(self, directory, feed_format, version, goods, options):
+        """
+        Загрузка одного прайса в очищенную базу
+        """
+        call_command('flush', interactive=False, verbosity=0)
+        user = User.objects.create(email='benchmark@example.com', type='shop', is_active=True)
+
+        generator = FeedGenerator(goods, options['parameters'], options['categories'], version=version)
+        path = generator.save(feed_format, os.path.join(directory, f'feed-{version}-{goods}.{feed_format}'))
+
+        rss_reset = reset_peak_rss()
+        started = perf_counter()
+        try:
+            with open(path, 'rb') as stream:
+                response = load_partner_file(File(stream), user.id, options['mode'])
+        finally:
+            duration = perf_counter() - started
+            size = os.path.getsize(path)
+            os.remove(path)
+        if response.status_code >= 400:
+            raise CommandError(f'Ошибка загрузки прайса {version} {feed_format}: {response.data}')
+
+        run = ImportRun.objects.prefetch_related('phases').latest('started_at')
+        return dict(format=feed_format,
+                    version=version,
+                    goods=goods,
+                    file_size=size,
+                    duration=duration,
+                    rows_per_second=goods / duration if duration else None,
+                    queries=run.queries,
+                    peak_rss=peak_rss(),
+                    peak_rss_reset=rss_reset,
+                    phases={phase.name: dict(duration=phase.duration,
+                                             rows=phase.rows,
+                                             rows_per_second=phase.rows_per_second,
+                                             queries=phase.queries,
+                                             memory_peak=phase.memory_peak)
+                            for phase in run.phases.all()})
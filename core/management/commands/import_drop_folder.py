@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.drop_folder import drop_root, scan_drop_folder
+from core.partner_info_loader import get_import_mode
+
+
+class Command(BaseCommand):
+    help = 'Загрузка новых и изменившихся прайсов из каталога магазинов на диске'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', default=None,
+                            help='Режим загрузки: replace или diff (по умолчанию - PRICE_IMPORT["MODE"])')
+        parser.add_argument('--dir', default=None,
+                            help='Каталог прайсов (по умолчанию - PRICE_IMPORT["DROP_DIR"] в PRIVATE_ROOT)')
+
+    def handle(self, *args, **options):
+        if not get_import_mode(options['mode']):
+            raise CommandError(f'Неизвестный режим загрузки {options["mode"]}')
+        root = options['dir'] or drop_root()
+        results = scan_drop_folder(options['mode'], root)
+        for result in results:
+            message = f'Магазин {result["shop_id"]}, {result["name"]}: {result["status"]}'
+            if result['errors']:
+                self.stdout.write(self.style.ERROR(f'{message} {result["errors"]}'))
+            else:
+                self.stdout.write(message)
+        self.stdout.write(self.style.SUCCESS(f'Обработано файлов в {root}: {len(results)}'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from core.catalog import rebuild_catalog
+
+
+class Command(BaseCommand):
+    help = 'Сборка каталога для покупателей (CatalogItem) заново по всем позициям прайсов'
+
+    def handle(self, *args, **options):
+        count = rebuild_catalog()
+        self.stdout.write(self.style.SUCCESS(f'Позиций в каталоге: {count}'))
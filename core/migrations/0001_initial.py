@@ -0,0 +1,263 @@
+# Generated by Django 2.2.4 on 2026-10-17 02:01
+
+import core.storage
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=40, unique=True, verbose_name='Название')),
+            ],
+            options={
+                'verbose_name': 'Категория',
+                'verbose_name_plural': 'Категории',
+                'ordering': ('-name',),
+            },
+        ),
+        migrations.CreateModel(
+            name='DropFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, verbose_name='Имя файла')),
+                ('size', models.BigIntegerField(blank=True, null=True, verbose_name='Размер, байт')),
+                ('mtime_ns', models.BigIntegerField(blank=True, null=True, verbose_name='Время изменения, нс')),
+                ('digest', models.CharField(blank=True, default='', max_length=64, verbose_name='sha256 файла')),
+                ('status_code', models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='Код ответа')),
+                ('result', models.TextField(blank=True, default='', verbose_name='Результат (json)')),
+                ('imported_at', models.DateTimeField(blank=True, null=True, verbose_name='Загружено')),
+            ],
+            options={
+                'verbose_name': 'Файл каталога прайсов',
+                'verbose_name_plural': 'Файлы каталога прайсов',
+                'ordering': ('shop', 'name'),
+            },
+        ),
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('partner', 'Прайс поставщика'), ('shops', 'Прайсы всех магазинов')], default='partner', max_length=10, verbose_name='Вид задания')),
+                ('url', models.URLField(blank=True, null=True, verbose_name='Ссылка')),
+                ('file', models.FileField(blank=True, null=True, storage=core.storage.PrivateStorage(), upload_to='imports/', verbose_name='Файл')),
+                ('mode', models.CharField(blank=True, choices=[('replace', 'Полная замена прайса'), ('diff', 'Изменения по внешнему ИД')], default='', max_length=10, verbose_name='Режим загрузки')),
+                ('task_id', models.CharField(blank=True, default='', max_length=50, verbose_name='ИД задачи celery')),
+                ('state', models.CharField(choices=[('queued', 'В очереди'), ('running', 'Выполняется'), ('done', 'Выполнено'), ('partial', 'Выполнено частично'), ('failed', 'Ошибка')], default='queued', max_length=10, verbose_name='Статус')),
+                ('processed', models.PositiveIntegerField(default=0, verbose_name='Обработано')),
+                ('total', models.PositiveIntegerField(blank=True, null=True, verbose_name='Всего')),
+                ('result', models.TextField(blank=True, default='', verbose_name='Результат (json)')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создано')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Завершено')),
+            ],
+            options={
+                'verbose_name': 'Задание импорта',
+                'verbose_name_plural': 'Задания импорта',
+                'ordering': ('-created_at',),
+            },
+        ),
+        migrations.CreateModel(
+            name='ImportReport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('skipped', models.PositiveIntegerField(default=0, verbose_name='Пропущено товаров')),
+                ('file', models.FileField(storage=core.storage.PrivateStorage(), upload_to='import_reports/', verbose_name='Файл отчета')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создано')),
+            ],
+            options={
+                'verbose_name': 'Отчет об ошибках загрузки',
+                'verbose_name_plural': 'Отчеты об ошибках загрузки',
+                'ordering': ('-created_at',),
+            },
+        ),
+        migrations.CreateModel(
+            name='ImportRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(blank=True, default='', max_length=255, verbose_name='Источник')),
+                ('status_code', models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='Код ответа')),
+                ('rows', models.PositiveIntegerField(default=0, verbose_name='Товаров')),
+                ('duration', models.FloatField(default=0, verbose_name='Время, с')),
+                ('queries', models.PositiveIntegerField(default=0, verbose_name='Запросов к базе')),
+                ('started_at', models.DateTimeField(verbose_name='Начало')),
+            ],
+            options={
+                'verbose_name': 'Профиль загрузки прайса',
+                'verbose_name_plural': 'Профили загрузки прайсов',
+                'ordering': ('-started_at',),
+            },
+        ),
+        migrations.CreateModel(
+            name='ImportRunPhase',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(choices=[('fetch', 'Скачивание'), ('decode', 'Разбор'), ('validate', 'Проверка'), ('resolve', 'Поиск в справочниках'), ('write', 'Запись')], max_length=10, verbose_name='Этап')),
+                ('duration', models.FloatField(default=0, verbose_name='Время, с')),
+                ('rows', models.PositiveIntegerField(default=0, verbose_name='Товаров')),
+                ('queries', models.PositiveIntegerField(default=0, verbose_name='Запросов к базе')),
+                ('memory_peak', models.BigIntegerField(blank=True, null=True, verbose_name='Пик памяти, байт')),
+            ],
+            options={
+                'verbose_name': 'Этап загрузки прайса',
+                'verbose_name_plural': 'Этапы загрузки прайса',
+            },
+        ),
+        migrations.CreateModel(
+            name='Order',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dt', models.DateTimeField(auto_now_add=True)),
+                ('state', models.CharField(choices=[('basket', 'Статус корзины'), ('new', 'Новый'), ('confirmed', 'Подтвержден'), ('assembled', 'Собран'), ('sent', 'Отправлен'), ('delivered', 'Доставлен'), ('canceled', 'Отменен')], max_length=25, verbose_name='Статус')),
+            ],
+            options={
+                'verbose_name': 'Заказ',
+                'verbose_name_plural': 'Заказы',
+                'ordering': ('-dt',),
+            },
+        ),
+        migrations.CreateModel(
+            name='OrderItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField(verbose_name='Количество')),
+            ],
+            options={
+                'verbose_name': 'Позиция заказа',
+                'verbose_name_plural': 'Позиции заказов',
+            },
+        ),
+        migrations.CreateModel(
+            name='Parameter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=40, unique=True, verbose_name='Название')),
+            ],
+            options={
+                'verbose_name': 'Название параметра',
+                'verbose_name_plural': 'Названия параметров продуктов',
+                'ordering': ('-name',),
+            },
+        ),
+        migrations.CreateModel(
+            name='Product',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=80, unique=True, verbose_name='Название')),
+            ],
+            options={
+                'verbose_name': 'Продукт',
+                'verbose_name_plural': 'Продукты',
+                'ordering': ('-name',),
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductInfo',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('external_id', models.PositiveIntegerField(blank=True, null=True, verbose_name='Внешний ИД')),
+                ('quantity', models.PositiveIntegerField(verbose_name='Количество')),
+                ('price', models.DecimalField(decimal_places=2, max_digits=20, validators=[django.core.validators.MinValueValidator(0)], verbose_name='Цена')),
+                ('price_rrc', models.DecimalField(decimal_places=2, max_digits=20, validators=[django.core.validators.MinValueValidator(0)], verbose_name='Рекомендуемая розничная цена')),
+                ('generation', models.PositiveIntegerField(default=0, verbose_name='Поколение прайса')),
+            ],
+            options={
+                'verbose_name': 'Информация о продукте',
+                'verbose_name_plural': 'Информация о продуктах',
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductParameter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.CharField(max_length=100, verbose_name='Значение')),
+            ],
+            options={
+                'verbose_name': 'Параметр',
+                'verbose_name_plural': 'Параметры',
+            },
+        ),
+        migrations.CreateModel(
+            name='Shop',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True, verbose_name='Название')),
+                ('state', models.BooleanField(default=True, verbose_name='Получать заказы')),
+                ('load_url', models.URLField(blank=True, null=True, verbose_name='Ссылка')),
+                ('error_policy', models.CharField(choices=[('reject', 'Отклонять прайс с ошибками'), ('skip', 'Пропускать товары с ошибками')], default='reject', max_length=10, verbose_name='Товары с ошибками')),
+                ('feed_etag', models.CharField(blank=True, default='', max_length=255, verbose_name='ETag прайса')),
+                ('feed_last_modified', models.CharField(blank=True, default='', max_length=64, verbose_name='Last-Modified прайса')),
+                ('feed_digest', models.CharField(blank=True, default='', max_length=64, verbose_name='Хэш прайса (sha256)')),
+                ('feed_failures', models.PositiveIntegerField(default=0, verbose_name='Неудачных запросов прайса подряд')),
+                ('feed_retry_after', models.DateTimeField(blank=True, null=True, verbose_name='Не запрашивать прайс до')),
+                ('active_generation', models.PositiveIntegerField(default=0, verbose_name='Активное поколение прайса')),
+                ('last_generation', models.PositiveIntegerField(default=0, verbose_name='Последнее выданное поколение прайса')),
+            ],
+            options={
+                'verbose_name': 'Магазин',
+                'verbose_name_plural': 'Магазины',
+                'ordering': ('-name',),
+            },
+        ),
+        migrations.CreateModel(
+            name='UploadChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField(verbose_name='Номер части')),
+                ('checksum', models.CharField(max_length=64, verbose_name='sha256 части')),
+            ],
+            options={
+                'verbose_name': 'Часть файла',
+                'verbose_name_plural': 'Части файлов',
+            },
+        ),
+        migrations.CreateModel(
+            name='CatalogItem',
+            fields=[
+                ('product_info', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='catalog_item', serialize=False, to='core.ProductInfo', verbose_name='Информация о продукте')),
+                ('shop_name', models.CharField(max_length=50, verbose_name='Название магазина')),
+                ('shop_state', models.BooleanField(default=True, verbose_name='Магазин получает заказы')),
+                ('product_name', models.CharField(max_length=80, verbose_name='Название продукта')),
+                ('category_name', models.CharField(max_length=40, verbose_name='Название категории')),
+                ('quantity', models.PositiveIntegerField(verbose_name='Количество')),
+                ('price', models.DecimalField(decimal_places=2, max_digits=20, verbose_name='Цена')),
+                ('price_rrc', models.DecimalField(decimal_places=2, max_digits=20, verbose_name='Рекомендуемая розничная цена')),
+                ('parameters', models.TextField(blank=True, default='', verbose_name='Параметры (json)')),
+                ('generation', models.PositiveIntegerField(default=0, verbose_name='Поколение прайса')),
+                ('visible', models.BooleanField(default=False, verbose_name='Видна покупателям')),
+            ],
+            options={
+                'verbose_name': 'Позиция каталога',
+                'verbose_name_plural': 'Позиции каталога',
+            },
+        ),
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, verbose_name='Имя файла')),
+                ('size', models.BigIntegerField(validators=[django.core.validators.MinValueValidator(1)], verbose_name='Размер, байт')),
+                ('chunk_size', models.PositiveIntegerField(validators=[django.core.validators.MinValueValidator(1)], verbose_name='Размер части, байт')),
+                ('checksum', models.CharField(blank=True, default='', max_length=64, verbose_name='sha256 файла')),
+                ('mode', models.CharField(blank=True, choices=[('replace', 'Полная замена прайса'), ('diff', 'Изменения по внешнему ИД')], default='', max_length=10, verbose_name='Режим загрузки')),
+                ('state', models.CharField(choices=[('open', 'Загружается'), ('finalized', 'Передана в импорт')], default='open', max_length=10, verbose_name='Статус')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создано')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Изменено')),
+                ('job', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='uploads', to='core.ImportJob', verbose_name='Задание импорта')),
+            ],
+            options={
+                'verbose_name': 'Загрузка прайса по частям',
+                'verbose_name_plural': 'Загрузки прайсов по частям',
+                'ordering': ('-created_at',),
+            },
+        ),
+    ]
@@ -0,0 +1,186 @@
+# Generated by Django 2.2.4 on 2026-10-17 02:01
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('rest_auth', '0001_initial'),
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь'),
+        ),
+        migrations.AddField(
+            model_name='uploadchunk',
+            name='session',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='received_chunks', to='core.UploadSession', verbose_name='Загрузка'),
+        ),
+        migrations.AddField(
+            model_name='shop',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='shops', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь'),
+        ),
+        migrations.AddField(
+            model_name='productparameter',
+            name='parameter',
+            field=models.ForeignKey(blank=True, on_delete=django.db.models.deletion.CASCADE, related_name='product_parameters', to='core.Parameter', verbose_name='Параметр'),
+        ),
+        migrations.AddField(
+            model_name='productparameter',
+            name='product_info',
+            field=models.ForeignKey(blank=True, on_delete=django.db.models.deletion.CASCADE, related_name='product_parameters', to='core.ProductInfo', verbose_name='Информация о продукте'),
+        ),
+        migrations.AddField(
+            model_name='productinfo',
+            name='product',
+            field=models.ForeignKey(blank=True, on_delete=django.db.models.deletion.CASCADE, related_name='product_infos', to='core.Product', verbose_name='Продукт'),
+        ),
+        migrations.AddField(
+            model_name='productinfo',
+            name='shop',
+            field=models.ForeignKey(blank=True, on_delete=django.db.models.deletion.CASCADE, related_name='product_infos', to='core.Shop', verbose_name='Магазин'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='category',
+            field=models.ForeignKey(blank=True, on_delete=django.db.models.deletion.CASCADE, related_name='products', to='core.Category', verbose_name='Категория'),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='order',
+            field=models.ForeignKey(blank=True, on_delete=django.db.models.deletion.CASCADE, related_name='ordered_items', to='core.Order', verbose_name='Заказ'),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='product_info',
+            field=models.ForeignKey(blank=True, on_delete=django.db.models.deletion.CASCADE, related_name='ordered_items', to='core.ProductInfo', verbose_name='Информация о продукте'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='contact',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='orders', to='rest_auth.Contact', verbose_name='Контакт'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='user',
+            field=models.ForeignKey(blank=True, on_delete=django.db.models.deletion.CASCADE, related_name='orders', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь'),
+        ),
+        migrations.AddField(
+            model_name='importrunphase',
+            name='run',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='phases', to='core.ImportRun', verbose_name='Профиль загрузки'),
+        ),
+        migrations.AddField(
+            model_name='importrun',
+            name='job',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='runs', to='core.ImportJob', verbose_name='Задание импорта'),
+        ),
+        migrations.AddField(
+            model_name='importrun',
+            name='shop',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='import_runs', to='core.Shop', verbose_name='Магазин'),
+        ),
+        migrations.AddField(
+            model_name='importrun',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='import_runs', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь'),
+        ),
+        migrations.AddField(
+            model_name='importreport',
+            name='shop',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='import_reports', to='core.Shop', verbose_name='Магазин'),
+        ),
+        migrations.AddField(
+            model_name='importjob',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='import_jobs', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь'),
+        ),
+        migrations.AddField(
+            model_name='dropfile',
+            name='shop',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='drop_files', to='core.Shop', verbose_name='Магазин'),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='shops',
+            field=models.ManyToManyField(blank=True, related_name='categories', to='core.Shop', verbose_name='Магазины'),
+        ),
+        migrations.AddConstraint(
+            model_name='uploadchunk',
+            constraint=models.UniqueConstraint(fields=('session', 'number'), name='unique_upload_chunk'),
+        ),
+        migrations.AddConstraint(
+            model_name='productparameter',
+            constraint=models.UniqueConstraint(fields=('product_info', 'parameter'), name='unique_product_parameter'),
+        ),
+        migrations.AddIndex(
+            model_name='productinfo',
+            index=models.Index(fields=['shop', 'generation'], name='product_info_generation'),
+        ),
+        migrations.AddConstraint(
+            model_name='productinfo',
+            constraint=models.UniqueConstraint(fields=('product', 'shop', 'generation'), name='unique_product_info'),
+        ),
+        migrations.AddConstraint(
+            model_name='orderitem',
+            constraint=models.UniqueConstraint(fields=('order', 'product_info'), name='unique_order_item'),
+        ),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(fields=('user', 'dt'), name='unique_order'),
+        ),
+        migrations.AddConstraint(
+            model_name='importrunphase',
+            constraint=models.UniqueConstraint(fields=('run', 'name'), name='unique_run_phase'),
+        ),
+        migrations.AddConstraint(
+            model_name='dropfile',
+            constraint=models.UniqueConstraint(fields=('shop', 'name'), name='unique_drop_file'),
+        ),
+        migrations.AddField(
+            model_name='catalogitem',
+            name='category',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='catalog_items', to='core.Category', verbose_name='Категория'),
+        ),
+        migrations.AddField(
+            model_name='catalogitem',
+            name='product',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='catalog_items', to='core.Product', verbose_name='Продукт'),
+        ),
+        migrations.AddField(
+            model_name='catalogitem',
+            name='shop',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='catalog_items', to='core.Shop', verbose_name='Магазин'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogitem',
+            index=models.Index(condition=models.Q(('shop_state', True), ('visible', True)), fields=['product'], name='catalog_product'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogitem',
+            index=models.Index(condition=models.Q(('shop_state', True), ('visible', True)), fields=['category', 'product'], name='catalog_category'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogitem',
+            index=models.Index(condition=models.Q(('shop_state', True), ('visible', True)), fields=['shop', 'product'], name='catalog_shop'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogitem',
+            index=models.Index(condition=models.Q(('shop_state', True), ('visible', True)), fields=['price'], name='catalog_price'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogitem',
+            index=models.Index(fields=['shop', 'generation'], name='catalog_generation'),
+        ),
+    ]
@@ -1,10 +1,14 @@
 from django.conf import settings
 from django.core.validators import MinValueValidator
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
+import json
 
 from rest_auth.models import Contact
 
+from .storage import private_storage
+
 
 STATE_CHOICES = (
     ('basket', _('Статус корзины')),
@@ -16,6 +20,42 @@ STATE_CHOICES = (
     ('canceled', _('Отменен')),
 )
 
+IMPORT_MODE_CHOICES = (
+    ('replace', _('Полная замена прайса')),
+    ('diff', _('Изменения по внешнему ИД')),
+)
+
+IMPORT_ERROR_POLICY_CHOICES = (
+    ('reject', _('Отклонять прайс с ошибками')),
+    ('skip', _('Пропускать товары с ошибками')),
+)
+
+IMPORT_JOB_KIND_CHOICES = (
+    ('partner', _('Прайс поставщика')),
+    ('shops', _('Прайсы всех магазинов')),
+)
+
+IMPORT_JOB_STATE_CHOICES = (
+    ('queued', _('В очереди')),
+    ('running', _('Выполняется')),
+    ('done', _('Выполнено')),
+    ('partial', _('Выполнено частично')),
+    ('failed', _('Ошибка')),
+)
+
+IMPORT_PHASE_CHOICES = (
+    ('fetch', _('Скачивание')),
+    ('decode', _('Разбор')),
+    ('validate', _('Проверка')),
+    ('resolve', _('Поиск в справочниках')),
+    ('write', _('Запись')),
+)
+
+UPLOAD_STATE_CHOICES = (
+    ('open', _('Загружается')),
+    ('finalized', _('Передана в импорт')),
+)
+
 CONTACT_TYPE_CHOICES = (
     ('phone', _('Телефон')),
     ('address', _('Адреса')),
@@ -32,6 +72,22 @@ class Shop(models.Model):
 
     load_url = models.URLField(verbose_name=_('Ссылка'), null=True, blank=True)
     # filename = models.FileField(upload_to='shops/', null=True, blank=True)
+    # Товары с ошибками: весь прайс отклоняется или товары пропускаются
+    # (загрузка частичная, пропущенные товары - в отчете ImportReport):
+    error_policy = models.CharField(verbose_name=_('Товары с ошибками'), choices=IMPORT_ERROR_POLICY_CHOICES,
+                                    max_length=10, default='reject')
+
+    # Сведения о последнем успешно загруженном прайсе (для пропуска неизменившихся прайсов):
+    feed_etag = models.CharField(max_length=255, verbose_name=_('ETag прайса'), blank=True, default='')
+    feed_last_modified = models.CharField(max_length=64, verbose_name=_('Last-Modified прайса'), blank=True, default='')
+    feed_digest = models.CharField(max_length=64, verbose_name=_('Хэш прайса (sha256)'), blank=True, default='')
+    # Размыкатель для недоступных ссылок на прайс:
+    feed_failures = models.PositiveIntegerField(verbose_name=_('Неудачных запросов прайса подряд'), default=0)
+    feed_retry_after = models.DateTimeField(verbose_name=_('Не запрашивать прайс до'), null=True, blank=True)
+    # Поколения прайса: покупателям видны только позиции активного поколения,
+    # полная загрузка пишет новое поколение и затем переключает на него магазин:
+    active_generation = models.PositiveIntegerField(verbose_name=_('Активное поколение прайса'), default=0)
+    last_generation = models.PositiveIntegerField(verbose_name=_('Последнее выданное поколение прайса'), default=0)
 
     class Meta:
         verbose_name = _('Магазин')
@@ -69,6 +125,19 @@ class Product(models.Model):
         return self.name
 
 
+# Позиции каталога, видимые покупателям (см. CatalogItem):
+VISIBLE_CATALOG = models.Q(visible=True, shop_state=True)
+
+
+class ProductInfoQuerySet(models.QuerySet):
+
+    def active(self):
+        """
+        Позиции активных поколений прайсов магазинов
+        """
+        return self.filter(generation=models.F('shop__active_generation'))
+
+
 class ProductInfo(models.Model):
 
     external_id = models.PositiveIntegerField(verbose_name=_('Внешний ИД'), blank=True, null=True)
@@ -79,18 +148,27 @@ class ProductInfo(models.Model):
     quantity = models.PositiveIntegerField(verbose_name=_('Количество'))
     price = models.DecimalField(max_digits=20, decimal_places=2, verbose_name=_('Цена'), validators=[MinValueValidator(0)])
     price_rrc = models.DecimalField(max_digits=20, decimal_places=2, verbose_name=_('Рекомендуемая розничная цена'), validators=[MinValueValidator(0)])
+    generation = models.PositiveIntegerField(verbose_name=_('Поколение прайса'), default=0)
+
+    objects = ProductInfoQuerySet.as_manager()
 
     class Meta:
         verbose_name = _('Информация о продукте')
         verbose_name_plural = _('Информация о продуктах')
         constraints = [
-            models.UniqueConstraint(fields=['product', 'shop'], name='unique_product_info'),
+            models.UniqueConstraint(fields=['product', 'shop', 'generation'], name='unique_product_info'),
+        ]
+        indexes = [
+            models.Index(fields=['shop', 'generation'], name='product_info_generation'),
         ]
 
     def __str__(self):
         return f'{self.shop}: {self.product}'
 
     def save(self, *args, **kwargs):
+        # Позиция, созданная вручную, попадает в активное поколение прайса магазина:
+        if self._state.adding and not self.generation:
+            self.generation = self.shop.active_generation
         category = self.product.category.name
         if not self.shop.categories.filter(name=category).exists():
             print(f'Add category {category}')
@@ -129,6 +207,49 @@ class ProductParameter(models.Model):
         return f'{self.parameter} [ {self.product_info} ]'
 
 
+class CatalogItem(models.Model):
+    """
+    Позиция каталога для покупателей: денормализованная копия позиции прайса
+    с магазином, продуктом, категорией и параметрами в одной строке (см. core.catalog).
+    visible - позиция активного поколения прайса магазина
+    """
+    product_info = models.OneToOneField(ProductInfo, verbose_name=_('Информация о продукте'), primary_key=True,
+                                        related_name='catalog_item', on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop, verbose_name=_('Магазин'), related_name='catalog_items', on_delete=models.CASCADE)
+    shop_name = models.CharField(verbose_name=_('Название магазина'), max_length=50)
+    shop_state = models.BooleanField(verbose_name=_('Магазин получает заказы'), default=True)
+    product = models.ForeignKey(Product, verbose_name=_('Продукт'), related_name='catalog_items',
+                                on_delete=models.CASCADE)
+    product_name = models.CharField(verbose_name=_('Название продукта'), max_length=80)
+    category = models.ForeignKey(Category, verbose_name=_('Категория'), related_name='catalog_items',
+                                 on_delete=models.CASCADE)
+    category_name = models.CharField(verbose_name=_('Название категории'), max_length=40)
+    quantity = models.PositiveIntegerField(verbose_name=_('Количество'))
+    price = models.DecimalField(max_digits=20, decimal_places=2, verbose_name=_('Цена'))
+    price_rrc = models.DecimalField(max_digits=20, decimal_places=2, verbose_name=_('Рекомендуемая розничная цена'))
+    parameters = models.TextField(verbose_name=_('Параметры (json)'), blank=True, default='')
+    generation = models.PositiveIntegerField(verbose_name=_('Поколение прайса'), default=0)
+    visible = models.BooleanField(verbose_name=_('Видна покупателям'), default=False)
+
+    class Meta:
+        verbose_name = _('Позиция каталога')
+        verbose_name_plural = _('Позиции каталога')
+        # Частичные индексы только по видимым позициям - под запросы /products:
+        indexes = [
+            models.Index(fields=['product'], name='catalog_product', condition=VISIBLE_CATALOG),
+            models.Index(fields=['category', 'product'], name='catalog_category', condition=VISIBLE_CATALOG),
+            models.Index(fields=['shop', 'product'], name='catalog_shop', condition=VISIBLE_CATALOG),
+            models.Index(fields=['price'], name='catalog_price', condition=VISIBLE_CATALOG),
+            models.Index(fields=['shop', 'generation'], name='catalog_generation'),
+        ]
+
+    def __str__(self):
+        return f'{self.shop_name}: {self.product_name}'
+
+    def get_parameters(self):
+        return json.loads(self.parameters) if self.parameters else {}
+
+
 class Order(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('Пользователь'),
                              related_name='orders', blank=True,
@@ -177,3 +298,215 @@ class OrderItem(models.Model):
 
     def __str__(self):
         return f'{self.order} / {self.product_info} / {self.quantity}'
+
+
+class ImportJob(models.Model):
+    """
+    Фоновое задание импорта: загрузка прайса поставщика (kind=partner)
+    или общий импорт прайсов всех магазинов (kind=shops).
+    processed/total - число обработанных товаров (магазинов для kind=shops)
+    из общего числа; до окончания загрузки прайса total - оценка
+    """
+    kind = models.CharField(verbose_name=_('Вид задания'), choices=IMPORT_JOB_KIND_CHOICES, max_length=10, default='partner')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('Пользователь'),
+                             related_name='import_jobs', blank=True, null=True,
+                             on_delete=models.CASCADE)
+    url = models.URLField(verbose_name=_('Ссылка'), null=True, blank=True)
+    file = models.FileField(verbose_name=_('Файл'), upload_to='imports/', null=True, blank=True,
+                            storage=private_storage)
+    mode = models.CharField(verbose_name=_('Режим загрузки'), choices=IMPORT_MODE_CHOICES, max_length=10, blank=True, default='')
+    task_id = models.CharField(verbose_name=_('ИД задачи celery'), max_length=50, blank=True, default='')
+    state = models.CharField(verbose_name=_('Статус'), choices=IMPORT_JOB_STATE_CHOICES, max_length=10, default='queued')
+    processed = models.PositiveIntegerField(verbose_name=_('Обработано'), default=0)
+    total = models.PositiveIntegerField(verbose_name=_('Всего'), null=True, blank=True)
+    result = models.TextField(verbose_name=_('Результат (json)'), blank=True, default='')
+    created_at = models.DateTimeField(verbose_name=_('Создано'), auto_now_add=True)
+    finished_at = models.DateTimeField(verbose_name=_('Завершено'), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('Задание импорта')
+        verbose_name_plural = _('Задания импорта')
+        ordering = ('-created_at',)
+
+    def __str__(self):
+        return f'{self.get_kind_display()} #{self.id} ({self.get_state_display()})'
+
+    def start(self, total=None):
+        self.state = 'running'
+        self.total = total
+        self.save(update_fields=('state', 'total', ))
+
+    def finish(self, success, result):
+        """
+        Завершение задания с сохранением результата (словарь, сериализуемый в json).
+        Загрузка с пропущенными товарами (Partial в результате) выполнена частично
+        """
+        if not success:
+            self.state = 'failed'
+        else:
+            self.state = 'partial' if isinstance(result, dict) and result.get('Partial') else 'done'
+        self.result = json.dumps(result, ensure_ascii=False, default=str)
+        self.finished_at = timezone.now()
+        self.save(update_fields=('state', 'result', 'finished_at', 'processed', 'total', ))
+
+    def get_result(self):
+        return json.loads(self.result) if self.result else None
+
+
+class ImportRun(models.Model):
+    """
+    Профиль загрузки прайса: общие показатели и показатели по этапам (ImportRunPhase)
+    """
+    shop = models.ForeignKey(Shop, verbose_name=_('Магазин'), related_name='import_runs', blank=True, null=True,
+                             on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('Пользователь'),
+                             related_name='import_runs', blank=True, null=True,
+                             on_delete=models.CASCADE)
+    job = models.ForeignKey(ImportJob, verbose_name=_('Задание импорта'), related_name='runs', blank=True, null=True,
+                            on_delete=models.SET_NULL)
+    source = models.CharField(verbose_name=_('Источник'), max_length=255, blank=True, default='')
+    status_code = models.PositiveSmallIntegerField(verbose_name=_('Код ответа'), null=True, blank=True)
+    rows = models.PositiveIntegerField(verbose_name=_('Товаров'), default=0)
+    duration = models.FloatField(verbose_name=_('Время, с'), default=0)
+    queries = models.PositiveIntegerField(verbose_name=_('Запросов к базе'), default=0)
+    started_at = models.DateTimeField(verbose_name=_('Начало'))
+
+    class Meta:
+        verbose_name = _('Профиль загрузки прайса')
+        verbose_name_plural = _('Профили загрузки прайсов')
+        ordering = ('-started_at',)
+
+    def __str__(self):
+        return f'{self.source} ({self.started_at})'
+
+
+class ImportRunPhase(models.Model):
+    run = models.ForeignKey(ImportRun, verbose_name=_('Профиль загрузки'), related_name='phases',
+                            on_delete=models.CASCADE)
+    name = models.CharField(verbose_name=_('Этап'), choices=IMPORT_PHASE_CHOICES, max_length=10)
+    duration = models.FloatField(verbose_name=_('Время, с'), default=0)
+    rows = models.PositiveIntegerField(verbose_name=_('Товаров'), default=0)
+    queries = models.PositiveIntegerField(verbose_name=_('Запросов к базе'), default=0)
+    memory_peak = models.BigIntegerField(verbose_name=_('Пик памяти, байт'), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('Этап загрузки прайса')
+        verbose_name_plural = _('Этапы загрузки прайса')
+        constraints = [
+            models.UniqueConstraint(fields=['run', 'name'], name='unique_run_phase'),
+        ]
+
+    def __str__(self):
+        return f'{self.get_name_display()}: {self.duration:.3f} с'
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.duration if self.rows and self.duration else None
+
+
+class ImportReport(models.Model):
+    """
+    Отчет о товарах, пропущенных при частичной загрузке прайса (csv: строка, название, ошибка)
+    """
+    shop = models.ForeignKey(Shop, verbose_name=_('Магазин'), related_name='import_reports', on_delete=models.CASCADE)
+    skipped = models.PositiveIntegerField(verbose_name=_('Пропущено товаров'), default=0)
+    file = models.FileField(verbose_name=_('Файл отчета'), upload_to='import_reports/',
+                            storage=private_storage)
+    created_at = models.DateTimeField(verbose_name=_('Создано'), auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('Отчет об ошибках загрузки')
+        verbose_name_plural = _('Отчеты об ошибках загрузки')
+        ordering = ('-created_at',)
+
+    def __str__(self):
+        return f'{self.shop}: {self.skipped} ({self.created_at})'
+
+
+class UploadSession(models.Model):
+    """
+    Загрузка файла прайса по частям (см. core.upload_sessions).
+    Части с номерами от 0 до chunks - 1 по chunk_size байт (последняя - остаток)
+    записываются на свои места в файле сессии в любом порядке и могут передаваться повторно.
+    checksum - sha256 всего файла (если задан, проверяется при завершении)
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_('Пользователь'),
+                             related_name='upload_sessions', on_delete=models.CASCADE)
+    name = models.CharField(verbose_name=_('Имя файла'), max_length=255)
+    size = models.BigIntegerField(verbose_name=_('Размер, байт'), validators=[MinValueValidator(1)])
+    chunk_size = models.PositiveIntegerField(verbose_name=_('Размер части, байт'), validators=[MinValueValidator(1)])
+    checksum = models.CharField(verbose_name=_('sha256 файла'), max_length=64, blank=True, default='')
+    mode = models.CharField(verbose_name=_('Режим загрузки'), choices=IMPORT_MODE_CHOICES, max_length=10, blank=True, default='')
+    state = models.CharField(verbose_name=_('Статус'), choices=UPLOAD_STATE_CHOICES, max_length=10, default='open')
+    job = models.ForeignKey(ImportJob, verbose_name=_('Задание импорта'), related_name='uploads', blank=True, null=True,
+                            on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(verbose_name=_('Создано'), auto_now_add=True)
+    updated_at = models.DateTimeField(verbose_name=_('Изменено'), auto_now=True)
+
+    class Meta:
+        verbose_name = _('Загрузка прайса по частям')
+        verbose_name_plural = _('Загрузки прайсов по частям')
+        ordering = ('-created_at',)
+
+    def __str__(self):
+        return f'{self.name} #{self.id} ({self.get_state_display()})'
+
+    @property
+    def chunks(self):
+        return -(-self.size // self.chunk_size)
+
+    def chunk_length(self, number):
+        """
+        Размер части number (последняя часть может быть короче)
+        """
+        return min(self.chunk_size, self.size - number * self.chunk_size)
+
+
+class UploadChunk(models.Model):
+    """
+    Принятая часть файла загрузки по частям
+    """
+    session = models.ForeignKey(UploadSession, verbose_name=_('Загрузка'), related_name='received_chunks',
+                                on_delete=models.CASCADE)
+    number = models.PositiveIntegerField(verbose_name=_('Номер части'))
+    checksum = models.CharField(verbose_name=_('sha256 части'), max_length=64)
+
+    class Meta:
+        verbose_name = _('Часть файла')
+        verbose_name_plural = _('Части файлов')
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'number'], name='unique_upload_chunk'),
+        ]
+
+    def __str__(self):
+        return f'{self.session} / {self.number}'
+
+
+class DropFile(models.Model):
+    """
+    Файл прайса в каталоге магазина для автоматической загрузки (см. core.drop_folder).
+    Размер, время изменения и хэш последней обработанной версии файла
+    позволяют не загружать неизменившийся файл повторно
+    """
+    shop = models.ForeignKey(Shop, verbose_name=_('Магазин'), related_name='drop_files', on_delete=models.CASCADE)
+    name = models.CharField(verbose_name=_('Имя файла'), max_length=255)
+    size = models.BigIntegerField(verbose_name=_('Размер, байт'), null=True, blank=True)
+    mtime_ns = models.BigIntegerField(verbose_name=_('Время изменения, нс'), null=True, blank=True)
+    digest = models.CharField(verbose_name=_('sha256 файла'), max_length=64, blank=True, default='')
+    status_code = models.PositiveSmallIntegerField(verbose_name=_('Код ответа'), null=True, blank=True)
+    result = models.TextField(verbose_name=_('Результат (json)'), blank=True, default='')
+    imported_at = models.DateTimeField(verbose_name=_('Загружено'), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('Файл каталога прайсов')
+        verbose_name_plural = _('Файлы каталога прайсов')
+        ordering = ('shop', 'name', )
+        constraints = [
+            models.UniqueConstraint(fields=['shop', 'name'], name='unique_drop_file'),
+        ]
+
+    def __str__(self):
+        return f'{self.shop} / {self.name}'
+
+    def get_result(self):
+        return json.loads(self.result) if self.result else None
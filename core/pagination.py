@@ -0,0 +1,203 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from datetime import datetime
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
+from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils.functional import cached_property
+import hashlib
+import json
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from .catalog import CATALOG_CACHE, catalog_version
+
+
+# Постраничный вывод больших списков (/products, /productparameters, /orders).
+# Два режима, выбираемых в запросе:
+#  - номера страниц (?page=N): число записей для представлений с cache_counts = True
+#    кэшируется до изменения каталога (см. catalog.catalog_version), поэтому
+#    COUNT(*) по каталогу выполняется один раз на загрузку прайса;
+#  - курсор (?paginate=cursor, далее ?cursor=...): страница выбирается по ключу
+#    текущей сортировки и id (например, price > X OR (price = X AND id > Y))
+#    без OFFSET и без подсчета записей - глубокие страницы стоят как первая.
+
+class CursorEncoder(DjangoJSONEncoder):
+    """
+    Кодирование значений ключа курсора (время - с микросекундами, без округления)
+    """
+
+    def default(self, o):
+        if isinstance(o, datetime):
+            return o.isoformat()
+        return super(CursorEncoder, self).default(o)
+
+
+class CachedCountPaginator(Paginator):
+    """
+    Paginator с числом записей, закэшированным для текущей версии каталога
+    (в общем для процессов кэше каталога)
+    """
+
+    @cached_property
+    def count(self):
+        try:
+            sql, params = self.object_list.query.sql_with_params()
+        except EmptyResultSet:
+            # Заведомо пустой запрос (queryset.none())
+            return 0
+        key = hashlib.md5(f'{catalog_version()}:{sql}:{params}'.encode()).hexdigest()
+        key = f'page_count:{key}'
+        cache = caches[CATALOG_CACHE]
+        count = cache.get(key)
+        if count is None:
+            count = super(CachedCountPaginator, self).count
+            cache.set(key, count, settings.CACHE_TIMES['PAGE_COUNTS'])
+        return count
+
+
+def key_value(instance, term):
+    """
+    Значение поля сортировки term ('price', '-dt', 'parameter__name'...) у записи instance
+    """
+    name = term.lstrip('-')
+    if name in ('pk', instance._meta.pk.name):
+        return instance.pk
+    *path, name = name.split('__')
+    for attr in path:
+        instance = getattr(instance, attr)
+    try:
+        return getattr(instance, instance._meta.get_field(name).attname)
+    except FieldDoesNotExist:
+        # Аннотация запроса (например, ранг поиска):
+        return getattr(instance, name)
+
+
+def keyset_filter(keys, values, forward=True):
+    """
+    Условие выбора записей после (forward) или перед позицией values в сортировке keys:
+    (k1 > v1) OR (k1 = v1 AND k2 > v2) OR ... (для убывающих полей - <)
+    """
+    query = Q()
+    equal = Q()
+    for term, value in zip(keys, values):
+        name = term.lstrip('-')
+        lookup = 'gt' if term.startswith('-') != forward else 'lt'
+        query |= equal & Q(**{f'{name}__{lookup}': value})
+        equal &= Q(**{name: value})
+    return query
+
+
+class ListingPagination(PageNumberPagination):
+    """
+    Постраничный вывод номерами страниц или курсором (см. описание модуля)
+    """
+
+    cursor_query_param = 'cursor'
+    mode_query_param = 'paginate'
+
+    keys = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keys = None
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor or request.query_params.get(self.mode_query_param) == 'cursor':
+            return self.paginate_keyset(queryset, request, view, cursor)
+        self.django_paginator_class = CachedCountPaginator if getattr(view, 'cache_counts', False) else Paginator
+        return super(ListingPagination, self).paginate_queryset(queryset, request, view)
+
+    def get_keys(self, queryset, request, view):
+        """
+        Ключ курсора: поля текущей сортировки, дополненные первичным ключом
+        """
+        ordering = None
+        for backend in getattr(view, 'filter_backends', ()):
+            if hasattr(backend, 'get_ordering'):
+                ordering = backend().get_ordering(request, queryset, view)
+        ordering = list(ordering or queryset.query.order_by or queryset.model._meta.ordering)
+        keys = []
+        for term in ordering:
+            keys.append(term)
+            if term.lstrip('-') in ('pk', queryset.model._meta.pk.name):
+                return keys
+        return keys + ['-pk' if keys and keys[0].startswith('-') else 'pk']
+
+    def decode_cursor(self, cursor):
+        try:
+            data = json.loads(urlsafe_b64decode(cursor.encode()).decode())
+            keys, values, forward = data['k'], data['v'], data['f']
+        except (ValueError, TypeError, KeyError):
+            raise NotFound('Неверный курсор')
+        if keys != self.keys or not isinstance(values, list) or len(values) != len(keys):
+            raise NotFound('Курсор не соответствует сортировке')
+        return values, bool(forward)
+
+    def encode_cursor(self, instance, forward):
+        values = [key_value(instance, term) for term in self.keys]
+        data = json.dumps(dict(k=self.keys, v=values, f=int(forward)), cls=CursorEncoder)
+        return urlsafe_b64encode(data.encode()).decode()
+
+    def paginate_keyset(self, queryset, request, view, cursor):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.keys = self.get_keys(queryset, request, view)
+        self.display_page_controls = False
+
+        forward = True
+        if cursor:
+            values, forward = self.decode_cursor(cursor)
+            queryset = queryset.filter(keyset_filter(self.keys, values, forward))
+        keys = self.keys if forward else [term[1:] if term.startswith('-') else '-' + term for term in self.keys]
+        results = list(queryset.order_by(*keys)[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if not forward:
+            results.reverse()
+
+        # Переход назад возможен, если страница получена по курсору вперед,
+        # и наоборот; в направлении движения - если выбрана лишняя запись:
+        self.next_cursor = self.previous_cursor = None
+        if results:
+            if has_more if forward else bool(cursor):
+                self.next_cursor = self.encode_cursor(results[-1], True)
+            if bool(cursor) if forward else has_more:
+                self.previous_cursor = self.encode_cursor(results[0], False)
+        return results
+
+    def get_cursor_link(self, cursor):
+        if cursor is None:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        if self.keys is None:
+            return super(ListingPagination, self).get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_cursor_link(self.next_cursor)),
+            ('previous', self.get_cursor_link(self.previous_cursor)),
+            ('results', data),
+        ]))
+
+    def get_schema_operation_parameters(self, view):
+        return super(ListingPagination, self).get_schema_operation_parameters(view) + [
+            {
+                'name': self.mode_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'cursor - постраничный вывод курсором (без номеров страниц и числа записей)',
+                'schema': {'type': 'string', 'enum': ['cursor']},
+            },
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': 'Курсор страницы (из ссылок next/previous)',
+                'schema': {'type': 'string'},
+            },
+        ]
@@ -1,142 +1,422 @@
+from contextlib import contextmanager, nullcontext
 from decimal import Decimal
+from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.core.files.base import ContentFile
-from django.core.files.uploadedfile import InMemoryUploadedFile as FileClass
+from django.core.files.uploadedfile import UploadedFile
 from django.core.validators import URLValidator
-from rest_framework.exceptions import ParseError
+from django.db import transaction
 from rest_framework.response import Response
-from rest_framework_xml.parsers import XMLParser
 from requests import get, RequestException
+from rest_framework.status import HTTP_304_NOT_MODIFIED
+import hashlib
+import mmap
 import os
-from ujson import loads as load_json
-from yaml import load as load_yaml, Loader, YAMLError
+from tempfile import TemporaryFile
 
-from .models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter
-from .response import ResponseCreated, ResponseBadRequest, ResponseForbidden, ResponseNotFound
-from .utils import to_decimal, to_positive_int, is_dict, is_list
+from .exceptions import FeedError
+from .feed_columns import GoodsColumns
+from .feed_parallel import PARALLEL_READERS, SegmentPool, parallel_workers
+from .feed_compression import ACCEPT_ENCODING, decompressed, split_extension
+from .feed_fetcher import remove_fetched
+from .feed_readers import Feed, FEED_READERS, READ_CHUNK_SIZE
+from .feed_validator import GoodsValidator
+from .import_profiler import add_phase, iterate, phase, profiled, set_run_info
+from .import_report import ErrorReport
+from .import_writer import CATALOG_WRITERS
+from .models import Shop
+from .response import ResponseOK, ResponseCreated, ResponseBadRequest, ResponseForbidden, ResponseNotFound
+from .utils import is_dict, is_list
 
 
-def load_xml(stream):
+MIME_FORMATS = {
+    'application/yaml': 'yaml',
+    'text/yaml': 'yaml',
+    'application/json': 'json',
+    'text/json': 'json',
+    'application/xml': 'xml',
+    'text/xml': 'xml',
+}
+
+EXTENSION_FORMATS = {
+    '.yaml': 'yaml',
+    '.json': 'json',
+    '.xml': 'xml',
+    # Прайс Яндекс.Маркета (xml с корнем yml_catalog, см. feed_readers.iter_yml_feed):
+    '.yml': 'xml',
+}
+
+
+def get_feed_format(mime, extension):
     """
-    Parses the incoming bytestream as XML and returns the resulting data.
+    Определение формата прайса по mime типу или расширению файла
+    (для сжатого файла - по расширению перед расширением сжатия, см. split_extension)
     """
+    mime = (mime or '').split(';')[0].strip()
+    return MIME_FORMATS.get(mime) or EXTENSION_FORMATS.get(extension)
 
-    return XMLParser().parse(ContentFile(stream))
+
+def feed_digest(chunks, copy_to=None):
+    """
+    Подсчет sha256 содержимого прайса, читаемого порциями chunks
+    (с копированием в файл copy_to, если он задан)
+    """
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(chunk)
+        if copy_to is not None:
+            copy_to.write(chunk)
+    return digest.hexdigest()
 
 
-def load_partner_info(url=None, file_obj=None, user_id=0):
+def import_digest(digest, mode, error_policy):
     """
-    Обновление прайса от поставщика
+    Ключ повторной загрузки, сохраняемый в Shop.feed_digest: хэш содержимого прайса
+    вместе с режимом загрузки и политикой ошибок магазина. Тот же прайс в другом
+    режиме или с другой политикой ошибок загружается заново
     """
+    return hashlib.sha256(f'{digest}:{mode}:{error_policy}'.encode()).hexdigest()
 
-    if not url and not (file_obj and isinstance(file_obj, FileClass)):
-        return ResponseBadRequest('Не указаны все необходимые аргументы. Нужно указать url или загрузить файл')
-    if file_obj:
-        stream = file_obj.read()
-        _, extension = os.path.splitext(file_obj.name)
-        mime = ''
-    else:
-        validate_url = URLValidator()
-        try:
-            validate_url(url)
-        except ValidationError as e:
-            return ResponseBadRequest(e)
 
-        try:
-            response = get(url)
-            response.raise_for_status()
-        except RequestException as e:
-            return ResponseNotFound(e)
-        _, extension = os.path.splitext(url)
-        stream = response.content
-        mime = response.headers.get('content-type')
-    try:
-        if mime in ('application/yaml', 'text/yaml'):
-            data = load_yaml(stream, Loader=Loader)
-        elif mime in ('application/json', 'text/json'):
-            data = load_json(stream)
-        elif mime in ('application/xml', 'text/xml'):
-            data = load_xml(stream)
-        elif extension == '.yaml':
-            data = load_yaml(stream, Loader=Loader)
-        elif extension == '.json':
-            data = load_json(stream)
-        elif extension == '.xml':
-            data = load_xml(stream)
-        else:
-            return ResponseBadRequest('Не опознан формат файла {}', url)
-    except (ParseError, YAMLError, ValueError, TypeError) as e:
-        return ResponseBadRequest('Некорректный формат файла: {}', e)
-
-    # Check format:
-    if not is_dict(data):
-        return ResponseBadRequest('Некорректный формат файла: исходные данные должны представлять собой словарь')
-    version = data.get('version')
-    if not version or version != 'v1.0':
-        return ResponseBadRequest('Некорректный формат файла: не поддерживается версия {}', version)
-    if not data.get('shop'):
-        return ResponseBadRequest('Некорректный формат файла: не задано/некорректное название магазина')
-    categories = data.get('categories', [])
+def conditional_headers(shop):
+    """
+    Заголовки условного запроса прайса по сведениям о последней загрузке
+    """
+    headers = {}
+    if shop.feed_etag:
+        headers['If-None-Match'] = shop.feed_etag
+    if shop.feed_last_modified:
+        headers['If-Modified-Since'] = shop.feed_last_modified
+    return headers
+
+
+# Поддерживаемые версии формата прайса: v1.0 - список товаров,
+# v2.0 - товары по столбцам (см. feed_columns)
+FEED_VERSIONS = ('v1.0', 'v2.0', )
+
+
+def check_header(header):
+    """
+    Проверка заголовка прайса (версия, магазин)
+    """
+    version = header.get('version')
+    if not version or version not in FEED_VERSIONS:
+        raise FeedError('Некорректный формат файла: не поддерживается версия {}', version)
+    if not header.get('shop'):
+        raise FeedError('Некорректный формат файла: не задано/некорректное название магазина')
+
+
+def check_categories(categories):
+    """
+    Проверка списка категорий прайса
+    """
     if not is_list(categories):
-        return ResponseBadRequest('Некорректный формат файла: категории должны быть заданы в списке')
+        raise FeedError('Некорректный формат файла: категории должны быть заданы в списке')
     for category in categories:
         if not is_dict(category):
-            return ResponseBadRequest('Некорректный формат файла: категории должны быть описаны как словарь') 
+            raise FeedError('Некорректный формат файла: категории должны быть описаны как словарь')
         if not category.get('name'):
-            return ResponseBadRequest('Некорректный формат файла: не задано/некорректное название категории')
-    goods = data.get('goods', [])
-    if not is_list(goods):
-        return ResponseBadRequest('Некорректный формат файла: товары должны быть заданы в списке')
-    names = set()
-    for item in goods:
-        if not is_dict(item):
-            return ResponseBadRequest('Некорректный формат файла: товары должны быть описаны как словарь') 
-        name = item.get('name')
-        category = item.get('category')
-        price = to_decimal(item.get('price'))
-        price_rrc = to_decimal(item.get('price_rrc'))
-        quantity = to_positive_int(item.get('quantity'))
-        if not name or not category or None in (price, price_rrc, quantity):
-            return ResponseBadRequest('Некорректный формат файла: некорректно указана информация по продукту {}', name)
-        if name in names:
-            return ResponseBadRequest('Некорректный формат файла: продукты с одинаковым именем')
-        names.add(name)
-        parameters = item.get('parameters')
-        if parameters is not None:
-            if not is_list(parameters):
-                return ResponseBadRequest('Некорректный формат файла: параметры для продукта {} должны быть заданы как массив полей name и value', name)
-            parameter_names = set()
-            for entry in parameters:
-                if not is_dict(entry):
-                    return ResponseBadRequest('Некорректный формат файла: параметр для продукта должен быть описан как словарь (продукт {})', name)
-                par_name = entry.get('name')
-                if not par_name or entry.get('value') is None:
-                    return ResponseBadRequest('Некорректный формат файла: параметры для продукта {} должны иметь не пустые значения name и value', name)
-                if par_name in parameter_names:
-                    return ResponseBadRequest('Некорректный формат файла: параметры с одинаковым именем у продукта {}', name)
-                parameter_names.add(par_name)
-    # Actions:
-    shop, _ = Shop.objects.get_or_create(name=data['shop'], defaults=dict(user_id=user_id))
+            raise FeedError('Некорректный формат файла: не задано/некорректное название категории')
+
+
+def import_feed(feed, user_id, mode, source, progress=None, pool=None):
+    """
+    Проверка и запись прайса, читаемого из потока.
+    source - сведения об источнике прайса (хэш, ETag, Last-Modified),
+    сохраняемые в магазине после успешной загрузки (хэш - вместе с режимом
+    загрузки, см. import_digest) и сбрасываемые после неудачной.
+    progress - функция для отслеживания числа записанных товаров (см. CatalogWriter).
+    При ошибке в середине прайса уже записанные пачки удаляются (writer.discard)
+    или откатываются вместе с транзакцией (для писателей с atomic=True).
+    Для магазина с политикой error_policy=skip товары с ошибками пропускаются:
+    загрузка частичная (Partial), пропущенные товары - в отчете ImportReport.
+    pool - пул процессов для разбора товаров прайса, читаемого сегментами (см. feed_parallel)
+    """
+    check_header(feed.header)
+    shop, _ = Shop.objects.get_or_create(name=feed.header['shop'], defaults=dict(user_id=user_id))
     if shop.user_id != user_id:
         return ResponseForbidden('Магазин не принадлежит пользователю')
-    for category in data.get('categories', []):
-        category_object, _ = Category.objects.get_or_create(name=category['name'])
-        category_object.shops.add(shop.id)
-        category_object.save()
-    ProductInfo.objects.filter(shop_id=shop.id).delete()
-    for item in data.get('goods', []):           
-        category_object, _ = Category.objects.get_or_create(name=item['category'])
-        product, _ = Product.objects.get_or_create(name=item['name'], category_id=category_object.id)
-
-        product_info = ProductInfo.objects.create(product_id=product.id,
-                                                  external_id=item.get('id'),
-                                                  price=item['price'],
-                                                  price_rrc=item['price_rrc'],
-                                                  quantity=item['quantity'],
-                                                  shop_id=shop.id)
-        for entry in item.get('parameters', []):
-            parameter_object, _ = Parameter.objects.get_or_create(name=entry.get('name'))
-            ProductParameter.objects.create(product_info_id=product_info.id,
-                                            parameter_id=parameter_object.id,
-                                            value=entry.get('value'))
-    return ResponseCreated()
+    set_run_info(shop=shop)
+    source = dict(source, feed_digest=import_digest(source['feed_digest'], mode, shop.error_policy))
+    if shop.feed_digest == source['feed_digest']:
+        Shop.objects.filter(id=shop.id).update(**source)
+        return ResponseOK(NotModified=True)
+    writer = CATALOG_WRITERS[mode](shop, progress=progress)
+    report = ErrorReport() if shop.error_policy == 'skip' else None
+    writer.clear()
+    try:
+        validator = GoodsValidator(batch_size=writer.batch_size, skip_invalid=report is not None, report=report)
+        if feed.header['version'] == 'v2.0':
+            with phase('decode'):
+                columns = GoodsColumns(feed.columns(), feed.header.get('categories'))
+            add_phase('decode', 0, len(columns))
+            batches = validator.column_batches(columns)
+        elif pool is not None:
+            batches = validator.checked_batches(pool.goods(feed))
+        else:
+            batches = validator.batches(iterate('decode', feed.goods()))
+        for batch in batches:
+            # После первой ошибки товары только проверяются, чтобы вернуть все ошибки сразу
+            # (при частичной загрузке товары с ошибками уже исключены из пачки):
+            if validator.writable:
+                writer.extend(batch)
+        # Прайс без единого корректного товара не загружается и частично:
+        if not validator.skip_invalid or validator.error_count == validator.rows:
+            validator.raise_errors()
+        # Категории могут идти в документе после товаров:
+        categories = feed.header.get('categories', [])
+        check_categories(categories)
+        writer.add_categories(category['name'] for category in categories)
+        result = writer.close()
+        if validator.error_count:
+            result.update(partial=True, skipped=validator.error_count, report=report.save(shop).id,
+                          rows=validator.errors)
+    except BaseException:
+        writer.discard()
+        # После неудачной загрузки тот же прайс загружается заново (по ссылке - без
+        # условного запроса), даже если он совпадает с последним загруженным
+        # (в транзакции сброс откатывается вместе с записанными пачками):
+        Shop.objects.filter(id=shop.id).update(feed_digest='', feed_etag='', feed_last_modified='')
+        raise
+    finally:
+        if report is not None:
+            report.close()
+    Shop.objects.filter(id=shop.id).update(**source)
+    return ResponseCreated(**{key.capitalize(): value for key, value in result.items()})
+
+
+@contextmanager
+def mapped_stream(stream):
+    """
+    Поток для разбора прайса из файла на диске: файл отображается в память (mmap),
+    парсер читает страницы файла без копирования через буферы файлового объекта,
+    и память процесса не растет с размером файла.
+    Поток без файла на диске (например, InMemoryUploadedFile) возвращается как есть
+    """
+    try:
+        stream.flush()
+        fileno = stream.fileno()
+        mapped = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) if os.fstat(fileno).st_size else None
+    except (AttributeError, OSError, ValueError):
+        mapped = None
+    if mapped is None:
+        yield stream
+        return
+    try:
+        if hasattr(mapped, 'madvise'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        yield mapped
+    finally:
+        mapped.close()
+
+
+def file_digest(stream):
+    """
+    Подсчет sha256 файла: файл на диске хэшируется через mmap
+    без копирования содержимого в буферы файлового объекта
+    """
+    with mapped_stream(stream) as mapped:
+        if isinstance(mapped, mmap.mmap):
+            return hashlib.sha256(mapped).hexdigest()
+        return feed_digest(iter(lambda: mapped.read(READ_CHUNK_SIZE), b''))
+
+
+def stream_size(stream):
+    """
+    Размер потока в байтах (без изменения текущей позиции)
+    """
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+
+def stream_progress(stream, progress):
+    """
+    Отслеживание загрузки прайса из файла: progress(processed, total) вызывается
+    с числом записанных товаров и оценкой их общего числа по прочитанной доле файла
+    """
+    size = stream_size(stream)
+
+    def report(processed):
+        read = stream.tell()
+        progress(processed, processed * size // read if 0 < read < size else processed)
+
+    return report
+
+
+def import_stream(stream, feed_format, user_id, mode, source, progress=None, parallel=True):
+    """
+    Загрузка прайса из потока. Инкрементальная загрузка выполняется в одной
+    транзакции, полная - пачками с переключением поколения прайса в конце
+    (см. CatalogWriter).
+    Сжатый прайс распаковывается по мере чтения (см. feed_compression),
+    прайс из файла на диске читается через mmap (см. mapped_stream).
+    Большой прайс разбирается параллельно в нескольких процессах (см. feed_parallel),
+    при ошибке разбора (не товаров) он разбирается заново последовательно (parallel=False):
+    так ошибка сегмента отличается от ошибки документа и описывается позицией в документе.
+    progress - функция progress(processed, total) для отслеживания загрузки
+    """
+    try:
+        position = stream.tell()
+        workers = parallel_workers(feed_format, stream_size(stream)) if parallel else 0
+        try:
+            with mapped_stream(stream) as mapped, \
+                    transaction.atomic() if CATALOG_WRITERS[mode].atomic else nullcontext(), \
+                    SegmentPool(workers) if workers else nullcontext() as pool:
+                report = stream_progress(mapped, progress) if progress else None
+                with phase('decode'):
+                    reader = PARALLEL_READERS[feed_format] if pool else FEED_READERS[feed_format]
+                    feed = Feed(reader(decompressed(mapped)))
+                return import_feed(feed, user_id, mode, source, report, pool)
+        except FeedError as e:
+            if not workers or e.rows:
+                raise
+        stream.seek(position)
+        return import_stream(stream, feed_format, user_id, mode, source, progress, parallel=False)
+    except FeedError as e:
+        return ResponseBadRequest(e.error, e.format, **({'Rows': e.rows} if e.rows else {}))
+
+
+def get_import_mode(mode):
+    """
+    Режим загрузки прайса (по умолчанию - из настройки PRICE_IMPORT['MODE']).
+    Для неизвестного режима возвращается None
+    """
+    mode = mode or settings.PRICE_IMPORT['MODE']
+    return mode if mode in CATALOG_WRITERS else None
+
+
+@profiled
+def load_fetched_feed(fetched, user_id, mode=None, progress=None):
+    """
+    Загрузка прайса, скачанного feed_fetcher.fetch_feeds.
+    Временный файл прайса удаляется после загрузки
+    """
+    set_run_info(user_id=user_id or None, source=fetched['url'][:255])
+    add_phase('fetch', fetched.get('elapsed') or 0)
+    try:
+        if not get_import_mode(mode):
+            return ResponseBadRequest('Неизвестный режим загрузки {}', mode)
+        if fetched['error']:
+            return ResponseNotFound('Не удалось скачать прайс {}', fetched['error'])
+        if fetched['status'] == HTTP_304_NOT_MODIFIED:
+            return ResponseOK(NotModified=True)
+        extension, _ = split_extension(fetched['url'])
+        feed_format = get_feed_format(fetched['content_type'], extension)
+        if not feed_format:
+            return ResponseBadRequest('Не опознан формат файла {}', fetched['url'])
+        source = dict(feed_digest=fetched['digest'],
+                      feed_etag=fetched['etag'][:255],
+                      feed_last_modified=fetched['last_modified'][:64])
+        with open(fetched['path'], 'rb') as stream:
+            return import_stream(stream, feed_format, user_id, get_import_mode(mode), source, progress)
+    finally:
+        remove_fetched(fetched)
+
+
+@profiled
+def load_partner_file(file_obj, user_id=0, mode=None, progress=None):
+    """
+    Обновление прайса поставщика из файла, загруженного через http
+    или сохраненного для фонового задания импорта.
+    Большие загрузки Django сохраняет во временный файл (TemporaryUploadedFile,
+    см. FILE_UPLOAD_MAX_MEMORY_SIZE): прайс разбирается прямо из этого файла
+    """
+    set_run_info(user_id=user_id or None, source=os.path.basename(file_obj.name)[:255])
+    if not get_import_mode(mode):
+        return ResponseBadRequest('Неизвестный режим загрузки {}', mode)
+    extension, _ = split_extension(file_obj.name)
+    feed_format = get_feed_format('', extension)
+    if not feed_format:
+        return ResponseBadRequest('Не опознан формат файла {}', file_obj.name)
+    with phase('fetch'):
+        source = dict(feed_digest=feed_digest(file_obj.chunks()), feed_etag='', feed_last_modified='')
+    stream = file_obj.file
+    stream.seek(0)
+    return import_stream(stream, feed_format, user_id, get_import_mode(mode), source, progress)
+
+
+@profiled
+def load_local_file(path, user_id=0, mode=None, digest=None, progress=None):
+    """
+    Обновление прайса поставщика из файла на локальном диске (см. drop_folder).
+    Файл читается через mmap (см. mapped_stream).
+    digest - уже подсчитанный хэш содержимого файла (см. file_digest)
+    """
+    set_run_info(user_id=user_id or None, source=os.path.basename(path)[:255])
+    if not get_import_mode(mode):
+        return ResponseBadRequest('Неизвестный режим загрузки {}', mode)
+    extension, _ = split_extension(path)
+    feed_format = get_feed_format('', extension)
+    if not feed_format:
+        return ResponseBadRequest('Не опознан формат файла {}', os.path.basename(path))
+    with open(path, 'rb') as stream:
+        if digest is None:
+            with phase('fetch'):
+                digest = file_digest(stream)
+        source = dict(feed_digest=digest, feed_etag='', feed_last_modified='')
+        return import_stream(stream, feed_format, user_id, get_import_mode(mode), source, progress)
+
+
+@profiled
+def load_partner_info(url=None, file_obj=None, user_id=0, mode=None, shop=None, progress=None):
+    """
+    Обновление прайса от поставщика.
+    mode - режим загрузки: replace (полная замена) или diff (только изменения
+    по внешнему ИД), по умолчанию берется из настройки PRICE_IMPORT['MODE'].
+    shop - магазин, прайс которого обновляется по его ссылке load_url:
+    прайс запрашивается условным запросом (If-None-Match/If-Modified-Since).
+    Неизменившийся прайс (ответ 304 или совпадение хэша содержимого
+    с последней загрузкой) не записывается в базу.
+    progress - функция progress(processed, total) для отслеживания загрузки.
+    Показатели загрузки по этапам сохраняются в ImportRun (см. import_profiler)
+    """
+    set_run_info(user_id=user_id or None, source=(url or '')[:255])
+
+    if not get_import_mode(mode):
+        return ResponseBadRequest('Неизвестный режим загрузки {}', mode)
+    if not url and not (file_obj and isinstance(file_obj, UploadedFile)):
+        return ResponseBadRequest('Не указаны все необходимые аргументы. Нужно указать url или загрузить файл')
+    if file_obj:
+        return load_partner_file(file_obj, user_id, mode, progress)
+
+    validate_url = URLValidator()
+    try:
+        validate_url(url)
+    except ValidationError as e:
+        return ResponseBadRequest(e)
+
+    headers = conditional_headers(shop) if shop and shop.load_url == url else {}
+    headers['Accept-Encoding'] = ACCEPT_ENCODING
+    try:
+        with phase('fetch'):
+            response = get(url, stream=True, headers=headers,
+                           timeout=(settings.PRICE_IMPORT['FETCH_CONNECT_TIMEOUT'],
+                                    settings.PRICE_IMPORT['FETCH_READ_TIMEOUT']))
+        response.raise_for_status()
+    except RequestException as e:
+        return ResponseNotFound(e)
+    if response.status_code == HTTP_304_NOT_MODIFIED:
+        response.close()
+        return ResponseOK(NotModified=True)
+    extension, _ = split_extension(url)
+    mime = response.headers.get('content-type')
+
+    try:
+        feed_format = get_feed_format(mime, extension)
+        if not feed_format:
+            return ResponseBadRequest('Не опознан формат файла {}', url)
+        # Прайс скачивается во временный файл: хэш содержимого известен до записи в базу
+        with TemporaryFile() as stream:
+            with phase('fetch'):
+                digest = feed_digest(response.iter_content(READ_CHUNK_SIZE), stream)
+            source = dict(feed_digest=digest,
+                          feed_etag=response.headers.get('ETag', '')[:255],
+                          feed_last_modified=response.headers.get('Last-Modified', '')[:64])
+            stream.seek(0)
+            return import_stream(stream, feed_format, user_id, get_import_mode(mode), source, progress)
+    except RequestException as e:
+        return ResponseNotFound(e)
+    finally:
+        response.close()
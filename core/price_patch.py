@@ -0,0 +1,53 @@
+from django.db import transaction
+from django.db.models import Case, Value, When
+
+from .catalog import refresh_items, touch_suggest
+from .models import Shop, ProductInfo
+from .utils import chunked
+
+
+# Быстрое обновление остатков и цен без загрузки всего прайса.
+# Изменения {external_id, quantity?, price?, price_rrc?} применяются к позициям
+# активного поколения прайса магазина запросами вида
+#   UPDATE ... SET quantity = CASE external_id WHEN ... THEN ... END WHERE external_id IN (...)
+# - по одному запросу на поле и порцию ИД, все порции в одной транзакции.
+
+PATCH_FIELDS = ('quantity', 'price', 'price_rrc', )
+
+# Число ИД в одном запросе: CASE добавляет по два параметра на ИД,
+# IN - еще один (у sqlite есть лимит на число параметров в запросе)
+PATCH_CHUNK_SIZE = 300
+
+
+def apply_patch(shop, items):
+    """
+    Применение изменений items (проверенные словари с external_id и изменяемыми полями)
+    к прайсу магазина shop. Для повторяющегося external_id действует последнее изменение.
+    Сведения о последнем загруженном прайсе сбрасываются: тот же прайс будет загружен заново.
+    Возвращает число обновленных позиций и список ненайденных external_id
+    """
+    changes = {item['external_id']: item for item in items}
+    updated = 0
+    found = set()
+    info_ids = []
+    with transaction.atomic():
+        # Блокировка магазина: поколение прайса не переключается до конца обновления
+        shop = Shop.objects.select_for_update().get(id=shop.id)
+        queryset = ProductInfo.objects.filter(shop_id=shop.id, generation=shop.active_generation)
+        for chunk in chunked(list(changes), PATCH_CHUNK_SIZE):
+            infos = list(queryset.filter(external_id__in=chunk).values_list('external_id', 'id'))
+            found.update(external_id for external_id, _ in infos)
+            info_ids.extend(info_id for _, info_id in infos)
+            updated += len(infos)
+            for field in PATCH_FIELDS:
+                values = {external_id: changes[external_id][field] for external_id in chunk
+                          if field in changes[external_id]}
+                if not values:
+                    continue
+                queryset.filter(external_id__in=list(values)).update(**{field: Case(
+                    *(When(external_id=external_id, then=Value(value)) for external_id, value in values.items()),
+                    output_field=ProductInfo._meta.get_field(field))})
+        refresh_items(info_ids)
+        touch_suggest()
+        Shop.objects.filter(id=shop.id).update(feed_digest='', feed_etag='', feed_last_modified='')
+    return updated, [external_id for external_id in changes if external_id not in found]
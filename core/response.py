@@ -18,6 +18,12 @@ def ResponseCreated(**kwargs):
         response.update(kwargs)
     return Response(response, status=http_status.HTTP_201_CREATED)
 
+def ResponseAccepted(**kwargs):
+    response = {'Status': True}
+    if kwargs:
+        response.update(kwargs)
+    return Response(response, status=http_status.HTTP_202_ACCEPTED)
+
 def UniversalResponse(error=None, format=None, status=418, **kwargs):
     response = {'Status': False}
     if error:
@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+@deconstructible
+class PrivateStorage(FileSystemStorage):
+    """
+    Хранилище файлов в PRIVATE_ROOT: прайсы поставщиков и отчеты загрузок.
+    В отличие от MEDIA_ROOT каталог не раздается по ссылкам, файлы выдаются
+    только представлениями с проверкой прав
+    """
+
+    def __init__(self):
+        super(PrivateStorage, self).__init__(location=settings.PRIVATE_ROOT)
+
+
+private_storage = PrivateStorage()
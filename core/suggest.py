@@ -0,0 +1,152 @@
+from bisect import bisect_left
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, Sum
+import logging
+import numpy as np
+import threading
+import time
+
+from .catalog import SUGGEST_VERSION_KEY, catalog_version
+from .fuzzy_search import normalize
+from .models import CatalogItem, VISIBLE_CATALOG
+
+
+# Подсказки при вводе поискового запроса (/products/suggest?q=...).
+# Индекс хранится в памяти процесса: отсортированный список ключей - названий продуктов
+# и категорий видимого каталога, начиная с каждого слова ("смартфон apple iphone",
+# "apple iphone", "iphone"), - и массивы номера записи для каждого ключа и веса записи
+# в порядке ключей. Ключи с началом q занимают непрерывный диапазон списка (bisect),
+# лучшие по весу записи диапазона выбираются numpy.argpartition.
+# Вес продукта - его остаток во всех магазинах, категории - число ее продуктов в наличии.
+# Подсказки не обращаются к базе: индекс пересобирается одним запросом на тип записей,
+# когда меняется версия каталога для подсказок (core.catalog.touch_suggest - один раз
+# на загрузку прайса), которая проверяется не чаще CATALOG_SEARCH['SUGGEST_SYNC_INTERVAL']
+# секунд. Версия хранится в общем для процессов кэше каталога (CACHES['catalog']):
+# загрузка прайса в задаче celery сбрасывает подсказки во всех процессах сайта. Пересборка идет в фоновом потоке, запросы до ее окончания получают подсказки
+# по прежнему индексу; только первый индекс процесса собирается при запросе.
+
+# Результаты запросов, под которые попадает больше ключей, запоминаются до пересборки
+# индекса (короткие запросы вида "с", "см" - при каждом нажатии клавиши)
+MEMO_RANGE = 1000
+
+PRODUCT = 'product'
+CATEGORY = 'category'
+
+logger = logging.getLogger(__name__)
+
+
+class SuggestIndex(object):
+    """
+    Префиксный индекс названий продуктов и категорий (см. описание модуля)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.checked_at = None
+        self.thread = None
+        self.data = self.build([])
+
+    def build(self, records):
+        """
+        Данные индекса по записям (вид, id, название, вес): ключи, номера записей ключей,
+        веса записей ключей, записи (вид, id, название), запомненные результаты
+        """
+        keys = []
+        for number, (kind, record_id, name, weight) in enumerate(records):
+            words = normalize(name).split()
+            for start in range(len(words)):
+                keys.append((' '.join(words[start:]), number))
+        keys.sort()
+        numbers = np.array([number for _, number in keys], dtype=np.intp)
+        weights = np.array([weight for _, _, _, weight in records], dtype=np.float64)
+        return ([key for key, _ in keys], numbers, weights[numbers],
+                [(kind, record_id, name) for kind, record_id, name, _ in records], {})
+
+    def load(self):
+        """
+        Записи видимого каталога: продукты с остатками и категории с числом продуктов в наличии
+        """
+        catalog = CatalogItem.objects.filter(VISIBLE_CATALOG).order_by()
+        products = catalog.values_list('product_id', 'product_name').annotate(weight=Sum('quantity'))
+        categories = catalog.filter(quantity__gt=0).values_list('category_id', 'category_name').annotate(
+            weight=Count('product_id', distinct=True))
+        return [(PRODUCT, record_id, name, weight or 0) for record_id, name, weight in products] + \
+            [(CATEGORY, record_id, name, weight) for record_id, name, weight in categories]
+
+    def sync(self):
+        """
+        Пересборка индекса, если каталог изменился: первого - сразу,
+        следующих - в фоновом потоке (см. описание модуля)
+        """
+        now = time.monotonic()
+        if self.checked_at is not None and now - self.checked_at < settings.CATALOG_SEARCH['SUGGEST_SYNC_INTERVAL']:
+            return
+        version = catalog_version(SUGGEST_VERSION_KEY)
+        if version != self.version:
+            with self.lock:
+                if self.version is None:
+                    self.rebuild(version)
+                elif version != self.version and not (self.thread and self.thread.is_alive()):
+                    self.thread = threading.Thread(target=self.rebuild_in_background, args=(version, ),
+                                                   name='suggest-rebuild', daemon=True)
+                    self.thread.start()
+        self.checked_at = now
+
+    def rebuild(self, version):
+        """
+        Пересборка индекса по каталогу версии version
+        """
+        self.data = self.build(self.load())
+        self.version = version
+
+    def rebuild_in_background(self, version):
+        """
+        Пересборка индекса в фоновом потоке. При ошибке остается прежний индекс,
+        пересборка повторяется при следующей проверке версии каталога
+        """
+        try:
+            self.rebuild(version)
+        except Exception:
+            logger.exception('Error rebuilding suggest index')
+        finally:
+            # Соединение с базой открыто потоком, Django его не закроет:
+            connection.close()
+
+    def suggest(self, query, limit=None):
+        """
+        Записи (вид, id, название) с названием, слово которого начинается с query,
+        от больших весов к меньшим
+        """
+        self.sync()
+        limit = limit or settings.CATALOG_SEARCH['SUGGEST_LIMIT']
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        # Данные индекса заменяются целиком, поэтому запрос работает с ними без блокировки:
+        keys, numbers, weights, records, memo = self.data
+        if (prefix, limit) in memo:
+            return memo[prefix, limit]
+        start = bisect_left(keys, prefix)
+        end = bisect_left(keys, prefix + '\uffff', start)
+        # Запись может попасть в диапазон несколькими ключами (словами), поэтому
+        # выбирается с запасом:
+        count = min(end - start, limit * 3)
+        if not count:
+            return []
+        found = -weights[start:end]
+        best = np.argpartition(found, count - 1)[:count] if end - start > count else np.arange(end - start)
+        best = best[np.lexsort((best, found[best]))]
+        result = []
+        for number in dict.fromkeys(numbers[start + best].tolist()):
+            result.append(records[number])
+            if len(result) == limit:
+                break
+        if end - start > MEMO_RANGE:
+            memo[prefix, limit] = result
+        return result
+
+
+# Индекс процесса
+suggest_index = SuggestIndex()
@@ -1,14 +1,24 @@
+from celery import chord
 from django.conf import settings
 from django.core.mail import send_mail as core_send_mail
 from django.core.mail import EmailMultiAlternatives
+from django.db.models import F
 from django.utils.translation import gettext_lazy as t
 import logging
+import os
 from rest_framework.status import is_success
 
 from orders.celery import app
 
-from .models import Shop
-from .partner_info_loader import load_partner_info
+from .feed_compression import ACCEPT_ENCODING
+from .drop_folder import scan_drop_folder
+from .feed_fetcher import fetch_feeds, remove_fetched, CircuitBreaker
+from .import_profiler import profile_import
+from .models import Shop, ImportJob
+from .partner_info_loader import load_partner_info, load_partner_file, load_fetched_feed, conditional_headers
+
+
+logger = logging.getLogger(__name__)
 
 
 @app.task
@@ -31,43 +41,188 @@ def send_multi_alternative(subject='', body='', from_email=None, to=None, bcc=No
     msg.send()
 
 
+def report_import_error(user):
+    send_multi_alternative.delay(
+        # title:
+        t('Не удалось обновить прайс'),
+        # message:
+        t('Произошла ошибка при обновлении прайса'),
+        # from:
+        settings.EMAIL_HOST_USER,
+        # to:
+        [user.email]
+    )
+
+
+def report_import_success(user):
+    send_multi_alternative.delay(
+        # title:
+        t('Обновление прайс листов завершено'),
+        # message:
+        t('Все возможные прайс листы обновлены'),
+        # from:
+        settings.EMAIL_HOST_USER,
+        # to:
+        [user.email]
+    )
+
+
+@app.task(bind=True)
+def run_import_job(self, job_id):
+    """
+    Фоновая загрузка прайса поставщика (задание ImportJob kind=partner).
+    Ход загрузки публикуется в состоянии задачи celery PROGRESS,
+    т.к. до окончания транзакции загрузки изменения задания в базе не видны
+    """
+    job = ImportJob.objects.select_related('user').get(id=job_id)
+    job.start()
+
+    def progress(processed, total):
+        job.processed, job.total = processed, total
+        if self.request.id:
+            self.update_state(state='PROGRESS', meta=dict(processed=processed, total=total))
+
+    try:
+        with profile_import(job_id=job.id):
+            if job.file:
+                with job.file.open('rb'):
+                    response = load_partner_file(job.file, job.user_id, job.mode, progress)
+            else:
+                response = load_partner_info(job.url, None, job.user_id, job.mode, progress=progress)
+    except Exception as e:
+        logger.exception(f'Error importing price list: job_id={job_id}')
+        job.finish(False, dict(Status=False, Errors=str(e)))
+    else:
+        success = is_success(response.status_code)
+        if success:
+            job.total = job.processed
+        job.finish(success, response.data)
+    finally:
+        if job.file:
+            job.file.delete()
+    return job.state
+
+
 @app.task
-def do_import():
-
-    def report_error(user):
-        send_multi_alternative.delay(
-            # title:
-            t('Не удалось обновить прайс'),
-            # message:
-            t('Произошла ошибка при обновлении прайса'),
-            # from:
-            settings.EMAIL_HOST_USER,
-            # to:
-            [user.email]
-        )
-
-    def report_success(user):
-        send_multi_alternative.delay(
-            # title:
-            t('Обновление прайс листов завершено'),
-            # message:
-            t('Все возможные прайс листы обновлены'),
-            # from:
-            settings.EMAIL_HOST_USER,
-            # to:
-            [user.email]
-        )
-
-
-    for shop in Shop.objects.all().prefetch_related('user'):
-        response = None
-        try:
-            response = load_partner_info(shop.url, None, shop.user_id)
-        except Exception:
-            report_error(shop.user)
-            raise
-        else:
-            if response and is_success(response.status_code):
-                report_success(shop.user)
+def import_shop(shop_id, fetched=None, job_id=None):
+    """
+    Обновление прайса одного магазина по его ссылке load_url.
+    fetched - прайс, уже скачанный на этапе fetch (см. feed_fetcher) в общий каталог
+    PRICE_IMPORT['FETCH_DIR'], иначе (и если файла прайса на этом сервере нет)
+    прайс скачивается самой задачей. Файл прайса удаляется в любом случае.
+    job_id - задание общего импорта, в котором учитывается обработанный магазин.
+    Ошибки не пробрасываются, чтобы не прерывать общий импорт:
+    возвращается сводка для import_summary
+    """
+    shop = Shop.objects.select_related('user').filter(id=shop_id).first()
+    if shop is None:
+        remove_fetched(fetched)
+        return dict(shop_id=shop_id, success=False, status=None, errors='Магазин не найден')
+    if fetched and fetched['path'] and not os.path.exists(fetched['path']):
+        logger.warning(f'Fetched price list is missing, downloading it again: shop_id={shop_id}, '
+                       f'path={fetched["path"]}')
+        fetched = None
+
+    response = None
+    try:
+        with profile_import(job_id=job_id, shop=shop):
+            if fetched:
+                response = load_fetched_feed(fetched, shop.user_id)
             else:
-                report_error(shop.user)
+                response = load_partner_info(shop.load_url, None, shop.user_id, shop=shop)
+    except Exception as e:
+        logger.exception(f'Error importing price list: shop_id={shop_id}, url={shop.load_url}')
+        errors = str(e)
+    else:
+        errors = response.data.get('Errors') if response else None
+    finally:
+        remove_fetched(fetched)
+
+    success = bool(response) and is_success(response.status_code)
+    partial = success and bool(response.data.get('Partial'))
+    if job_id:
+        ImportJob.objects.filter(id=job_id).update(processed=F('processed') + 1)
+    if shop.user:
+        if success:
+            report_import_success(shop.user)
+        else:
+            report_import_error(shop.user)
+    return dict(shop_id=shop_id, success=success, partial=partial,
+                status=response.status_code if response else None,
+                errors=str(errors) if errors else None)
+
+
+@app.task
+def import_summary(results, job_id=None):
+    """
+    Итог общего импорта прайсов (вызывается после обработки всех магазинов).
+    partial - магазины, прайсы которых загружены с пропуском товаров с ошибками
+    """
+    failed = [result['shop_id'] for result in results if not result['success']]
+    partial = [result['shop_id'] for result in results if result.get('partial')]
+    summary = dict(total=len(results), succeeded=len(results) - len(failed), failed=failed, partial=partial)
+    if failed:
+        logger.warning(f'Price import finished with errors: {summary}')
+    else:
+        logger.info(f'Price import finished: {summary}')
+    job = ImportJob.objects.filter(id=job_id).first() if job_id else None
+    if job:
+        job.processed = len(results)
+        job.finish(not failed, summary)
+    return summary
+
+
+@app.task
+def import_drop_folder(mode=None):
+    """
+    Загрузка новых и изменившихся прайсов из каталога магазинов на диске
+    (см. drop_folder). Возвращает сводки загрузок
+    """
+    results = scan_drop_folder(mode)
+    failed = [result for result in results if result['status'] is None or not is_success(result['status'])]
+    if failed:
+        logger.warning(f'Dropped price lists import finished with errors: {failed}')
+    elif results:
+        logger.info(f'Dropped price lists imported: {len(results)}')
+    return results
+
+
+def fetch_shops(shops, breaker=None):
+    """
+    Этап fetch общего импорта: параллельное скачивание прайсов магазинов.
+    Ссылки, исключенные размыкателем, не запрашиваются.
+    Возвращает словарь id магазина -> результат скачивания
+    """
+    breaker = breaker or CircuitBreaker()
+    skipped = [shop.id for shop in shops if not breaker.allows(shop)]
+    if skipped:
+        logger.warning(f'Price list urls are disabled by the circuit breaker: shop_ids={skipped}')
+    shops = [shop for shop in shops if shop.id not in skipped]
+    results = fetch_feeds([(shop.load_url, dict(conditional_headers(shop), **{'Accept-Encoding': ACCEPT_ENCODING}))
+                           for shop in shops])
+    for shop, fetched in zip(shops, results):
+        breaker.record(shop, not fetched['error'])
+        if fetched['error']:
+            logger.warning(f'Error fetching price list: shop_id={shop.id}, url={shop.load_url}, error={fetched["error"]}')
+    return {shop.id: fetched for shop, fetched in zip(shops, results)}
+
+
+@app.task(bind=True)
+def do_import(self, job_id=None):
+    """
+    Общий импорт прайсов: прайсы всех магазинов со ссылкой на прайс
+    скачиваются параллельно, затем загружаются задачами import_shop
+    (выполняются параллельно воркерами), по завершении всех - import_summary.
+    Ход импорта отслеживается заданием ImportJob kind=shops
+    (создается, если не передано)
+    """
+    job = ImportJob.objects.filter(id=job_id).first() if job_id else None
+    if job is None:
+        job = ImportJob.objects.create(kind='shops', task_id=self.request.id or '')
+    shops = Shop.objects.exclude(load_url__isnull=True).exclude(load_url='')
+    fetched = fetch_shops(shops)
+    job.start(total=len(fetched))
+    if not fetched:
+        job.finish(True, dict(total=0, succeeded=0, failed=[], partial=[]))
+        return None
+    return chord(import_shop.s(shop_id, result, job.id) for shop_id, result in fetched.items())(import_summary.s(job.id)).id
@@ -1,3 +1,1583 @@
-from django.test import TestCase
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-# Create your tests here.
+import bz2
+import csv
+from datetime import timedelta
+import gzip
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import lzma
+import mmap
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from yaml import YAMLError
+import zstandard
+
+from rest_auth.models import User
+
+from .catalog import SUGGEST_VERSION_KEY, catalog_version, refresh_shops, touch_suggest
+from .catalog_search import search_available, search_catalog
+from .drop_folder import scan_drop_folder
+from .exceptions import FeedError
+from .feed_compression import split_extension
+from .feed_fetcher import fetch_feeds, CircuitBreaker
+from .tasks import import_shop
+from .feed_generator import FeedGenerator
+from .feed_parallel import SegmentPool, parallel_workers
+from .feed_validator import DUPLICATE_ERROR, GoodsValidator, INFO_ERROR
+from .fuzzy_search import TrigramIndex, edit_distance
+from .feed_readers import READ_CHUNK_SIZE, Feed, JSONStreamReader, iter_json_feed, iter_yaml_feed, iter_xml_feed
+from .import_profiler import ImportProfiler
+from .import_writer import CatalogWriter, DiffCatalogWriter
+from .partner_info_loader import import_digest, load_fetched_feed, load_partner_file, mapped_stream
+from .price_patch import apply_patch
+from .suggest import SuggestIndex
+from .models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter, Order, OrderItem, ImportReport, \
+    DropFile, CatalogItem, VISIBLE_CATALOG
+
+
+def make_goods(count, parameters=2, prefix='Товар'):
+    """
+    Генерация тестовых товаров в формате прайса v1.0
+    """
+    return [{
+        'id': index + 1,
+        'category': f'Категория {index % 3}',
+        'name': f'{prefix} {index}',
+        'price': 100 + index,
+        'price_rrc': 120 + index,
+        'quantity': index % 10,
+        'parameters': [{'name': f'Параметр {number}', 'value': f'{index}.{number}'} for number in range(parameters)],
+    } for index in range(count)]
+
+
+class CatalogWriterTests(TestCase):
+    """
+    Тесты пакетной записи прайсов
+    """
+
+    writer_class = CatalogWriter
+
+    def setUp(self):
+        self.user = User.objects.create(email='shop@mail.com', type='shop', is_active=True)
+        self.shop = Shop.objects.create(name='Магазин', user=self.user)
+
+    def write(self, goods, batch_size=None, categories=()):
+        with transaction.atomic():
+            writer = self.writer_class(self.shop, batch_size=batch_size)
+            writer.clear()
+            writer.add_categories(categories)
+            writer.extend(goods)
+            return writer.close()
+
+    def test_write_goods(self):
+        """
+        Все товары, параметры и справочники записаны
+        """
+        result = self.write(make_goods(25), batch_size=10, categories=['Пустая категория'])
+
+        self.assertEqual(result, dict(created=25, updated=0, unchanged=0, deleted=0))
+        self.assertEqual(ProductInfo.objects.filter(shop=self.shop).count(), 25)
+        self.assertEqual(Product.objects.count(), 25)
+        self.assertEqual(Category.objects.count(), 4)
+        self.assertEqual(Parameter.objects.count(), 2)
+        self.assertEqual(ProductParameter.objects.count(), 50)
+        self.assertEqual(self.shop.categories.count(), 4)
+        info = ProductInfo.objects.get(product__name='Товар 7')
+        self.assertEqual(info.external_id, 8)
+        self.assertEqual(info.quantity, 7)
+        self.assertEqual(info.product.category.name, 'Категория 1')
+        self.assertEqual(
+            dict(info.product_parameters.values_list('parameter__name', 'value')),
+            {'Параметр 0': '7.0', 'Параметр 1': '7.1'})
+
+    def test_queries_depend_on_batches(self):
+        """
+        Число запросов зависит от числа пачек, а не от числа товаров
+        """
+        # Категории и параметры создаются при первой загрузке:
+        self.write(make_goods(3, prefix='Первый'))
+        with CaptureQueriesContext(connection) as small:
+            self.write(make_goods(10, prefix='Малый'), batch_size=100)
+        # Пачка не длиннее лимита sqlite на число параметров во вставке каталога
+        # (иначе bulk_create сам делит вставку на несколько запросов):
+        with CaptureQueriesContext(connection) as large:
+            self.write(make_goods(60, prefix='Большой'), batch_size=100)
+
+        self.assertEqual(len(small), len(large))
+
+    def test_rewrite_reuses_existing_objects(self):
+        """
+        Повторная загрузка заменяет прайс и не дублирует справочники
+        """
+        self.write(make_goods(5))
+        self.write(make_goods(3))
+
+        self.assertEqual(ProductInfo.objects.filter(shop=self.shop).count(), 3)
+        self.assertEqual(Product.objects.count(), 5)
+        self.assertEqual(Parameter.objects.count(), 2)
+        self.assertEqual(ProductParameter.objects.count(), 6)
+
+
+class DiffCatalogWriterTests(CatalogWriterTests):
+    """
+    Тесты инкрементальной записи прайсов
+    """
+
+    writer_class = DiffCatalogWriter
+
+    def test_unchanged_goods_are_kept(self):
+        """
+        Повторная загрузка того же прайса ничего не меняет в базе
+        """
+        self.write(make_goods(25), batch_size=10)
+        ids = set(ProductInfo.objects.values_list('id', flat=True))
+        parameter_ids = set(ProductParameter.objects.values_list('id', flat=True))
+
+        with CaptureQueriesContext(connection) as queries:
+            result = self.write(make_goods(25), batch_size=10)
+
+        self.assertEqual(result, dict(created=0, updated=0, unchanged=25, deleted=0))
+        self.assertEqual(set(ProductInfo.objects.values_list('id', flat=True)), ids)
+        self.assertEqual(set(ProductParameter.objects.values_list('id', flat=True)), parameter_ids)
+        self.assertFalse([query for query in queries if query['sql'].startswith(('UPDATE', 'INSERT INTO', 'DELETE'))])
+
+    def test_changes_are_applied(self):
+        """
+        Записываются только изменения: новые, измененные и исчезнувшие позиции
+        """
+        self.write(make_goods(10))
+        kept = ProductInfo.objects.get(external_id=1)
+        goods = make_goods(12)[1:]
+        goods[0]['price'] = 500
+        goods[1]['parameters'][0]['value'] = 'новое'
+        goods[2]['id'] = 100
+
+        result = self.write(goods)
+
+        self.assertEqual(result, dict(created=2, updated=3, unchanged=6, deleted=1))
+        self.assertFalse(ProductInfo.objects.filter(id=kept.id).exists())
+        self.assertEqual(ProductInfo.objects.filter(shop=self.shop).count(), 11)
+        self.assertEqual(ProductInfo.objects.get(external_id=2).price, 500)
+        self.assertEqual(
+            dict(ProductInfo.objects.get(external_id=3).product_parameters.values_list('parameter__name', 'value')),
+            {'Параметр 0': 'новое', 'Параметр 1': '2.1'})
+        self.assertEqual(ProductInfo.objects.get(external_id=100).product.name, 'Товар 3')
+        self.assertEqual(ProductParameter.objects.count(), 22)
+
+    def test_order_items_are_kept(self):
+        """
+        Позиции заказов по неизменившимся и измененным товарам не удаляются
+        """
+        self.write(make_goods(3))
+        order = Order.objects.create(user=self.user, state='basket')
+        for info in ProductInfo.objects.all():
+            OrderItem.objects.create(order=order, product_info=info, quantity=1)
+        goods = make_goods(2)
+        goods[1]['quantity'] = 5
+
+        self.write(goods)
+
+        self.assertEqual(order.ordered_items.count(), 2)
+
+    def test_placed_order_items_are_kept(self):
+        """
+        Позиции оформленных заказов по исчезнувшим товарам сохраняются, но товары
+        больше не продаются
+        """
+        self.write(make_goods(3))
+        info = ProductInfo.objects.get(external_id=3)
+        order = Order.objects.create(user=self.user, state='confirmed')
+        OrderItem.objects.create(order=order, product_info=info, quantity=1)
+        basket = Order.objects.create(user=self.user, state='basket')
+        OrderItem.objects.create(order=basket, product_info=info, quantity=1)
+
+        result = self.write(make_goods(2))
+
+        self.assertEqual(result['deleted'], 1)
+        self.assertEqual(order.ordered_items.get().product_info_id, info.id)
+        self.assertFalse(basket.ordered_items.exists())
+        info.refresh_from_db()
+        self.assertEqual(info.quantity, 0)
+        self.assertFalse(ProductInfo.objects.active().filter(id=info.id).exists())
+        self.assertFalse(CatalogItem.objects.filter(VISIBLE_CATALOG, product_info_id=info.id).exists())
+        # Товар, снова появившийся в прайсе, - новая позиция:
+        self.assertEqual(self.write(make_goods(3))['created'], 1)
+        self.assertEqual(ProductInfo.objects.active().filter(shop=self.shop).count(), 3)
+
+    def test_external_id_moves_to_other_product(self):
+        """
+        Внешний ИД переходит к названию, которое числится за другой позицией магазина
+        """
+        self.write([dict(item, name=name) for item, name in zip(make_goods(2), 'AB')])
+        moved = ProductInfo.objects.get(external_id=1)
+
+        result = self.write([dict(make_goods(1)[0], name='B')])
+
+        self.assertEqual(result, dict(created=0, updated=1, unchanged=0, deleted=1))
+        self.assertEqual(list(ProductInfo.objects.values_list('id', 'external_id', 'product__name')),
+                         [(moved.id, 1, 'B')])
+        self.assertEqual(CatalogItem.objects.get().product_name, 'B')
+
+        # Позиции обмениваются продуктами:
+        self.write([dict(item, name=name) for item, name in zip(make_goods(2), 'BA')])
+        result = self.write([dict(item, name=name) for item, name in zip(make_goods(2), 'AB')])
+        self.assertEqual(result, dict(created=0, updated=2, unchanged=0, deleted=0))
+        self.assertEqual(sorted(ProductInfo.objects.active().values_list('external_id', 'product__name')),
+                         [(1, 'A'), (2, 'B')])
+
+
+class GenerationSwapTests(TestCase):
+    """
+    Тесты полной загрузки прайса с переключением поколений
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(email='shop@mail.com', type='shop', is_active=True)
+        self.shop = Shop.objects.create(name='Магазин', user=self.user)
+        self.write(make_goods(5))
+
+    def write(self, goods, **kwargs):
+        writer = CatalogWriter(self.shop, **kwargs)
+        writer.clear()
+        writer.extend(goods)
+        return writer.close()
+
+    def active_prices(self):
+        return sorted(ProductInfo.objects.active().filter(shop=self.shop).values_list('price', flat=True))
+
+    def test_old_generation_is_visible_until_swap(self):
+        old_prices = self.active_prices()
+        goods = make_goods(30)
+        for item in goods:
+            item['price'] += 1000
+        writer = CatalogWriter(self.shop, batch_size=10)
+        writer.clear()
+        writer.extend(goods[:25])
+
+        # Записанные пачки нового поколения не видны покупателям:
+        self.assertEqual(ProductInfo.objects.filter(shop=self.shop, generation=writer.generation).count(), 20)
+        self.assertEqual(self.active_prices(), old_prices)
+
+        writer.extend(goods[25:])
+        result = writer.close()
+
+        self.assertEqual(result['deleted'], 5)
+        self.assertEqual(ProductInfo.objects.filter(shop=self.shop).count(), 30)
+        self.assertEqual(self.active_prices(), sorted(item['price'] for item in goods))
+
+    def test_failed_import_is_discarded(self):
+        old_ids = set(ProductInfo.objects.values_list('id', flat=True))
+        goods = make_goods(20)
+        goods[15]['price'] = 'abc'
+        content = json.dumps({'version': 'v1.0', 'shop': 'Магазин', 'goods': goods}).encode()
+
+        with self.settings(PRICE_IMPORT=dict(settings.PRICE_IMPORT, BATCH_SIZE=10)):
+            response = load_partner_file(ContentFile(content, name='shop.json'), self.user.id, 'replace')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(ProductInfo.objects.values_list('id', flat=True)), old_ids)
+        self.assertEqual(set(ProductInfo.objects.active().values_list('id', flat=True)), old_ids)
+
+    def test_order_items(self):
+        """
+        Позиции корзин переносятся в новое поколение, позиции оформленных заказов сохраняются
+        """
+        infos = list(ProductInfo.objects.order_by('external_id'))
+        basket = Order.objects.create(user=self.user, state='basket')
+        OrderItem.objects.create(order=basket, product_info=infos[0], quantity=1)
+        OrderItem.objects.create(order=basket, product_info=infos[4], quantity=1)
+        order = Order.objects.create(user=self.user, state='new', dt=timezone.now() - timedelta(days=1))
+        OrderItem.objects.create(order=order, product_info=infos[0], quantity=2)
+
+        self.write(make_goods(3))
+
+        self.assertEqual(list(basket.ordered_items.values_list('product_info__product__name', flat=True)),
+                         [infos[0].product.name])
+        self.assertEqual(basket.ordered_items.get().product_info.generation, self.shop.active_generation)
+        self.assertEqual(order.ordered_items.get().product_info_id, infos[0].id)
+        self.assertEqual(ProductInfo.objects.filter(shop=self.shop).count(), 4)
+        self.assertEqual(ProductInfo.objects.active().filter(shop=self.shop).count(), 3)
+
+    def test_stale_generation_is_not_activated(self):
+        """
+        Загрузка, завершившаяся после более новой параллельной загрузки, не активируется
+        """
+        older = CatalogWriter(self.shop)
+        older.clear()
+        older.extend(make_goods(2))
+        self.write(make_goods(4))
+        generation = Shop.objects.get(id=self.shop.id).active_generation
+
+        older.close()
+
+        self.assertEqual(Shop.objects.get(id=self.shop.id).active_generation, generation)
+        self.assertEqual(ProductInfo.objects.filter(shop=self.shop).count(), 4)
+
+
+class CatalogTests(TestCase):
+    """
+    Тесты каталога для покупателей (CatalogItem)
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(email='shop@mail.com', type='shop', is_active=True)
+        self.shop = Shop.objects.create(name='Магазин', user=self.user)
+
+    def write(self, goods, writer_class=CatalogWriter, **kwargs):
+        with transaction.atomic():
+            writer = writer_class(self.shop, **kwargs)
+            writer.clear()
+            writer.extend(goods)
+            return writer.close()
+
+    def visible(self):
+        return CatalogItem.objects.filter(VISIBLE_CATALOG, shop=self.shop)
+
+    def test_replace_import(self):
+        """
+        Каталог повторяет активное поколение прайса, новое поколение скрыто до переключения
+        """
+        self.write(make_goods(5))
+        goods = make_goods(8, prefix='Новый')
+        writer = CatalogWriter(self.shop, batch_size=5)
+        writer.clear()
+        writer.extend(goods)
+
+        self.assertEqual(CatalogItem.objects.filter(shop=self.shop).count(), 10)
+        self.assertEqual(set(self.visible().values_list('product_name', flat=True)),
+                         {f'Товар {index}' for index in range(5)})
+
+        writer.close()
+
+        self.assertEqual(CatalogItem.objects.filter(shop=self.shop).count(), 8)
+        item = self.visible().get(product_name='Новый 7')
+        info = ProductInfo.objects.active().get(product__name='Новый 7')
+        self.assertEqual(item.product_info_id, info.id)
+        self.assertEqual((item.shop_name, item.category_name, item.quantity, item.price, item.price_rrc),
+                         ('Магазин', 'Категория 1', 7, info.price, info.price_rrc))
+        self.assertEqual(item.get_parameters(), {'Параметр 0': '7.0', 'Параметр 1': '7.1'})
+
+    def test_diff_import(self):
+        self.write(make_goods(5))
+        goods = make_goods(4)
+        goods[1]['price'] = 500
+        goods[2]['parameters'][0]['value'] = 'новое'
+
+        self.write(goods, DiffCatalogWriter)
+
+        self.assertEqual(self.visible().count(), 4)
+        self.assertEqual(self.visible().get(product_name='Товар 1').price, 500)
+        self.assertEqual(self.visible().get(product_name='Товар 2').get_parameters()['Параметр 0'], 'новое')
+
+    def test_patch_and_shop_state(self):
+        self.write(make_goods(3))
+
+        apply_patch(self.shop, [dict(external_id=1, quantity=42)])
+        self.assertEqual(self.visible().get(product_name='Товар 0').quantity, 42)
+
+        Shop.objects.filter(id=self.shop.id).update(state=False, name='Закрытый')
+        refresh_shops([self.shop.id])
+        self.assertFalse(self.visible().exists())
+        self.assertEqual(set(CatalogItem.objects.values_list('shop_name', flat=True)), {'Закрытый'})
+
+    def test_rebuild(self):
+        self.write(make_goods(7))
+        expected = list(CatalogItem.objects.order_by('pk').values())
+        CatalogItem.objects.all().delete()
+
+        call_command('rebuild_catalog', stdout=io.StringIO())
+
+        self.assertEqual(list(CatalogItem.objects.order_by('pk').values()), expected)
+
+
+class CatalogSearchTests(TestCase):
+    """
+    Тесты полнотекстового поиска по каталогу
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(email='shop@mail.com', type='shop', is_active=True)
+        self.shop = Shop.objects.create(name='Магазин', user=self.user)
+        self.goods = make_goods(4)
+        self.goods[0]['name'] = 'Чехол синий'
+        self.goods[0]['parameters'] = [{'name': 'Цвет', 'value': 'красный'}]
+        self.goods[1]['name'] = 'Чехол красный'
+        self.goods[2]['name'] = 'Ёлочная игрушка'
+        self.write(self.goods)
+
+    def write(self, goods, writer_class=CatalogWriter):
+        with transaction.atomic():
+            writer = writer_class(self.shop)
+            writer.clear()
+            writer.extend(goods)
+            return writer.close()
+
+    def search(self, *terms):
+        return list(search_catalog(CatalogItem.objects.filter(VISIBLE_CATALOG), terms).order_by(
+            'search_rank').values_list('product_name', flat=True))
+
+    def test_ranked_search(self):
+        """
+        Совпадение в названии весит больше совпадения в параметрах, слова ищутся по началу
+        """
+        self.assertTrue(search_available())
+        self.assertEqual(self.search('красн'), ['Чехол красный', 'Чехол синий'])
+        self.assertEqual(self.search('чехол', 'син'), ['Чехол синий'])
+        self.assertEqual(self.search('елочная'), ['Ёлочная игрушка'])
+        self.assertEqual(len(self.search('Категория')), 4)
+        self.assertEqual(self.search('"; DROP'), [])
+
+    def test_index_follows_catalog(self):
+        goods = make_goods(4)
+        goods[1]['parameters'][0]['value'] = 'бирюзовый'
+        self.write(goods, DiffCatalogWriter)
+        self.assertEqual(self.search('бирюз'), ['Товар 1'])
+        self.assertEqual(self.search('чехол'), [])
+
+        Shop.objects.filter(id=self.shop.id).update(name='Лавка')
+        refresh_shops([self.shop.id])
+        self.assertEqual(len(self.search('лавка')), 4)
+
+        self.write(make_goods(2, prefix='Новый'))
+        self.assertEqual(self.search('лавка', 'товар'), [])
+        self.assertEqual(len(self.search('новый')), 2)
+
+
+class FuzzySearchTests(TestCase):
+    """
+    Тесты нечеткого поиска по названиям продуктов
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(email='shop@mail.com', type='shop', is_active=True)
+        self.shop = Shop.objects.create(name='Магазин', user=self.user)
+        self.write(['Смартфон Apple iPhone XR (черный)', 'Смартфон Samsung Galaxy S10', 'Ёлочная гирлянда'])
+        self.index = TrigramIndex()
+
+    def write(self, names):
+        goods = make_goods(len(names))
+        for item, name in zip(goods, names):
+            item['name'] = name
+        writer = CatalogWriter(self.shop)
+        writer.clear()
+        writer.extend(goods)
+        writer.close()
+
+    def names(self, query):
+        return list(Product.objects.filter(id__in=self.index.search(query)).values_list('name', flat=True))
+
+    def test_typos(self):
+        self.assertEqual(self.names('iphne'), ['Смартфон Apple iPhone XR (черный)'])
+        self.assertEqual(self.names('самсунг'), [])
+        self.assertEqual(self.names('smasung galxy'), ['Смартфон Samsung Galaxy S10'])
+        self.assertEqual(self.names('елочная гирлнда'), ['Ёлочная гирлянда'])
+        self.assertEqual(self.names('смартфон'), self.names('смартфн'))
+        self.assertEqual(len(self.names('смартфон')), 2)
+        self.assertEqual(edit_distance('iphne', 'iphone', 1), 1)
+        self.assertEqual(edit_distance('galxy', 'galaxy', 0), 1)
+
+    def test_incremental_sync(self):
+        with self.settings(CATALOG_SEARCH=dict(settings.CATALOG_SEARCH, FUZZY_SYNC_INTERVAL=0)):
+            self.assertEqual(self.names('nokla'), [])
+            self.write(['Смартфон Nokia 3310'])
+            self.assertEqual(self.names('nokla'), ['Смартфон Nokia 3310'])
+        self.assertEqual(len(self.index.names), 4)
+
+    def test_budget(self):
+        with self.settings(CATALOG_SEARCH=dict(settings.CATALOG_SEARCH, FUZZY_BUDGET=0)):
+            self.assertEqual(len(self.names('смартфн')), 1)
+
+
+class SuggestTests(TestCase):
+    """
+    Тесты подсказок поиска
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(email='shop@mail.com', type='shop', is_active=True)
+        self.shop = Shop.objects.create(name='Магазин', user=self.user)
+        self.write([('Смартфон Apple iPhone XR', 5, 'Смартфоны'), ('Смартфон Samsung Galaxy', 9, 'Смартфоны'),
+                    ('Чехол для iPhone', 2, 'Аксессуары'), ('Смарт-часы', 0, 'Часы')])
+        self.index = SuggestIndex()
+
+    def write(self, goods):
+        items = make_goods(len(goods))
+        for item, (name, quantity, category) in zip(items, goods):
+            item.update(name=name, quantity=quantity, category=category)
+        writer = CatalogWriter(self.shop)
+        writer.clear()
+        writer.extend(items)
+        writer.close()
+
+    def names(self, query):
+        return [(kind, name) for kind, _, name in self.index.suggest(query)]
+
+    def test_suggest(self):
+        # Продукты - по остаткам, категории - по числу продуктов в наличии:
+        self.assertEqual(self.names('смарт'), [('product', 'Смартфон Samsung Galaxy'),
+                                               ('product', 'Смартфон Apple iPhone XR'),
+                                               ('category', 'Смартфоны'), ('product', 'Смарт-часы')])
+        self.assertEqual(self.names('IPH'), [('product', 'Смартфон Apple iPhone XR'),
+                                             ('product', 'Чехол для iPhone')])
+        self.assertEqual(self.names('apple  iphone x'), [('product', 'Смартфон Apple iPhone XR')])
+        self.assertEqual(self.names('час'), [('product', 'Смарт-часы')])
+        self.assertEqual(self.names('nokia'), [])
+        self.assertEqual(self.names(''), [])
+        self.assertEqual(len(self.index.suggest('с', limit=2)), 2)
+
+
+class SuggestRebuildTests(TransactionTestCase):
+    """
+    Тесты пересборки подсказок поиска при изменении каталога
+    (фоновый поток видит только зафиксированные данные)
+    """
+
+    setUp = SuggestTests.setUp
+    write = SuggestTests.write
+    names = SuggestTests.names
+
+    def test_catalog_changes(self):
+        with self.settings(CATALOG_SEARCH=dict(settings.CATALOG_SEARCH, SUGGEST_SYNC_INTERVAL=0)):
+            self.assertEqual(self.names('nokia'), [])
+            # Пока каталог не меняется, подсказки читают из базы только версию каталога:
+            with self.assertNumQueries(1):
+                self.assertEqual(self.names('nokia'), [])
+            self.write([('Смартфон Nokia 3310', 1, 'Смартфоны')])
+            # Индекс пересобирается в фоновом потоке, запрос получает подсказки по прежнему:
+            with self.assertNumQueries(1):
+                self.index.suggest('nokia')
+            self.index.thread.join()
+            self.assertEqual(self.names('nokia'), [('product', 'Смартфон Nokia 3310')])
+            self.assertEqual(self.names('iphone'), [])
+
+    def test_version_is_shared(self):
+        """
+        Смена версии каталога в другом процессе (здесь - потоке со своим соединением
+        с базой, как у задачи загрузки прайса) видна при кэше из настроек проекта
+        """
+        version = catalog_version(SUGGEST_VERSION_KEY)
+
+        def touch():
+            try:
+                touch_suggest()
+            finally:
+                connection.close()
+        thread = threading.Thread(target=touch)
+        thread.start()
+        thread.join()
+
+        self.assertNotEqual(catalog_version(SUGGEST_VERSION_KEY), version)
+
+    def test_one_rebuild_per_import(self):
+        version = catalog_version(SUGGEST_VERSION_KEY)
+        writer = DiffCatalogWriter(self.shop, batch_size=2)
+        writer.clear()
+        writer.extend(make_goods(7))
+        writer.flush()
+        # Пачки меняют только версию каталога для счетчиков страниц:
+        self.assertEqual(catalog_version(SUGGEST_VERSION_KEY), version)
+        writer.close()
+        self.assertNotEqual(catalog_version(SUGGEST_VERSION_KEY), version)
+
+
+class FeedReadersTests(TestCase):
+    """
+    Тесты потокового чтения прайсов
+    """
+
+    def read_file(self, name, reader):
+        with open(os.path.join(settings.MEDIA_ROOT, 'tests', name), 'rb') as fp:
+            feed = Feed(reader(fp))
+            goods = list(feed.goods())
+        return feed.header, goods
+
+    def test_formats_are_equal(self):
+        """
+        Все форматы тестового прайса читаются одинаково
+        """
+        header, goods = self.read_file('shop1.json', iter_json_feed)
+        self.assertEqual(header['version'], 'v1.0')
+        self.assertEqual(header['shop'], 'Связной')
+        self.assertEqual(len(goods), 4)
+        for name, reader in (('shop1.yaml', iter_yaml_feed), ('shop1.xml', iter_xml_feed)):
+            other_header, other_goods = self.read_file(name, reader)
+            self.assertEqual(other_header['shop'], header['shop'])
+            self.assertEqual([item['name'] for item in other_goods], [item['name'] for item in goods])
+            self.assertEqual([int(item['price']) for item in other_goods], [item['price'] for item in goods])
+
+    def test_generated_feeds(self):
+        """
+        Синтетические прайсы всех форматов читаются одинаково и проходят проверку
+        """
+        generator = FeedGenerator(30, parameters=3, categories=4)
+        expected = list(generator.goods())
+        for feed_format, reader in (('json', iter_json_feed), ('yaml', iter_yaml_feed), ('xml', iter_xml_feed)):
+            target = io.StringIO()
+            generator.write(feed_format, target)
+            feed = Feed(reader(io.BytesIO(target.getvalue().encode())))
+            goods = list(feed.goods())
+            self.assertEqual(feed.header['shop'], generator.shop)
+            self.assertEqual(len(feed.header['categories']), 4)
+            self.assertEqual([item['name'] for item in goods], [item['name'] for item in expected])
+            self.assertEqual([int(item['price']) for item in goods], [item['price'] for item in expected])
+            self.assertEqual([str(entry['value']) for entry in goods[-1]['parameters']],
+                             [entry['value'] for entry in expected[-1]['parameters']])
+            validator = GoodsValidator()
+            validator.check(goods)
+            self.assertFalse(validator.error_count)
+
+    def test_json_small_chunks(self):
+        """
+        Значения, разорванные между порциями чтения, разбираются целиком
+        """
+        document = {'version': 'v1.0', 'shop': 'Магазин', 'goods': make_goods(20)}
+        stream = io.BytesIO(json.dumps(document, ensure_ascii=False).encode())
+        reader = JSONStreamReader(stream, chunk_size=7)
+        self.assertEqual(reader.next(), '{')
+        self.assertEqual(reader.value(), 'version')
+        self.assertEqual(reader.next(), ':')
+        self.assertEqual(reader.value(), 'v1.0')
+
+        stream.seek(0)
+        events = list(iter_json_feed(stream))
+        self.assertEqual([value for kind, key, value in events if kind == 'item'], document['goods'])
+
+    def test_stream_is_read_lazily(self):
+        """
+        Товары отдаются до того, как прочитан весь поток
+        """
+        document = {'version': 'v1.0', 'shop': 'Магазин', 'goods': make_goods(5000)}
+        stream = io.BytesIO(json.dumps(document).encode())
+        feed = Feed(iter_json_feed(stream))
+        next(feed.goods())
+        self.assertLess(stream.tell(), len(stream.getvalue()) / 10)
+
+    def test_goods_before_header(self):
+        """
+        Товары до заголовка буферизуются, ключи после товаров попадают в заголовок
+        """
+        stream = io.BytesIO(json.dumps({
+            'goods': make_goods(2), 'version': 'v1.0', 'shop': 'Магазин', 'categories': [{'name': 'Категория'}],
+        }).encode())
+        feed = Feed(iter_json_feed(stream))
+        self.assertEqual(feed.header['shop'], 'Магазин')
+        self.assertNotIn('categories', feed.header)
+        self.assertEqual(len(list(feed.goods())), 2)
+        self.assertEqual(feed.header['categories'], [{'name': 'Категория'}])
+
+    def test_not_a_dict(self):
+        """
+        Документ верхнего уровня должен быть словарем
+        """
+        for reader, content in ((iter_json_feed, b'[]'), (iter_yaml_feed, b'- 1'),
+                                (iter_xml_feed, b'<root><list-item>1</list-item></root>'),
+                                (iter_json_feed, b''), (iter_json_feed, b'{"shop": 1,}')):
+            with self.assertRaises(FeedError):
+                list(Feed(reader(io.BytesIO(content))).goods())
+
+    def test_malformed_json_item(self):
+        """
+        Ошибка в товаре не приводит к чтению остатка прайса, ее позиция - позиция в документе
+        """
+        goods = json.dumps(make_goods(5000), ensure_ascii=False)
+        text = '{"shop": "Магазин", "goods": ' + goods.replace('"price": 110,', '"price": 110 1,', 1) + '}'
+        stream = io.BytesIO(text.encode())
+        position = text.index('"price": 110 1,') + len('"price": 110 ')
+        with self.assertRaisesRegex(ValueError, f'at position {position}$'):
+            list(iter_json_feed(stream))
+        self.assertGreater(len(text), 10 * READ_CHUNK_SIZE)
+        self.assertLessEqual(stream.tell(), 2 * READ_CHUNK_SIZE)
+
+    def test_yaml_is_loaded_safely(self):
+        """
+        Прайс yaml не может создавать произвольные объекты python
+        """
+        content = b'shop: !!python/object/apply:os.getcwd []\ngoods:\n  - !!python/object/apply:os.getcwd []\n'
+        with self.assertRaises(YAMLError):
+            list(iter_yaml_feed(io.BytesIO(content)))
+
+
+YML_FEED = '''<?xml version="1.0" encoding="UTF-8"?>
+<yml_catalog date="2019-11-01 17:22">
+  <shop>
+    <name>Маркет</name>
+    <company>ООО Маркет</company>
+    <currencies><currency id="RUR" rate="1"/></currencies>
+    <categories>
+      <category id="1">Смартфоны</category>
+      <category id="2" parentId="1">Аксессуары</category>
+    </categories>
+    <offers>
+      <offer id="101" available="true">
+        <name>Смартфон Apple iPhone XR</name>
+        <price>60000</price>
+        <oldprice>65000</oldprice>
+        <categoryId>1</categoryId>
+        <count>7</count>
+        <param name="Диагональ" unit="дюйм">6.1</param>
+        <param name="Цвет">красный</param>
+        <param name="Цвет">черный</param>
+      </offer>
+      <offer id="102" type="vendor.model" available="false">
+        <typePrefix>Чехол</typePrefix>
+        <vendor>Apple</vendor>
+        <model>Silicone Case</model>
+        <price>3000</price>
+        <categoryId>2</categoryId>
+      </offer>
+      <offer id="103">
+        <name>Кабель</name>
+        <price>500</price>
+        <categoryId>2</categoryId>
+      </offer>
+    </offers>
+  </shop>
+</yml_catalog>
+'''
+
+
+class YMLFeedTests(TestCase):
+    """
+    Тесты прайсов Яндекс.Маркета (YML)
+    """
+
+    def test_read(self):
+        feed = Feed(iter_xml_feed(io.BytesIO(YML_FEED.encode())))
+        goods = list(feed.goods())
+
+        self.assertEqual(feed.header['shop'], 'Маркет')
+        self.assertEqual(feed.header['categories'], [{'name': 'Смартфоны'}, {'name': 'Аксессуары'}])
+        self.assertEqual([(item['id'], item['name'], item['category'], item['quantity']) for item in goods], [
+            ('101', 'Смартфон Apple iPhone XR', 'Смартфоны', '7'),
+            ('102', 'Чехол Apple Silicone Case', 'Аксессуары', 0),
+            ('103', 'Кабель', 'Аксессуары', 1),
+        ])
+        self.assertEqual((goods[0]['price'], goods[0]['price_rrc']), ('60000', '65000'))
+        self.assertEqual(goods[0]['parameters'], [{'name': 'Диагональ, дюйм', 'value': '6.1'},
+                                                  {'name': 'Цвет', 'value': 'красный, черный'}])
+
+    def test_import(self):
+        user = User.objects.create(email='shop@mail.com', type='shop', is_active=True)
+        for name in ('market.yml', 'market.xml.gz'):
+            with self.subTest(name=name):
+                Shop.objects.all().delete()
+                content = YML_FEED.encode()
+                if name.endswith('.gz'):
+                    content = gzip.compress(content)
+                response = load_partner_file(ContentFile(content, name=name), user.id)
+
+                self.assertEqual(response.status_code, 201, response.data)
+                self.assertEqual(Shop.objects.get().name, 'Маркет')
+                self.assertEqual(sorted(ProductInfo.objects.values_list('external_id', 'quantity', 'price_rrc')),
+                                 [(101, 7, 65000), (102, 0, 3000), (103, 1, 500)])
+                self.assertEqual(ProductParameter.objects.get(parameter__name='Цвет').value, 'красный, черный')
+
+
+class GoodsValidatorTests(TestCase):
+    """
+    Тесты проверки товаров прайса по столбцам
+    """
+
+    def test_all_errors_are_collected(self):
+        """
+        Возвращаются все ошибки с номерами строк, повторы ищутся и между пачками
+        """
+        goods = make_goods(10)
+        goods[1]['price'] = 'abc'
+        del goods[3]['category']
+        goods[4]['name'] = goods[0]['name']
+        goods[5]['quantity'] = -1
+        goods[6]['parameters'] = 'abc'
+        goods[8] = ['не словарь']
+        goods[9]['name'] = goods[7]['name']
+        validator = GoodsValidator(batch_size=3)
+
+        batches = list(validator.batches(goods))
+
+        self.assertEqual([len(batch) for batch in batches], [3, 3, 3, 1])
+        self.assertEqual(validator.error_count, 7)
+        self.assertEqual([(error['row'], error['error']) for error in validator.errors], [
+            (1, 'некорректно указана информация по продукту'),
+            (3, 'некорректно указана информация по продукту'),
+            (4, 'продукты с одинаковым именем'),
+            (5, 'некорректно указана информация по продукту'),
+            (6, 'параметры должны быть заданы как массив полей name и value'),
+            (8, 'товары должны быть описаны как словарь'),
+            (9, 'продукты с одинаковым именем'),
+        ])
+        self.assertEqual(validator.errors[2]['name'], 'Товар 0')
+        with self.assertRaises(FeedError) as context:
+            validator.raise_errors()
+        self.assertEqual(len(context.exception.rows), 7)
+
+    def test_valid_goods(self):
+        """
+        Корректные значения в виде строк принимаются, количество приводится к целому
+        """
+        goods = make_goods(5)
+        goods[0].update(price='100.5', price_rrc='120', quantity='3')
+        validator = GoodsValidator(batch_size=2)
+
+        list(validator.batches(goods))
+        validator.raise_errors()
+
+        self.assertEqual(validator.error_count, 0)
+        self.assertEqual(goods[0]['quantity'], 3)
+
+    def test_errors_limit(self):
+        """
+        В ответ попадает ограниченное число ошибок, но считаются все
+        """
+        goods = make_goods(20)
+        for item in goods:
+            item['price'] = None
+        validator = GoodsValidator(batch_size=7, max_errors=5)
+
+        list(validator.batches(goods))
+
+        self.assertEqual(validator.error_count, 20)
+        self.assertEqual([error['row'] for error in validator.errors], [0, 1, 2, 3, 4])
+
+    def test_load_reports_rows(self):
+        """
+        Загрузка прайса с ошибками возвращает их список и ничего не записывает
+        """
+        user = User.objects.create(email='shop@mail.com', type='shop', is_active=True)
+        goods = make_goods(5)
+        goods[2]['price_rrc'] = 'abc'
+        goods[4]['name'] = goods[1]['name']
+        content = json.dumps({'version': 'v1.0', 'shop': 'Магазин', 'goods': goods}).encode()
+
+        response = load_partner_file(ContentFile(content, name='shop.json'), user.id)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error['row'] for error in response.data['Rows']], [2, 4])
+        self.assertFalse(ProductInfo.objects.count())
+
+    def test_skip_invalid(self):
+        """
+        При пропуске ошибок в пачках остаются только корректные товары
+        """
+        goods = make_goods(6)
+        goods[1]['price'] = 'abc'
+        goods[4]['name'] = goods[0]['name']
+        validator = GoodsValidator(batch_size=4, skip_invalid=True)
+
+        batches = list(validator.batches(goods))
+
+        self.assertEqual([[item['id'] for item in batch] for batch in batches], [[1, 3, 4], [6]])
+        self.assertEqual(validator.error_count, 2)
+
+    def test_skip_invalid_name(self):
+        """
+        Название товара с ошибкой не считается занятым: следующий корректный
+        товар с тем же названием загружается
+        """
+        goods = make_goods(6)
+        goods[1]['price'] = 'abc'
+        goods[2]['name'] = goods[1]['name']
+        goods[4]['name'] = goods[1]['name']
+        validator = GoodsValidator(batch_size=4, skip_invalid=True)
+
+        batches = list(validator.batches(goods))
+
+        self.assertEqual([[item['id'] for item in batch] for batch in batches], [[1, 3, 4], [6]])
+        self.assertEqual([(error['row'], error['error']) for error in validator.errors],
+                         [(1, INFO_ERROR), (4, DUPLICATE_ERROR)])
+
+
+class PartialImportTests(TestCase):
+    """
+    Тесты частичной загрузки прайса с пропуском товаров с ошибками
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(email='shop@mail.com', type='shop', is_active=True)
+        self.shop = Shop.objects.create(name='Магазин', user=self.user, error_policy='skip')
+
+    def load(self, goods, version='v1.0', mode=None):
+        content = json.dumps({'version': version, 'shop': 'Магазин', 'categories': [{'name': 'Категория 0'}],
+                              'goods': goods}, ensure_ascii=False).encode()
+        return load_partner_file(ContentFile(content, name='shop.json'), self.user.id, mode)
+
+    def read_report(self, report_id):
+        report = ImportReport.objects.get(id=report_id)
+        with report.file.open('rb') as source:
+            rows = list(csv.reader(io.StringIO(source.read().decode('utf-8-sig'))))
+        report.file.delete()
+        return rows
+
+    def test_partial_import(self):
+        goods = make_goods(6)
+        goods[2]['price_rrc'] = 'abc'
+        goods[5]['name'] = goods[1]['name']
+        for mode in ('replace', 'diff'):
+            with self.subTest(mode=mode):
+                response = self.load(goods, mode=mode)
+
+                self.assertEqual(response.status_code, 201, response.data)
+                self.assertTrue(response.data['Partial'])
+                self.assertEqual(response.data['Skipped'], 2)
+                self.assertEqual([error['row'] for error in response.data['Rows']], [2, 5])
+                self.assertEqual(sorted(ProductInfo.objects.active().values_list('external_id', flat=True)),
+                                 [1, 2, 4, 5])
+                self.assertEqual(self.read_report(response.data['Report']), [
+                    ['row', 'name', 'error'],
+                    ['2', 'Товар 2', 'некорректно указана информация по продукту'],
+                    ['5', 'Товар 1', 'продукты с одинаковым именем'],
+                ])
+
+    def test_same_feed_reloaded(self):
+        """
+        Тот же прайс не записывается повторно только в том же режиме и с той же
+        политикой ошибок и загружается заново после неудачной загрузки
+        """
+        goods = make_goods(3)
+        self.assertEqual(self.load(goods, mode='replace').status_code, 201)
+        self.assertTrue(self.load(goods, mode='replace').data['NotModified'])
+
+        response = self.load(goods, mode='diff')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertNotIn('NotModified', response.data)
+
+        Shop.objects.filter(id=self.shop.id).update(error_policy='reject')
+        self.assertEqual(self.load(goods, mode='diff').status_code, 201)
+        self.assertTrue(self.load(goods, mode='diff').data['NotModified'])
+
+        self.assertEqual(self.load(goods, mode='replace').status_code, 201)
+        invalid = make_goods(3)
+        invalid[0]['price'] = 'abc'
+        self.assertEqual(self.load(invalid, mode='replace').status_code, 400)
+        response = self.load(goods, mode='replace')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertNotIn('NotModified', response.data)
+
+    def test_partial_column_import(self):
+        goods = {
+            'id': [1, 2, 3],
+            'category': [0, 0, 5],
+            'name': ['Телефон 1', 'Телефон 2', 'Чехол'],
+            'price': [100, 'abc', 10],
+            'price_rrc': [110, 220, 12],
+            'quantity': [1, 2, 3],
+        }
+        response = self.load(goods, version='v2.0')
+
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data['Skipped'], 2)
+        self.assertEqual(list(ProductInfo.objects.values_list('external_id', 'quantity')), [(1, 1)])
+        self.assertEqual(len(self.read_report(response.data['Report'])), 3)
+
+    def test_partial_column_import_invalid_name(self):
+        goods = {
+            'id': [1, 2, 3],
+            'category': [0, 0, 0],
+            'name': ['Телефон', 'Телефон', 'Телефон'],
+            'price': ['abc', 100, 10],
+            'price_rrc': [110, 120, 12],
+            'quantity': [1, 2, 3],
+        }
+        response = self.load(goods, version='v2.0')
+
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data['Skipped'], 2)
+        self.assertEqual(list(ProductInfo.objects.values_list('external_id', 'quantity')), [(2, 2)])
+        self.read_report(response.data['Report'])
+
+    def test_all_invalid(self):
+        """
+        Прайс без корректных товаров не загружается, отчет не сохраняется
+        """
+        goods = make_goods(3)
+        for item in goods:
+            item['price'] = None
+        response = self.load(goods)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ImportReport.objects.count())
+
+    def test_reject_policy(self):
+        Shop.objects.filter(id=self.shop.id).update(error_policy='reject')
+        goods = make_goods(3)
+        goods[0]['price'] = None
+        response = self.load(goods)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ProductInfo.objects.count())
+
+
+class FeedCompressionTests(TestCase):
+    """
+    Тесты загрузки сжатых прайсов
+    """
+
+    compressors = {
+        '.gz': gzip.compress,
+        '.bz2': bz2.compress,
+        '.xz': lzma.compress,
+        '.zst': zstandard.ZstdCompressor().compress,
+    }
+
+    def setUp(self):
+        self.user = User.objects.create(email='shop@mail.com', type='shop', is_active=True)
+        self.content = json.dumps({'version': 'v1.0', 'shop': 'Магазин', 'goods': make_goods(50)}).encode()
+
+    def test_split_extension(self):
+        self.assertEqual(split_extension('shop.json'), ('.json', None))
+        self.assertEqual(split_extension('shop.xml.bz2'), ('.xml', 'bzip2'))
+        self.assertEqual(split_extension('http://example.com/shop.yaml.GZ'), ('.yaml', 'gzip'))
+        self.assertEqual(split_extension('shop.zst'), ('', 'zstd'))
+
+    def test_compressed_files(self):
+        """
+        Сжатые файлы распаковываются по сигнатуре, формат определяется по имени без расширения сжатия
+        """
+        for extension, compress in self.compressors.items():
+            with self.subTest(extension=extension):
+                ProductInfo.objects.all().delete()
+                Shop.objects.all().delete()
+                response = load_partner_file(ContentFile(compress(self.content), name=f'shop.json{extension}'),
+                                             self.user.id)
+                self.assertEqual(response.status_code, 201)
+                self.assertEqual(ProductInfo.objects.count(), 50)
+
+    def test_already_decompressed(self):
+        """
+        Файл с расширением сжатия, но без сигнатуры, читается как несжатый
+        """
+        response = load_partner_file(ContentFile(self.content, name='shop.json.gz'), self.user.id)
+        self.assertEqual(response.status_code, 201)
+
+    def test_corrupted(self):
+        content = gzip.compress(self.content)
+        content = content[:len(content) // 2]
+        response = load_partner_file(ContentFile(content, name='shop.json.gz'), self.user.id)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ProductInfo.objects.count())
+
+
+class TemporaryUploadTests(TestCase):
+    """
+    Тесты загрузки прайсов из временных файлов на диске
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(email='shop@mail.com', type='shop', is_active=True)
+        self.content = json.dumps({'version': 'v1.0', 'shop': 'Магазин', 'goods': make_goods(50)}).encode()
+
+    def upload(self, content, name='shop.json'):
+        upload = TemporaryUploadedFile(name, 'application/octet-stream', len(content), None)
+        upload.write(content)
+        upload.seek(0)
+        return upload
+
+    def test_mapped_stream(self):
+        """
+        Файл на диске читается через mmap, поток в памяти - напрямую
+        """
+        upload = self.upload(self.content)
+        with mapped_stream(upload.file) as stream:
+            self.assertIsInstance(stream, mmap.mmap)
+            self.assertEqual(stream.read(), self.content)
+        upload.close()
+
+        buffer = io.BytesIO(self.content)
+        with mapped_stream(buffer) as stream:
+            self.assertIs(stream, buffer)
+
+    def test_temporary_files(self):
+        progress = []
+        for content, name in ((self.content, 'shop.json'), (gzip.compress(self.content), 'shop.json.gz')):
+            with self.subTest(name=name):
+                Shop.objects.all().delete()
+                upload = self.upload(content, name)
+                response = load_partner_file(upload, self.user.id, progress=lambda *args: progress.append(args))
+                upload.close()
+                self.assertEqual(response.status_code, 201)
+                self.assertEqual(ProductInfo.objects.count(), 50)
+        self.assertTrue(progress)
+        self.assertEqual(progress[-1], (50, 50))
+
+
+class ParallelImportTests(TestCase):
+    """
+    Тесты параллельного разбора прайсов
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(email='shop@mail.com', type='shop', is_active=True)
+
+    def load(self, goods, workers=2):
+        content = json.dumps({'version': 'v1.0', 'shop': 'Магазин', 'goods': goods}, ensure_ascii=False).encode()
+        options = dict(settings.PRICE_IMPORT, PARALLEL_WORKERS=workers, PARALLEL_MIN_SIZE=0,
+                       PARALLEL_SEGMENT_SIZE=2000)
+        Shop.objects.all().delete()
+        with self.settings(PRICE_IMPORT=options):
+            return load_partner_file(ContentFile(content, name='shop.json'), self.user.id, mode='replace')
+
+    def test_segments(self):
+        goods = make_goods(300)
+        feed = Feed(iter_json_feed(io.BytesIO(json.dumps({'version': 'v1.0', 'shop': 'Магазин',
+                                                           'goods': goods}).encode()), 2000))
+        parts = list(feed.parts())
+        self.assertGreater(len([kind for kind, _ in parts if kind == 'segment']), 10)
+        with SegmentPool(2) as pool:
+            self.assertEqual([item for items, _ in pool.goods(Feed(iter([('key', 'shop', 'Магазин')] + [
+                ('segment' if kind == 'segment' else 'item', 'goods', value) for kind, value in parts])))
+                for item in items], goods)
+
+    def test_daemonic_process(self):
+        """
+        В демоническом процессе (исполнитель celery prefork) прайс разбирается последовательно
+        """
+        def run(queue):
+            workers = parallel_workers('json', 2 ** 30)
+            try:
+                with SegmentPool(2) as pool:
+                    pool.executor.submit(int, 1).result()
+            except AssertionError:
+                queue.put((workers, 'no children'))
+            else:
+                queue.put((workers, 'ok'))
+
+        queue = multiprocessing.Queue()
+        with self.settings(PRICE_IMPORT=dict(settings.PRICE_IMPORT, PARALLEL_WORKERS=2, PARALLEL_MIN_SIZE=0)):
+            self.assertEqual(parallel_workers('json', 2 ** 30), 2)
+            process = multiprocessing.Process(target=run, args=(queue, ), daemon=True)
+            process.start()
+            result = queue.get(timeout=60)
+            process.join()
+        self.assertEqual(result, (0, 'no children'))
+
+    def test_import(self):
+        goods = make_goods(500)
+        response = self.load(goods)
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data['Created'], 500)
+        self.assertEqual(sorted(ProductInfo.objects.values_list('external_id', 'quantity'))[-1], (500, 9))
+        self.assertEqual(ProductParameter.objects.count(), 1000)
+
+    def test_errors(self):
+        """
+        Ошибки товаров и их номера строк совпадают с последовательным разбором
+        """
+        goods = make_goods(400)
+        goods[5]['price'] = 'abc'
+        goods[150]['name'] = goods[3]['name']
+        goods[390]['parameters'] = [{'name': 'Параметр'}]
+        serial = self.load(goods, workers=0)
+        parallel = self.load(goods)
+        self.assertEqual(parallel.status_code, 400)
+        self.assertEqual(parallel.data['Rows'], serial.data['Rows'])
+        self.assertEqual([row['row'] for row in parallel.data['Rows']], [5, 150, 390])
+
+    def test_false_boundary(self):
+        """
+        Прайс с сегментами, обрезанными внутри вложенного словаря с ключом price,
+        разбирается заново последовательно
+        """
+        goods = make_goods(300)
+        for item in goods:
+            item['history'] = [{'price': 1}, {'price': 2}, {'price': 3}, {'price': 4}]
+        response = self.load(goods)
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(ProductInfo.objects.count(), 300)
+
+    def test_wrong_json(self):
+        """
+        Ошибка разбора описывается так же, как при последовательном разборе
+        """
+        content = json.dumps({'version': 'v1.0', 'shop': 'Магазин', 'goods': make_goods(300)}).encode()
+        content = content.replace(b'"name": "\\u0422\\u043e\\u0432\\u0430\\u0440 150"', b'"name" "x"')
+        responses = []
+        for workers in (0, 2):
+            options = dict(settings.PRICE_IMPORT, PARALLEL_WORKERS=workers, PARALLEL_MIN_SIZE=0,
+                           PARALLEL_SEGMENT_SIZE=2000)
+            with self.settings(PRICE_IMPORT=options):
+                responses.append(load_partner_file(ContentFile(content, name='shop.json'), self.user.id))
+        self.assertEqual(responses[1].status_code, 400)
+        self.assertIn('Некорректный формат файла', responses[1].data['Errors'])
+        self.assertEqual(responses[1].data, responses[0].data)
+        self.assertFalse(ProductInfo.objects.exists())
+
+
+class DropFolderTests(TestCase):
+    """
+    Тесты загрузки прайсов из каталога магазинов на диске
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(email='shop@mail.com', type='shop', is_active=True)
+        self.shop = Shop.objects.create(name='Магазин', user=self.user)
+        self.root = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.root.name, str(self.shop.id)))
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def drop(self, name, content, age=3600, shop_id=None):
+        path = os.path.join(self.root.name, str(shop_id or self.shop.id), name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as target:
+            target.write(content)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def feed(self, count):
+        return json.dumps({'version': 'v1.0', 'shop': 'Магазин', 'goods': make_goods(count)}).encode()
+
+    def test_scan(self):
+        path = self.drop('shop.json', self.feed(50))
+        results = scan_drop_folder(root=self.root.name)
+        self.assertEqual(results, [dict(shop_id=self.shop.id, name='shop.json', status=201, errors=None)])
+        self.assertEqual(ProductInfo.objects.count(), 50)
+        dropped = DropFile.objects.get()
+        self.assertEqual(dropped.digest, hashlib.sha256(self.feed(50)).hexdigest())
+        self.assertEqual(dropped.get_result()['Created'], 50)
+
+        # Неизменившийся файл не загружается, в том числе после изменения времени файла:
+        self.assertEqual(scan_drop_folder(root=self.root.name), [])
+        os.utime(path, (time.time() - 60, time.time() - 60))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(scan_drop_folder(root=self.root.name), [])
+        self.assertEqual(DropFile.objects.get().mtime_ns, os.stat(path).st_mtime_ns)
+        self.assertFalse([query for query in queries if 'product' in query['sql'].lower()])
+
+        self.drop('shop.json', self.feed(60))
+        self.assertEqual(scan_drop_folder(root=self.root.name)[0]['status'], 201)
+        self.assertEqual(ProductInfo.objects.count(), 60)
+
+    def test_skipped_files(self):
+        """
+        Пропускаются файлы, изменявшиеся недавно, скрытые и файлы неизвестных магазинов
+        """
+        self.drop('shop.json', self.feed(10), age=0)
+        self.drop('.shop.json', self.feed(10))
+        self.drop('shop.json', self.feed(10), shop_id=self.shop.id + 100)
+        self.assertEqual(scan_drop_folder(root=self.root.name), [])
+        self.assertFalse(ProductInfo.objects.exists())
+
+    def test_wrong_file(self):
+        """
+        Ошибка загрузки записывается и не повторяется, пока файл не изменится
+        """
+        self.drop('shop.txt', self.feed(10))
+        results = scan_drop_folder(root=self.root.name)
+        self.assertEqual(results[0]['status'], 400)
+        self.assertEqual(DropFile.objects.get().status_code, 400)
+        self.assertEqual(scan_drop_folder(root=self.root.name), [])
+
+    def test_command(self):
+        self.drop('shop.json.gz', gzip.compress(self.feed(10)))
+        output = io.StringIO()
+        call_command('import_drop_folder', dir=self.root.name, mode='replace', stdout=output)
+        self.assertIn('shop.json.gz: 201', output.getvalue())
+        self.assertEqual(ProductInfo.objects.count(), 10)
+
+
+class ColumnFeedTests(TestCase):
+    """
+    Тесты прайсов v2.0 (товары по столбцам)
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(email='shop@mail.com', type='shop', is_active=True)
+
+    def load(self, document, name='shop.json'):
+        content = json.dumps(document, ensure_ascii=False).encode()
+        return load_partner_file(ContentFile(content, name=name), self.user.id)
+
+    def make_feed(self):
+        return {
+            'version': 'v2.0', 'shop': 'Магазин', 'categories': [{'name': 'Смартфоны'}, {'name': 'Аксессуары'}],
+            'goods': {
+                'id': [1, 2, 3],
+                'category': [0, 0, 1],
+                'name': ['Телефон 1', 'Телефон 2', 'Чехол'],
+                'price': [100, 200, 10],
+                'price_rrc': [110, 220, 12],
+                'quantity': [1, 2, 3],
+                'parameters': {
+                    'names': ['Цвет', 'Память'],
+                    'values': ['черный', '64'],
+                    'good': [0, 0, 1, 2],
+                    'name': [0, 1, 0, 0],
+                    'value': [0, 1, 0, 0],
+                },
+            },
+        }
+
+    def test_formats_import_equally(self):
+        """
+        Прайс v2.0 во всех форматах загружается так же, как тот же прайс v1.0
+        """
+        counts = []
+        for version in ('v1.0', 'v2.0'):
+            for feed_format in ('json', 'yaml', 'xml'):
+                with self.subTest(version=version, format=feed_format):
+                    Shop.objects.all().delete()
+                    target = io.StringIO()
+                    FeedGenerator(40, parameters=3, categories=4, version=version).write(feed_format, target)
+                    response = load_partner_file(ContentFile(target.getvalue().encode(), name=f'shop.{feed_format}'),
+                                                 self.user.id)
+                    self.assertEqual(response.status_code, 201, response.data)
+                    counts.append((ProductInfo.objects.count(), ProductParameter.objects.count(),
+                                   sorted(ProductInfo.objects.values_list('external_id', 'quantity'))))
+        self.assertEqual(counts[0][:2], (40, 120))
+        self.assertTrue(all(count == counts[0] for count in counts))
+
+    def test_parameters_table(self):
+        response = self.load(self.make_feed())
+
+        self.assertEqual(response.status_code, 201)
+        info = ProductInfo.objects.get(external_id=1)
+        self.assertEqual(info.product.category.name, 'Смартфоны')
+        self.assertEqual(dict(info.product_parameters.values_list('parameter__name', 'value')),
+                         {'Цвет': 'черный', 'Память': '64'})
+        self.assertEqual(ProductInfo.objects.get(external_id=3).product.category.name, 'Аксессуары')
+
+    def test_row_errors(self):
+        """
+        Ошибки в значениях возвращаются по номерам товаров
+        """
+        document = self.make_feed()
+        goods = document['goods']
+        goods['price'][0] = 'abc'
+        goods['category'][1] = 5
+        goods['parameters']['good'].append(2)
+        goods['parameters']['name'].append(0)
+        goods['parameters']['value'].append(1)
+
+        response = self.load(document)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([(error['row'], error['error']) for error in response.data['Rows']],
+                         [(0, 'некорректно указана информация по продукту'),
+                          (1, 'некорректно указана информация по продукту'),
+                          (2, 'параметры с одинаковым именем')])
+        self.assertFalse(ProductInfo.objects.count())
+
+    def test_structure_errors(self):
+        for change in (lambda goods: goods['name'].pop(),
+                       lambda goods: goods.pop('price'),
+                       lambda goods: goods['parameters']['good'].__setitem__(0, 10),
+                       lambda goods: goods['parameters']['name'].__setitem__(0, 'Цвет')):
+            document = self.make_feed()
+            change(document['goods'])
+            response = self.load(document)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('Errors', response.data)
+            self.assertNotIn('Rows', response.data)
+
+
+class FeedServerHandler(BaseHTTPRequestHandler):
+    """
+    Обработчик тестового сервера прайсов
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            if self.path.startswith('/slow'):
+                time.sleep(1)
+            if self.path.startswith('/error'):
+                self.send_response(500)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            time.sleep(0.05)
+            content = server.content
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            if self.path.startswith('/zstd') and 'zstd' in self.headers.get('Accept-Encoding', ''):
+                content = zstandard.ZstdCompressor().compress(content)
+                self.send_header('Content-Encoding', 'zstd')
+            self.send_header('Content-Length', str(len(content)))
+            self.send_header('ETag', '"v1"')
+            self.end_headers()
+            self.wfile.write(content)
+        except ConnectionError:
+            # Клиент закрыл соединение по таймауту
+            pass
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class ImportProfilerTests(TestCase):
+    """
+    Тесты профиля загрузки
+    """
+
+    def test_iterate_memory_peak(self):
+        """
+        Пик памяти этапа iterate - пик всего цикла, а не одного элемента
+        """
+        kept = []
+
+        def items():
+            for index in range(100):
+                # Память, накопленная за цикл (например, буфер читателя)
+                kept.append(bytearray(100 * 2 ** 10))
+                yield index
+
+        profiler = ImportProfiler(memory=True)
+        profiler.start()
+        try:
+            self.assertEqual(sum(profiler.iterate('decode', items())), 4950)
+            with profiler.phase('write'):
+                pass
+        finally:
+            profiler.stop()
+        self.assertEqual(profiler.phases['decode'].rows, 100)
+        self.assertGreaterEqual(profiler.phases['decode'].memory_peak, 100 * 100 * 2 ** 10)
+        self.assertLess(profiler.phases['write'].memory_peak, 2 ** 20)
+
+
+class FeedFetcherTests(TestCase):
+    """
+    Тесты параллельного скачивания прайсов
+    """
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FeedServerHandler)
+        self.server.lock = threading.Lock()
+        self.server.active = self.server.max_active = 0
+        with open(os.path.join(settings.MEDIA_ROOT, 'tests/shop1.json'), 'rb') as fp:
+            self.server.content = fp.read()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch_feeds(self):
+        """
+        Прайсы скачиваются во временные файлы, число соединений с сервером ограничено
+        """
+        options = dict(settings.PRICE_IMPORT, FETCH_CONNECTIONS_PER_HOST=2)
+        with self.settings(PRICE_IMPORT=options):
+            results = fetch_feeds([(f'{self.base_url}/feed{index}.json', {}) for index in range(6)])
+
+        self.assertLessEqual(self.server.max_active, 2)
+        digest = hashlib.sha256(self.server.content).hexdigest()
+        for result in results:
+            self.assertIsNone(result['error'])
+            self.assertEqual(result['digest'], digest)
+            self.assertEqual(result['etag'], '"v1"')
+            with open(result['path'], 'rb') as fp:
+                self.assertEqual(fp.read(), self.server.content)
+            os.remove(result['path'])
+
+    def test_fetch_errors(self):
+        """
+        Ответ 304, ошибки сервера, таймауты и недоступный сервер
+        """
+        options = dict(settings.PRICE_IMPORT, FETCH_READ_TIMEOUT=0.2)
+        with self.settings(PRICE_IMPORT=options):
+            not_modified, error, slow, unreachable = fetch_feeds([
+                (f'{self.base_url}/feed.json', {'If-None-Match': '"v1"'}),
+                (f'{self.base_url}/error.json', {}),
+                (f'{self.base_url}/slow.json', {}),
+                ('http://127.0.0.1:1/feed.json', {}),
+            ])
+
+        self.assertEqual(not_modified['status'], 304)
+        self.assertIsNone(not_modified['error'])
+        self.assertIsNone(not_modified['path'])
+        self.assertEqual(error['status'], 500)
+        for result in (error, slow, unreachable):
+            self.assertTrue(result['error'])
+            self.assertIsNone(result['path'])
+
+    def test_load_fetched_feed(self):
+        """
+        Скачанный прайс загружается в базу, временный файл удаляется
+        """
+        user = User.objects.create(email='shop@mail.com', type='shop', is_active=True)
+        fetched, = fetch_feeds([(f'{self.base_url}/feed.json', {})])
+
+        response = load_fetched_feed(fetched, user.id)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(os.path.exists(fetched['path']))
+        shop = Shop.objects.get(user=user)
+        self.assertEqual(shop.feed_etag, '"v1"')
+        self.assertEqual(shop.feed_digest, import_digest(fetched['digest'], settings.PRICE_IMPORT['MODE'], 'reject'))
+        self.assertTrue(ProductInfo.objects.filter(shop=shop).count())
+
+    def test_import_shop_fetched(self):
+        """
+        Задача магазина загружает скачанный прайс, а если его файла нет на этом сервере -
+        скачивает прайс сама; файл прайса удаляется и для удаленного магазина
+        """
+        user = User.objects.create(email='shop@mail.com', type='shop', is_active=True)
+        shop = Shop.objects.create(name='Связной', user=user, load_url=f'{self.base_url}/feed.json')
+        fetched, = fetch_feeds([(shop.load_url, {})])
+        self.assertTrue(fetched['path'].startswith(settings.PRICE_IMPORT['FETCH_DIR']))
+        os.remove(fetched['path'])
+
+        self.assertTrue(import_shop(shop.id, fetched)['success'])
+        self.assertTrue(ProductInfo.objects.filter(shop=shop).count())
+
+        fetched, = fetch_feeds([(shop.load_url, {})])
+        self.assertFalse(import_shop(shop.id + 1, fetched)['success'])
+        self.assertFalse(os.path.exists(fetched['path']))
+
+    def test_load_fetched_compressed_feed(self):
+        """
+        Прайс, отданный сервером со сжатием zstd, распаковывается при загрузке
+        """
+        user = User.objects.create(email='shop@mail.com', type='shop', is_active=True)
+        fetched, = fetch_feeds([(f'{self.base_url}/zstd/feed.json', {'Accept-Encoding': 'zstd'})])
+
+        response = load_fetched_feed(fetched, user.id)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(ProductInfo.objects.count(), response.data['Created'])
+
+    def test_circuit_breaker(self):
+        """
+        Ссылка исключается после нескольких неудач подряд и проверяется снова по таймауту
+        """
+        shop = Shop.objects.create(name='Магазин')
+        breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+        now = timezone.now()
+
+        breaker.record(shop, False, now)
+        self.assertTrue(breaker.allows(shop, now))
+        breaker.record(shop, False, now)
+        self.assertFalse(breaker.allows(Shop.objects.get(id=shop.id), now))
+        self.assertTrue(breaker.allows(shop, now + timedelta(seconds=61)))
+        breaker.record(shop, True, now)
+        shop = Shop.objects.get(id=shop.id)
+        self.assertEqual(shop.feed_failures, 0)
+        self.assertIsNone(shop.feed_retry_after)
@@ -0,0 +1,131 @@
+from django.conf import settings
+from django.db import transaction
+import hashlib
+import os
+
+from .feed_readers import READ_CHUNK_SIZE
+from .models import ImportJob, UploadSession, UploadChunk
+from .partner_info_loader import feed_digest
+from .response import ResponseOK, ResponseBadRequest, ResponseConflict
+from .storage import private_storage
+from .tasks import run_import_job
+
+
+# Загрузка больших прайсов по частям с докачкой.
+# Поставщик создает сессию загрузки (имя файла, размер, размер части), передает
+# части с контрольной суммой sha256 в любом порядке, запрашивает номера
+# недостающих частей (например, после обрыва связи) и завершает загрузку:
+# собранный файл становится файлом фонового задания импорта (ImportJob) без копирования.
+# Файл сессии создается сразу полного размера, каждая часть пишется на свое место
+# порциями READ_CHUNK_SIZE по мере чтения запроса: ни файл, ни часть целиком
+# в памяти не хранятся.
+
+UPLOAD_DIR = 'uploads'
+
+
+def session_file_name(session):
+    """
+    Имя файла сессии в хранилище (относительно PRIVATE_ROOT)
+    """
+    return os.path.join(UPLOAD_DIR, f'{session.id}-{os.path.basename(session.name)}')
+
+
+def session_path(session):
+    return private_storage.path(session_file_name(session))
+
+
+def create_session(user, name, size, chunk_size=None, checksum='', mode=''):
+    """
+    Создание сессии загрузки и ее файла (разреженного, без записи данных)
+    """
+    session = UploadSession.objects.create(user=user, name=name, size=size,
+                                           chunk_size=chunk_size or settings.PRICE_IMPORT['UPLOAD_CHUNK_SIZE'],
+                                           checksum=(checksum or '').lower(), mode=mode or '')
+    path = session_path(session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as target:
+        target.truncate(size)
+    return session
+
+
+def missing_chunks(session):
+    """
+    Номера частей, еще не принятых сессией
+    """
+    received = set(session.received_chunks.values_list('number', flat=True))
+    return [number for number in range(session.chunks) if number not in received]
+
+
+def write_chunk(session, number, stream, checksum):
+    """
+    Запись части number, читаемой из потока stream, на ее место в файле сессии.
+    checksum - sha256 части (hex). Часть с неверным размером или контрольной суммой
+    не считается принятой (в том числе ранее принятая часть с тем же номером)
+    """
+    if session.state != 'open':
+        return ResponseConflict('Загрузка уже завершена')
+    if not 0 <= number < session.chunks:
+        return ResponseBadRequest('Номер части должен быть от 0 до {}', session.chunks - 1)
+    checksum = (checksum or '').strip().lower()
+    if not checksum:
+        return ResponseBadRequest('Не задана контрольная сумма части (заголовок X-Checksum-Sha256)')
+
+    length = session.chunk_length(number)
+    digest = hashlib.sha256()
+    received = 0
+    with open(session_path(session), 'r+b') as target:
+        target.seek(number * session.chunk_size)
+        for data in iter(lambda: stream.read(READ_CHUNK_SIZE), b''):
+            received += len(data)
+            if received > length:
+                break
+            digest.update(data)
+            target.write(data)
+
+    if received != length:
+        error = ResponseBadRequest('Размер части {number} должен быть {length} байт', dict(number=number, length=length))
+    elif digest.hexdigest() != checksum:
+        error = ResponseBadRequest('Контрольная сумма части {} не совпадает', number)
+    else:
+        UploadChunk.objects.update_or_create(session=session, number=number, defaults=dict(checksum=checksum))
+        session.save(update_fields=('updated_at', ))
+        return ResponseOK(Chunk=number, Missing=len(missing_chunks(session)))
+    session.received_chunks.filter(number=number).delete()
+    return error
+
+
+def finalize_session(session):
+    """
+    Завершение загрузки: проверка полноты файла и его контрольной суммы,
+    постановка файла в очередь импорта (session.job).
+    Возвращает ответ с ошибкой или None
+    """
+    if session.state != 'open':
+        return ResponseConflict('Загрузка уже завершена')
+    missing = missing_chunks(session)
+    if missing:
+        return ResponseConflict('Переданы не все части файла', Missing=missing)
+    if session.checksum:
+        with open(session_path(session), 'rb') as source:
+            digest = feed_digest(iter(lambda: source.read(READ_CHUNK_SIZE), b''))
+        if digest != session.checksum:
+            return ResponseBadRequest('Контрольная сумма файла не совпадает')
+
+    with transaction.atomic():
+        session.job = ImportJob.objects.create(user_id=session.user_id, mode=session.mode,
+                                               file=session_file_name(session))
+        session.state = 'finalized'
+        session.save(update_fields=('job', 'state', 'updated_at', ))
+    session.job.task_id = run_import_job.delay(session.job.id).id
+    session.job.save(update_fields=('task_id', ))
+    return None
+
+
+def delete_session(session):
+    """
+    Отмена загрузки. Файл завершенной загрузки принадлежит заданию импорта
+    и удаляется после импорта
+    """
+    if session.state == 'open' and os.path.exists(session_path(session)):
+        os.remove(session_path(session))
+    session.delete()
@@ -67,4 +67,12 @@ def to_positive_decimal(value):
     return None if value is None or value < 0 else Decimal.from_float(value)
 
 
+def chunked(values, size):
+    """
+    Разбиение списка на части не длиннее size
+    """
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
 
@@ -16,4 +16,8 @@ app.conf.beat_schedule = {
         'task': 'core.tasks.do_import',
         'schedule': crontab(minute=0, hour=0)
     },
+    'do_drop_folder_import': {
+        'task': 'core.tasks.import_drop_folder',
+        'schedule': crontab(minute='*/5')
+    },
 }
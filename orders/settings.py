@@ -147,6 +147,10 @@ STATICFILES_DIRS = [
 MEDIA_URL = '/data/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'data')
 
+# Файлы, недоступные по MEDIA_URL (прайсы поставщиков, отчеты загрузок, см. core.storage).
+# При нескольких серверах с воркерами celery каталог должен быть общим
+PRIVATE_ROOT = os.path.join(BASE_DIR, 'private')
+
 AUTH_USER_MODEL = 'rest_auth.User'
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
@@ -167,7 +171,7 @@ REST_FRAMEWORK = {
 
     'DEFAULT_SCHEMA_CLASS': 'core.schemas.ResponsesSchema',
 
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    'DEFAULT_PAGINATION_CLASS': 'core.pagination.ListingPagination',
     'PAGE_SIZE': 40,
 
     'DEFAULT_RENDERER_CLASSES': (
@@ -228,7 +232,7 @@ REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend',
         'rest_framework.filters.SearchFilter',
-        'rest_framework.filters.OrderingFilter',
+        'core.filters.AliasOrderingFilter',
     ],
 
 }
@@ -236,7 +240,17 @@ REST_FRAMEWORK = {
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
-    }
+    },
+    # Кэш каталога, общий для всех процессов (web и celery): версии каталога и число
+    # записей списков (см. core.catalog, core.pagination). Хранится в таблице базы,
+    # которая создается командой createcachetable
+    'catalog': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'catalog_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
 }
 
 CACHE_TIMES = {
@@ -246,6 +260,8 @@ CACHE_TIMES = {
     'OPENAPI': 60*60*24,
     'SWAGGER': 60*60*24,
     'REDOC': 60*60*24,
+    # Число записей в списках каталога (сбрасывается при изменении каталога, см. core.pagination):
+    'PAGE_COUNTS': 60*60,
 }
 
 # Тестовые (общие) ключи для капчи
@@ -264,6 +280,79 @@ BROKER_URL = 'redis://' + REDIS_HOST + ':' + REDIS_PORT + '/0'
 BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 3600} 
 CELERY_RESULT_BACKEND = 'redis://' + REDIS_HOST + ':' + REDIS_PORT + '/0'
 
+# Импорт прайсов поставщиков
+
+PRICE_IMPORT = {
+    # Число товаров, записываемых в базу за одну пачку
+    'BATCH_SIZE': 1000,
+    # Максимальное число ошибок в товарах, возвращаемых в ответе
+    'MAX_ERRORS': 1000,
+    # Число хранимых отчетов о пропущенных товарах (частичных загрузок) на магазин
+    'ERROR_REPORTS': 10,
+    # Наибольшее число изменений в одном запросе обновления остатков и цен (partners/patch)
+    'PATCH_MAX_ITEMS': 10000,
+    # Количество товара в наличии для предложений прайса YML без элемента count
+    'YML_AVAILABLE_QUANTITY': 1,
+    # Параллельный разбор прайсов json не меньше PARALLEL_MIN_SIZE байт
+    # в PARALLEL_WORKERS процессах (None - по числу ядер, 0 - без параллельного разбора)
+    # сегментами по PARALLEL_SEGMENT_SIZE символов (см. core.feed_parallel)
+    'PARALLEL_WORKERS': None,
+    'PARALLEL_MIN_SIZE': 32 * 2 ** 20,
+    'PARALLEL_SEGMENT_SIZE': 2 * 2 ** 20,
+    # Профилирование загрузок по этапам (модель ImportRun) и учет пика памяти
+    # через tracemalloc (замедляет загрузку в 1.5-2 раза, для import_benchmark --profile-memory)
+    'PROFILE': True,
+    'PROFILE_MEMORY': False,
+    # Режим загрузки по умолчанию (см. core.models.IMPORT_MODE_CHOICES):
+    # replace - полная замена прайса, diff - только изменения (задается в запросе
+    # параметром mode, в import_drop_folder - ключом --mode)
+    'MODE': 'replace',
+
+    # Скачивание прайсов по ссылкам (таймауты в секундах):
+    'FETCH_TIMEOUT': 15 * 60,
+    'FETCH_CONNECT_TIMEOUT': 10,
+    'FETCH_READ_TIMEOUT': 60,
+    # Число одновременных соединений (всего и с одним сервером):
+    'FETCH_CONNECTIONS': 20,
+    'FETCH_CONNECTIONS_PER_HOST': 2,
+    # Каталог для скачанных прайсов: прайсы скачиваются задачей do_import, а загружаются
+    # задачами import_shop на любых воркерах, поэтому каталог должен быть для них общим
+    'FETCH_DIR': os.path.join(PRIVATE_ROOT, 'fetched'),
+    # Ссылка, не ответившая BREAKER_THRESHOLD раз подряд,
+    # не запрашивается BREAKER_RESET_TIMEOUT секунд
+    'BREAKER_THRESHOLD': 3,
+    'BREAKER_RESET_TIMEOUT': 6 * 60 * 60,
+
+    # Загрузка прайсов по частям (байт): размер части по умолчанию,
+    # наибольший размер части и файла
+    'UPLOAD_CHUNK_SIZE': 8 * 2 ** 20,
+    'UPLOAD_MAX_CHUNK_SIZE': 64 * 2 ** 20,
+    'UPLOAD_MAX_SIZE': 16 * 2 ** 30,
+
+    # Каталог прайсов магазинов на диске (относительно PRIVATE_ROOT, см. core.drop_folder)
+    # и время (в секундах) без изменений файла, после которого он загружается
+    'DROP_DIR': 'drop',
+    'DROP_SETTLE_TIME': 60,
+}
+
+# Поиск по каталогу
+
+CATALOG_SEARCH = {
+    # Нечеткий поиск по названиям продуктов (см. core.fuzzy_search), если полнотекстовый
+    # поиск ничего не нашел: число кандидатов по сходству триграмм, проверяемых
+    # расстоянием редактирования, время на проверку (в секундах), число найденных продуктов
+    'FUZZY_CANDIDATES': 100,
+    'FUZZY_BUDGET': 0.01,
+    'FUZZY_LIMIT': 20,
+    # Как часто (в секундах) индекс дополняется новыми продуктами и перестраивается целиком
+    'FUZZY_SYNC_INTERVAL': 5,
+    'FUZZY_REBUILD_INTERVAL': 60 * 60,
+    # Подсказки при вводе запроса (см. core.suggest): число подсказок и как часто
+    # (в секундах) проверяется, не изменился ли каталог
+    'SUGGEST_LIMIT': 10,
+    'SUGGEST_SYNC_INTERVAL': 5,
+}
+
 PATH_REMARKS = {
     '/users/': ' (покупатель)',
     '/partners/': ' (поставщик)',
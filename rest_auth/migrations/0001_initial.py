@@ -0,0 +1,99 @@
+# Generated by Django 2.2.4 on 2026-10-17 02:01
+
+from django.conf import settings
+import django.contrib.auth.models
+import django.contrib.auth.validators
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import phonenumber_field.modelfields
+import rest_auth.models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('auth', '0011_update_proxy_permissions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='User',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('password', models.CharField(max_length=128, verbose_name='password')),
+                ('last_login', models.DateTimeField(blank=True, null=True, verbose_name='last login')),
+                ('is_superuser', models.BooleanField(default=False, help_text='Designates that this user has all permissions without explicitly assigning them.', verbose_name='superuser status')),
+                ('first_name', models.CharField(blank=True, max_length=30, verbose_name='first name')),
+                ('last_name', models.CharField(blank=True, max_length=150, verbose_name='last name')),
+                ('is_staff', models.BooleanField(default=False, help_text='Designates whether the user can log into this admin site.', verbose_name='staff status')),
+                ('date_joined', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date joined')),
+                ('email', models.EmailField(help_text='Введите email адрес', max_length=254, unique=True, verbose_name='email address')),
+                ('company', models.CharField(blank=True, help_text='Укажите компанию', max_length=40, verbose_name='Компания')),
+                ('position', models.CharField(blank=True, help_text='Укажите должность', max_length=40, verbose_name='Должность')),
+                ('username', models.CharField(error_messages={'unique': 'A user with that username already exists.'}, help_text='Required. 150 characters or fewer. Letters, digits and @/./+/-/_ only.', max_length=150, validators=[django.contrib.auth.validators.UnicodeUsernameValidator()], verbose_name='username')),
+                ('is_active', models.BooleanField(default=False, help_text='Designates whether this user should be treated as active. Unselect this instead of deleting accounts.', verbose_name='active')),
+                ('type', models.CharField(choices=[('shop', 'Магазин'), ('buyer', 'Покупатель')], default='buyer', max_length=10, verbose_name='Тип пользователя')),
+                ('groups', models.ManyToManyField(blank=True, help_text='The groups this user belongs to. A user will get all permissions granted to each of their groups.', related_name='user_set', related_query_name='user', to='auth.Group', verbose_name='groups')),
+                ('user_permissions', models.ManyToManyField(blank=True, help_text='Specific permissions for this user.', related_name='user_set', related_query_name='user', to='auth.Permission', verbose_name='user permissions')),
+            ],
+            options={
+                'verbose_name': 'Пользователь',
+                'verbose_name_plural': 'Пользователи',
+                'ordering': ('email',),
+            },
+            managers=[
+                ('objects', rest_auth.models.UserManager()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Group',
+            fields=[
+            ],
+            options={
+                'verbose_name': 'Группа',
+                'verbose_name_plural': 'Группы',
+                'proxy': True,
+                'indexes': [],
+                'constraints': [],
+            },
+            bases=('auth.group',),
+            managers=[
+                ('objects', django.contrib.auth.models.GroupManager()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Contact',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('person', models.CharField(blank=True, help_text='Контактное лицо', max_length=50, verbose_name='Контактное лицо')),
+                ('phone', phonenumber_field.modelfields.PhoneNumberField(blank=True, help_text='Телефон', max_length=128, null=True, region=None, verbose_name='Телефон')),
+                ('city', models.CharField(blank=True, help_text='Введите город', max_length=50, verbose_name='Город')),
+                ('street', models.CharField(blank=True, help_text='Введите улицу', max_length=100, verbose_name='Улица')),
+                ('house', models.CharField(blank=True, help_text='Введите дом', max_length=15, verbose_name='Дом')),
+                ('structure', models.CharField(blank=True, help_text='Введите корпус', max_length=15, verbose_name='Корпус')),
+                ('building', models.CharField(blank=True, help_text='Введите строение', max_length=15, verbose_name='Строение')),
+                ('apartment', models.CharField(blank=True, help_text='Введите квартиру', max_length=15, verbose_name='Квартира')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='contacts', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Контакт',
+                'verbose_name_plural': 'Отдельные контакты',
+            },
+        ),
+        migrations.CreateModel(
+            name='ConfirmEmailToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Время создания токена')),
+                ('key', models.CharField(db_index=True, max_length=64, unique=True, verbose_name='Key')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='confirm_email_tokens', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь, связанный с данным токеном сброса пароля')),
+            ],
+            options={
+                'verbose_name': 'Токен подтверждения Email',
+                'verbose_name_plural': 'Токены подтверждения Email',
+            },
+        ),
+    ]